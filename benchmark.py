@@ -0,0 +1,461 @@
+"""Benchmarks of the mpu6050 pipeline that need no sensor.
+
+Stages are run on synthetic samples or on a recording (`--capture`) and
+report samples/sec, us/sample, p99 latency where it applies and peak RSS
+after the stage. `--json <file>` writes the results for comparing runs,
+`--compare <file>` prints the change of throughput, p99 latency and peak
+RSS against earlier ones. Latency percentiles are upper bounds of
+`metrics.Histogram` buckets.
+
+`batch_generator.quaternion` isn't faster than `generator.quaternion`: the
+quaternion filter is recursive with no vectorized form, so its batches
+are filtered sample by sample and converting blocks to lists and back
+costs about what the generator saves. Peak RSS never goes down, a stage
+shows the most of the stages before it.
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from ct_addons import wire
+from ct_addons.clock import monotonic
+from ct_addons.eventloop import EventLoop
+from ct_addons.metrics import Histogram, Registry
+from ct_addons.transport import CTSocketClient
+from ct_addons.event_trackers.mpu6050 import (
+    FILTERS, Mpu6050EventTracker, capture, epoch_rules, vibration,
+)
+from ct_addons.event_trackers.mpu6050.data_source import (
+    DataStreamer, motiontracker_batch_generator, motiontracker_data_generator,
+)
+
+
+def synthetic_samples(n, dt=0.011, seed=0):
+    # slow wobble with sensor noise, good enough to keep filters busy
+    rnd = random.Random(seed)
+    samples = []
+    for i in range(n):
+        t = i * dt
+        samples.append((
+            0.42 + 2.0 * math.sin(t) + rnd.gauss(0, 0.05),
+            -1.11 + 1.5 * math.cos(0.5 * t) + rnd.gauss(0, 0.05),
+            10.05 + rnd.gauss(0, 0.05),
+            40 * math.sin(1.3 * t) + rnd.gauss(0, 0.3),
+            25 * math.cos(0.7 * t) + rnd.gauss(0, 0.3),
+            10 * math.sin(2.1 * t) + rnd.gauss(0, 0.3),
+            25.0,
+        ))
+    return samples
+
+
+def recorded_samples(paths, n):
+    replay = capture.CaptureReplay(paths, speed=0)
+    samples = []
+    for item in replay:
+        samples.append(tuple(item))
+        if len(samples) == n:
+            break
+    replay.close()
+    return samples
+
+
+def result(n, elapsed, latency=None, **extra):
+    stats = {
+        'samples': n,
+        'seconds': elapsed,
+        'samples_per_sec': n / elapsed if elapsed else 0.0,
+        'us_per_sample': elapsed / n * 1e6 if n else 0.0,
+        # peak of the whole process so far, kilobytes on Linux
+        'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if latency is not None:
+        # `Histogram.snapshot()`
+        stats['p99_latency_us'] = latency['p99'] * 1e6
+        stats['max_latency_us'] = latency['max'] * 1e6
+    stats.update(extra)
+    return stats
+
+
+def bench_filter(filter_class, samples, dt=0.011, calibrate_n=300):
+    """`add_data` calls plus reading the outputs."""
+    tracker = filter_class(0.5, dt)
+    tracker.start_calibration()
+    for item in samples[:calibrate_n]:
+        tracker.add_data(*item[:-1])
+    tracker.finish_calibration()
+    samples = samples[calibrate_n:]
+    started_at = time.time()
+    for item in samples:
+        tracker.add_data(*item[:-1])
+        tracker.angles
+        tracker.coordinates
+    return result(len(samples), time.time() - started_at)
+
+
+def bench_generator(filter_class, samples, dt=0.011, calibrate_n=300):
+    """`motiontracker_data_generator`, calibration included."""
+    started_at = time.time()
+    for _ in motiontracker_data_generator(iter(samples), filter_class(0.5, dt),
+                                          calibrate_n=calibrate_n):
+        pass
+    return result(len(samples), time.time() - started_at)
+
+
+def bench_batch_generator(filter_class, samples, dt=0.011, calibrate_n=300,
+                          blocksize=1024):
+    """`motiontracker_batch_generator`, calibration included."""
+    import numpy as np
+    data = np.array(samples)
+    blocks = (data[i:i + blocksize] for i in range(0, len(data), blocksize))
+    started_at = time.time()
+    for _ in motiontracker_batch_generator(blocks, filter_class(0.5, dt),
+                                           calibrate_n=calibrate_n):
+        pass
+    return result(len(samples), time.time() - started_at)
+
+
+def bench_streamer(samples, n_consumers, runtime, rate=None):
+    """`DataStreamer` fanning `samples` out to `n_consumers`, as fast as
+    possible or at `rate` per second. Latency is from the generator
+    yielding a sample until a consumer gets it; the ring holds all
+    samples so nothing is lost to slow consumers."""
+    loop = None
+    if runtime == 'eventloop':
+        loop = EventLoop()
+        loop.start(name='bench-streamer')
+    started = threading.Event()
+    received = [0] * n_consumers
+    latencies = [Histogram() for _ in range(n_consumers)]
+    done = threading.Event()
+
+    def generator():
+        started.wait()
+        pace = rate and 10.0 / rate
+        next_at = monotonic()
+        for i, item in enumerate(samples):
+            if pace and i % 10 == 0:
+                next_at += pace
+                delay = next_at - monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            yield (monotonic(),) + item
+
+    def make_consumer(i):
+        histogram = latencies[i]
+
+        def consume(sent_at, *_):
+            histogram.observe(monotonic() - sent_at)
+            received[i] += 1
+            if received[i] == len(samples) and all(
+                    n == len(samples) for n in received):
+                done.set()
+        return consume
+
+    streamer = DataStreamer(generator(), max_queue_size=len(samples) + 1, loop=loop)
+    for i in range(n_consumers):
+        streamer.add_consumer(make_consumer(i))
+    started_at = time.time()
+    started.set()
+    done.wait(60)
+    elapsed = time.time() - started_at
+    streamer.wait_for_end()
+    if loop is not None:
+        loop.stop()
+        loop.join()
+    latency = max(latencies, key=lambda h: h.percentile(0.99))
+    return result(min(received), elapsed, latency.snapshot(),
+                  consumers=n_consumers)
+
+
+class _CountingClient(object):
+    # stands in for `CTSocketClient` in tracker benchmarks
+
+    def __init__(self):
+        self.events = 0
+
+    def send_event(self, event_type, data):
+        self.events += 1
+
+
+def bench_react(filter_class, samples, calibrate_n=300, n_rules=3, batch=None,
+                as_array=True, with_vibration=False):
+    """Epoch conditions of `Mpu6050EventTracker` on filtered samples, one
+    by one or in batches of `batch` samples, as arrays or lists, with
+    `n_rules` copies of the default rules.
+
+    Rules using vibration features are left out unless `with_vibration` is
+    set, since only array batches compute the features: all paths then
+    evaluate the same rules."""
+    items = [item + (0,) for item in motiontracker_data_generator(
+        iter(samples), filter_class(0.5, 0.011), calibrate_n=calibrate_n)]
+    configs = epoch_rules.DEFAULT_RULES
+    if not with_vibration:
+        features = set(vibration.FEATURES)
+        configs = [config for config in configs
+                   if not epoch_rules.EpochRule.from_config(config).names & features]
+    rules = epoch_rules.load_rules(configs[i % len(configs)] for i in range(n_rules))
+    directory = tempfile.mkdtemp()
+    try:
+        # one sample is too few to calibrate, the tracker's own
+        # pipeline ends right away
+        tracker = _tracker(_write_capture(samples[:1], directory), 'axis-angle',
+                           rules=rules)
+        tracker.streamer.wait_for_end()
+    finally:
+        shutil.rmtree(directory)
+    if batch is None:
+        started_at = time.time()
+        for item in items:
+            tracker._react_for_epoch_condition(*item)
+    elif not as_array:
+        started_at = time.time()
+        for i in range(0, len(items), batch):
+            tracker._react_for_epoch_batch(items[i:i + batch])
+    else:
+        import numpy as np
+        rows = np.array(items)
+        started_at = time.time()
+        for i in range(0, len(rows), batch):
+            tracker._react_for_epoch_array(rows[i:i + batch])
+    return result(len(items), time.time() - started_at,
+                  events=tracker.client.events)
+
+
+def bench_tracker(samples, filter_name, runtime):
+    """Whole `Mpu6050EventTracker` replaying a capture of `samples` as
+    fast as possible: filter, streamer and epoch conditions."""
+    loop = None
+    if runtime == 'eventloop':
+        loop = EventLoop()
+        loop.start(name='bench-tracker')
+    directory = tempfile.mkdtemp()
+    try:
+        paths = _write_capture(samples, directory)
+        started_at = time.time()
+        tracker = _tracker(paths, filter_name, loop)
+        tracker.streamer.wait_for_end()
+        if loop is not None:
+            # consumers on the loop are done once it gets to this
+            finished = threading.Event()
+            loop.call_soon_threadsafe(finished.set)
+            finished.wait(60)
+        elapsed = time.time() - started_at
+    finally:
+        shutil.rmtree(directory)
+        if loop is not None:
+            loop.stop()
+            loop.join()
+    return result(len(samples), elapsed, events=tracker.client.events)
+
+
+def _write_capture(samples, directory):
+    writer = capture.CaptureWriter(
+        os.path.join(directory, 'samples.ctcap'), capture.RAW_CHANNELS, 0.011,
+        metadata={'accel_offsets': [0.42, -1.11, 0.255]},
+        chunk_samples=4096, ring_size=len(samples) + 1,
+    )
+    for item in samples:
+        writer.append(item)
+    writer.close()
+    return writer.files
+
+
+def _tracker(paths, filter_name, loop=None, rules=None):
+    return Mpu6050EventTracker(
+        _CountingClient(), (0.42, -1.11, 0.255), filter_name=filter_name,
+        loop=loop, replay_paths=paths, replay_speed=0, rules=rules,
+    )
+
+
+def bench_transport(n_events, codec):
+    """`CTSocketClient.send_event` to a local agent stand-in that reads and
+    discards frames. Sending backs off while the client is congested;
+    latency is from queueing a frame until it's written."""
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'agent.sock')
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(path)
+    server.listen(1)
+    # hello, and the codec confirmation if it's switched
+    expected = n_events + (1 if codec == 'json' else 2)
+    done = threading.Event()
+
+    def agent():
+        sock, _ = server.accept()
+        reader = wire.FrameReader()
+        n_frames = 0
+        try:
+            while reader.recv_from(sock):
+                frames = reader.frames()
+                if n_frames == 0 and frames and codec != 'json':
+                    data = wire.CODECS['json'].encode({'codec': codec})
+                    sock.sendall(wire.HEADER.pack(len(data)) + data)
+                n_frames += len(frames)
+                if n_frames >= expected:
+                    done.set()
+        except socket.error:
+            pass  # client went away
+        finally:
+            sock.close()
+
+    agent_thread = threading.Thread(target=agent)
+    agent_thread.setDaemon(True)
+    agent_thread.start()
+    registry = Registry()
+    client = CTSocketClient('benchmark', ['benchmark'], None, None,
+                            socket_path=path, codec=codec, metrics=registry)
+    client.start()
+    try:
+        deadline = time.time() + 5
+        while not registry.snapshot()['transport.connected'] and time.time() < deadline:
+            time.sleep(0.01)
+        if codec != 'json':
+            time.sleep(0.1)  # let the codec switch happen first
+        data = {'x': 12.345678, 'y': -0.123456, 'z': 31.41592}
+        started_at = time.time()
+        for _ in range(n_events):
+            while client.is_congested():
+                time.sleep(0.0005)
+            client.send_event('ORIENTATION', data)
+        done.wait(60)
+        elapsed = time.time() - started_at
+    finally:
+        client.stop()
+        server.close()
+        shutil.rmtree(directory)
+    snapshot = registry.snapshot()
+    return result(n_events, elapsed, snapshot['transport.send_latency'],
+                  bytes_sent=snapshot['transport.bytes_sent'],
+                  writes=snapshot['transport.writes'],
+                  dropped=snapshot['transport.events_dropped'])
+
+
+def run(opts):
+    if opts.capture:
+        samples = recorded_samples(opts.capture, opts.n)
+    else:
+        samples = synthetic_samples(opts.n)
+    stages = {}
+
+    def report(name, stats):
+        stages[name] = stats
+        latency = stats.get('p99_latency_us')
+        print('{:34s} {:10.0f} samples/sec {:9.2f} us/sample {:>12s} {:8d} KB'.format(
+            name, stats['samples_per_sec'], stats['us_per_sample'],
+            '{:.0f} us p99'.format(latency) if latency is not None else '',
+            stats['maxrss_kb']))
+        sys.stdout.flush()
+
+    for name in sorted(FILTERS):
+        report('filter.{}'.format(name), bench_filter(FILTERS[name], samples))
+        report('generator.{}'.format(name), bench_generator(FILTERS[name], samples))
+        try:
+            stats = bench_batch_generator(FILTERS[name], samples)
+        except ImportError:
+            pass  # no NumPy
+        else:
+            report('batch_generator.{}'.format(name), stats)
+    for runtime in ('threads', 'eventloop'):
+        for n_consumers in sorted(set([1, opts.consumers // 2 or 1, opts.consumers])):
+            report('streamer.{}.{}'.format(runtime, n_consumers),
+                   bench_streamer(samples, n_consumers, runtime))
+            if opts.rate:
+                report('streamer.{}.{}.paced'.format(runtime, n_consumers),
+                       bench_streamer(samples[:opts.rate], n_consumers,
+                                      runtime, opts.rate))
+    # the tracker's consumers: lists of 16 without NumPy, arrays of 64 with it
+    report('tracker.react', bench_react(FILTERS['axis-angle'], samples))
+    report('tracker.react_batch.list', bench_react(
+        FILTERS['axis-angle'], samples, batch=16, as_array=False))
+    for name, options in [('', {}), ('.{}'.format(opts.rules), {'n_rules': opts.rules}),
+                          ('.vibration', {'n_rules': 4, 'with_vibration': True})]:
+        try:
+            stats = bench_react(FILTERS['axis-angle'], samples, batch=64, **options)
+        except ImportError:
+            break  # no NumPy
+        report('tracker.react_batch' + name, stats)
+    for runtime in ('threads', 'eventloop'):
+        report('tracker.{}'.format(runtime),
+               bench_tracker(samples, opts.filter, runtime))
+    for codec in sorted(wire.CODECS):
+        report('transport.{}'.format(codec), bench_transport(opts.events, codec))
+
+    return {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'source': opts.capture or 'synthetic',
+        'samples': len(samples),
+        'stages': stages,
+    }
+
+
+def compare(results, old_results):
+    print('\nsamples/sec, p99 latency and peak RSS against the run of {} on {}:'.format(
+        time.strftime('%Y-%m-%d %H:%M', time.localtime(old_results['time'])),
+        old_results['source']))
+    for name, stats in sorted(results['stages'].items()):
+        old = old_results['stages'].get(name)
+        if not old:
+            continue
+        print('{:34s} {:>8s} {:>12s} {:>12s}'.format(
+            name,
+            _change(stats, old, 'samples_per_sec'),
+            _change(stats, old, 'p99_latency_us', ' p99'),
+            _change(stats, old, 'maxrss_kb', ' RSS')))
+
+
+def _change(stats, old, key, label=''):
+    # relative change of `key`, empty when either run lacks it
+    if not stats.get(key) or not old.get(key):
+        return ''
+    return '{:+.1f}%{}'.format((float(stats[key]) / old[key] - 1) * 100, label)
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000,
+                        help="number of samples per run")
+    parser.add_argument('--capture', action='append',
+                        help="take samples from capture files instead of "
+                             "synthetic ones, can be given several times")
+    parser.add_argument('--filter', default='axis-angle',
+                        choices=sorted(FILTERS),
+                        help="orientation filter of the tracker stages")
+    parser.add_argument('--consumers', type=int, default=4,
+                        help="most streamer consumers to run with")
+    parser.add_argument('--rate', type=int, default=2000,
+                        help="samples/sec of the paced streamer runs, which "
+                             "measure latency without a backlog; 0 to skip")
+    parser.add_argument('--events', type=int, default=20000,
+                        help="number of events per transport run")
+    parser.add_argument('--rules', type=int, default=36,
+                        help="epoch rules of the batched epoch benchmark")
+    parser.add_argument('--json', help="write results to this file")
+    parser.add_argument('--compare', help="results of an earlier run")
+    opts = parser.parse_args()
+
+    results = run(opts)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+import time
+
+
+def _load_monotonic():
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    # python 2 has no monotonic clock, use clock_gettime directly
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or
+                           ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clock_monotonic = 1  # CLOCK_MONOTONIC on Linux
+        if clock_gettime(clock_monotonic, ctypes.byref(timespec())) != 0:
+            raise OSError(ctypes.get_errno())
+    except (ImportError, AttributeError, OSError, TypeError):
+        return time.time
+
+    def monotonic():
+        # timespec is not shared, ctypes releases the GIL during the call
+        ts = timespec()
+        clock_gettime(clock_monotonic, ctypes.byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+
+monotonic = _load_monotonic()
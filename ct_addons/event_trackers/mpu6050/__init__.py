@@ -1,155 +1,493 @@
 from __future__ import absolute_import
+import collections
 import threading
 import time
 import socket
-import struct
+import errno
 import logging
-import math
-from ct_addons.event_trackers.mpu6050 import data_source, motion_tracker
+from ct_addons.eventloop import EventLoop
+from ct_addons import policy
+from ct_addons.event_trackers.mpu6050 import (
+    capture, data_source, debug_protocol, epoch_rules, motion_tracker,
+    quaternion_tracker, sampler_process, scheduler, simulator, vibration,
+)
+from ct_addons.event_trackers.mpu6050.sensor import fifo_interval
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 log = logging.getLogger(__name__)
 
 
+# orientation filter backends selectable by name
+FILTERS = {
+    'axis-angle': motion_tracker.MotionTracker,
+    'quaternion': quaternion_tracker.QuaternionMotionTracker,
+}
+
+
+# samples every sensor is calibrated on when sampling starts
+CALIBRATE_N = 300
+
+
+# one sensor of the tracker, `name` identifies it in events
+SensorConfig = collections.namedtuple('SensorConfig', 'name bus address accel_offsets')
+
+
+# by event type, see `policy.EventPolicy`: events pass as they come unless
+# the config or the caller limits them
+DEFAULT_EVENT_POLICIES = {
+    '*': {},
+}
+
+
 class Mpu6050EventTracker(object):
+    """Samples `sensors` (`SensorConfig`s), by default one MPU6050 at 0x68
+    on bus 1 calibrated with `accel_offsets`, and sends epochs of each.
+
+    Sensors on the same bus are read one after another by a thread of
+    that bus, which also runs their filters; every sensor has its own
+    calibration, filter and epoch state. Samples of all of them go through
+    one streamer, with the number of the sensor as the last field.
+
+    With `sampling_process` 'sampling' every bus is read by a process of
+    its own instead of a thread, with 'filtering' that process runs the
+    filters too; see `sampler_process`.
+
+    Epochs are conditions of `rules`, `epoch_rules.DEFAULT_RULES` by
+    default, evaluated over batches of samples if NumPy is available.
+    Vibration features of rules are taken over `vibration_window` seconds,
+    their bands split at the two `vibration_bands` frequencies; they need
+    NumPy, without it the default VIBRATION rule is left out.
+
+    Epochs reach `client` through `event_policies`, a dict of
+    `policy.EventPolicy` by event type, `DEFAULT_EVENT_POLICIES` by
+    default, which doesn't limit them; the 'event_policies' param of the
+    agent's config replaces them with policies given as dicts, and they
+    stay when the config is disabled, like its 'max_angle_deviation'.
+    Policies measure time by samples, as sample number times `dt`.
+    """
 
     EVENT_TYPE = 'corlina.mpu6050'
 
-    def __init__(self, client, accel_offsets, run_server_at_port=None):
+    def __init__(self, client, accel_offsets=None, run_server_at_port=None,
+                 filter_name='axis-angle', fifo=False, catch_up='skip',
+                 loop=None, capture_path=None, capture_rotate_bytes=None,
+                 capture_rotate_seconds=None, replay_paths=None, replay_speed=1.0,
+                 replay_start_seq=None, replay_start_time=None, dt=0.011,
+                 sensors=None, simulate=False, simulation_seed=None,
+                 sampling_process=None, rules=None, vibration_window=1.0,
+                 vibration_bands=(5.0, 20.0), event_policies=None):
         self.client = client
-        self._stopped = threading.Event()
-        generator = data_source.mpu6050_data_generator(0.011, self._stopped)
-        generator = data_source.dump_to_file(generator, 'data.txt', 1000)
-        generator = data_source.motiontracker_data_generator(
-            generator,
-            motion_tracker.MotionTracker(0.5, 0.011, accel_offsets=accel_offsets),
-            calibrate_n=300,
+        if fifo and not simulate and not replay_paths:
+            # the sensor's FIFO samples at whole milliseconds
+            dt = fifo_interval(dt)
+        if event_policies is None:
+            event_policies = policy.load_policies(DEFAULT_EVENT_POLICIES)
+        self.events = policy.EventPolicies(
+            client, event_policies, metrics=getattr(client, 'metrics', None),
         )
-        self.streamer = data_source.DataStreamer(generator)
-        self.streamer.add_consumer(self._react_for_epoch_condition)
+        self.dt = dt
+        self._loop = loop
+        self._stopped = threading.Event()
         self._run_server_at_port = run_server_at_port
 
+        replay = None
+        if replay_paths:
+            # recorded samples instead of the sensors, paced by recorded time
+            replay = capture.CaptureReplay(
+                replay_paths, replay_speed, start_seq=replay_start_seq,
+                start_time=replay_start_time, stopped=self._stopped,
+            )
+            sensors = [SensorConfig(
+                replay.metadata.get('sensor', 'replay'), None, None,
+                accel_offsets or tuple(replay.metadata['accel_offsets']),
+            )]
+        elif sensors is None:
+            sensors = [SensorConfig('1-0x68', 1, 0x68, accel_offsets)]
+        self.sensors = sensors
+        if capture_path is not None and len(sensors) > 1 and '{sensor}' not in capture_path:
+            raise ValueError("Capture path needs '{sensor}' with several sensors")
+        if sampling_process not in (None, 'sampling', 'filtering'):
+            raise ValueError("Unknown sampling process: {}".format(sampling_process))
+        if capture_path is not None and sampling_process == 'filtering':
+            raise ValueError("Can't capture raw samples filtered in a sampling process")
+
         self._lock = threading.Lock()
         self._config_state = False
-        self._max_angle_deviation = 30.0
-        self._max_lateral_movement = 0.2
-        self._min_temp = 15
-        self._max_temp = 45
-        self._temp_blind_zone = 1
-        self._temp_min_histeresis_state = 0
-        self._temp_max_histeresis_state = 0
-        assert 2 * self._temp_blind_zone < self._max_temp - self._min_temp
-        self._is_in_epoch_condition = {
-            'ORIENTATION': False,
-            'MOVEMENT': False,
-            'TEMPERATURE': False,
-        }
-
-    def _react_for_epoch_condition(self,
-                                   accx, accy, accz,
-                                   gyrox, gyroy, gyroz,
-                                   temp,
-                                   anglex, angley, anglez,
-                                   latx, laty, latz):
+        if rules is None:
+            rules = epoch_rules.load_rules(epoch_rules.DEFAULT_RULES)
+            if numpy is None:
+                log.warning('no NumPy, VIBRATION epochs are disabled')
+                rules = [rule for rule in rules
+                         if not rule.names & set(vibration.FEATURES)]
+        self.rules = epoch_rules.EpochRules(rules, dt)
+        self._epoch_states = [self.rules.new_state() for _ in sensors]
+        self._vibration = None
+        if any(rule.names & set(vibration.FEATURES) for rule in rules):
+            if numpy is None:
+                raise ValueError("Vibration features need NumPy")
+            self._vibration = [
+                vibration.VibrationFeatures(dt, vibration_window, vibration_bands)
+                for _ in sensors
+            ]
+
+        filters = [FILTERS[filter_name](0.5, dt, accel_offsets=sensor.accel_offsets)
+                   for sensor in sensors]
+
+        # (sensor numbers, (sensor number, item) generator, timing, whether
+        # items are filtered already) per bus
+        sources = []
+        self.sampler_processes = []
+        if replay is not None:
+            sources.append(([0], ((0, item) for item in replay), replay, False))
+        else:
+            buses = collections.OrderedDict()
+            for i, sensor in enumerate(sensors):
+                buses.setdefault(sensor.bus, []).append(i)
+            for bus, indices in buses.items():
+                # in FIFO mode samples are paced by the sensor clock
+                if fifo:
+                    bus_scheduler = data_source.FifoTiming(dt)
+                else:
+                    bus_scheduler = scheduler.DeadlineScheduler(dt, catch_up)
+                openers = [self._sensor_opener(i, simulate, simulation_seed)
+                           for i in indices]
+                if sampling_process is None:
+                    generator = data_source.mpu6050_bus_generator(
+                        dt, self._stopped, openers, fifo=fifo, scheduler=bus_scheduler,
+                    )
+                    sources.append((indices, generator, bus_scheduler, False))
+                    continue
+                trackers = None
+                if sampling_process == 'filtering':
+                    trackers = [filters[i] for i in indices]
+                # forked before any thread of the tracker is started
+                process = sampler_process.SamplerProcess(
+                    self._bus_source(dt, openers, fifo, bus_scheduler, indices, trackers),
+                    debug_protocol.LEGACY_CHANNELS if trackers else len(capture.RAW_CHANNELS), dt,
+                    self._stopped, timing=bus_scheduler,
+                    name='mpu6050-bus-{}'.format(bus),
+                )
+                process.start()
+                self.sampler_processes.append(process)
+                sources.append((indices, process.samples(), process, trackers is not None))
+
+        # raw samples, calibration ones included, are recorded for replay
+        self.capture_writers = []
+        if capture_path is not None:
+            for sensor in sensors:
+                self.capture_writers.append(capture.CaptureWriter(
+                    capture_path.replace('{sensor}', sensor.name),
+                    capture.RAW_CHANNELS, dt,
+                    metadata={
+                        'sensor': sensor.name,
+                        'accel_offsets': list(sensor.accel_offsets),
+                        'filter': filter_name,
+                        'calibrate_n': CALIBRATE_N,
+                        'fifo': fifo,
+                    },
+                    rotate_bytes=capture_rotate_bytes,
+                    rotate_seconds=capture_rotate_seconds,
+                ))
+
+        self.streamer = None
+        for indices, generator, timing, filtered in sources:
+            if filtered:
+                generator = (item + (i,) for i, item in generator)
+            else:
+                if self.capture_writers:
+                    generator = capture.capture_sensors(
+                        generator, [self.capture_writers[i] for i in indices])
+                generator = data_source.multi_motiontracker_data_generator(
+                    generator, [filters[i] for i in indices], indices,
+                    calibrate_n=CALIBRATE_N, timing=timing,
+                )
+            if self.streamer is None:
+                self.streamer = data_source.DataStreamer(generator, loop=loop)
+            else:
+                self.streamer.add_source(generator)
+        if numpy is not None:
+            self.streamer.add_consumer(self._react_for_epoch_array, batch_size=64,
+                                       max_latency=0.02, as_array=True)
+        else:
+            self.streamer.add_consumer(self._react_for_epoch_batch,
+                                       batch_size=16, max_latency=0.02)
+
+    def _sensor_opener(self, i, simulate, simulation_seed):
+        # called from the sampling thread or process of the bus
+        sensor = self.sensors[i]
+
+        def open_sensor():
+            if simulate:
+                seed = None if simulation_seed is None else simulation_seed + i
+                return simulator.SimulatedMpu6050(sensor.accel_offsets, seed=seed)
+            from ct_addons.event_trackers.mpu6050.sensor import Mpu6050Reader
+            return Mpu6050Reader(sensor.address, sensor.bus)
+        return open_sensor
+
+    @staticmethod
+    def _bus_source(dt, openers, fifo, bus_scheduler, indices, trackers):
+        # (sensor number, item) generator run by the sampling process, with
+        # `trackers` items are filtered and numbered like the tracker's
+        def make_source(stopped):
+            generator = data_source.mpu6050_bus_generator(
+                dt, stopped, openers, fifo=fifo, scheduler=bus_scheduler,
+            )
+            if trackers is None:
+                return generator
+            items = data_source.multi_motiontracker_data_generator(
+                generator, trackers, indices, calibrate_n=CALIBRATE_N, timing=bus_scheduler,
+            )
+            return ((item[-1], item[:-1]) for item in items)
+        return make_source
+
+    def _react_for_epoch_batch(self, items):
+        # the lock is taken once per batch, events are sent after it
+        changes = []
         with self._lock:
             if self._config_state:
                 return
-        self._react_for_movement_epoch_condition(latx, laty, latz)
-        self._react_for_orientation_epoch_condition(anglex, angley, anglez)
-        self._react_for_temperature_epoch_condition(temp)
-
-    def _react_for_orientation_epoch_condition(self, anglex, angley, anglez):
-        maxdev = max(abs(anglex), abs(angley), abs(anglez))
-        now_in_condition = maxdev > self._max_angle_deviation
-        need_epoch = now_in_condition != self._is_in_epoch_condition['ORIENTATION']
-        if need_epoch:
-            log.info('met ORIENTATION Epoch condition: %s',
-                     'IN' if now_in_condition else 'OUT')
-            if now_in_condition:
-                data = {'x': anglex, 'y': angley, 'z': anglez}
-                self.client.send_event('ORIENTATION', data)
-        self._is_in_epoch_condition['ORIENTATION'] = now_in_condition
-
-    def _react_for_movement_epoch_condition(self, latx, laty, latz):
-        movement = math.sqrt(latx**2 + laty**2 + latz**2)
-        now_in_condition = movement > self._max_lateral_movement
-        need_epoch = now_in_condition != self._is_in_epoch_condition['MOVEMENT']
-        if need_epoch:
-            log.info('met MOVEMENT Epoch condition: %s',
-                     'IN' if now_in_condition else 'OUT')
-            if now_in_condition:
-                data = {'x': latx, 'y': laty, 'z': latz}
-                self.client.send_event('MOVEMENT', data)
-        self._is_in_epoch_condition['MOVEMENT'] = now_in_condition
-
-    def _react_for_temperature_epoch_condition(self, temp):
-        min_in_condition = temp < self._min_temp + self._temp_min_histeresis_state
-        max_in_condition = temp > self._max_temp + self._temp_max_histeresis_state
-        now_in_condition = min_in_condition or max_in_condition
-        condition_changed = now_in_condition != self._is_in_epoch_condition['TEMPERATURE']
-        if condition_changed:
-            log.info('met TEMPERATURE Epoch condition: %s',
-                     'IN' if now_in_condition else 'OUT')
-            if now_in_condition:
-                data = {'temp': temp}
-                self.client.send_event('TEMPERATURE', data)
-            if max_in_condition:
-                self._temp_min_histeresis_state = -self._temp_blind_zone
-                self._temp_max_histeresis_state = -self._temp_blind_zone
-            elif min_in_condition:
-                self._temp_min_histeresis_state = +self._temp_blind_zone
-                self._temp_max_histeresis_state = +self._temp_blind_zone
+            for item in items:
+                sensor = int(item[-1])
+                changes.extend((sensor,) + change for change in
+                               self.rules.evaluate(self._epoch_states[sensor], item))
+        for change in changes:
+            self._on_epoch_change(*change)
+        self.events.flush(self._sample_time())
+
+    def _react_for_epoch_array(self, rows):
+        # as `_react_for_epoch_batch`, rules are evaluated under the lock
+        changes = []
+        with self._lock:
+            if self._config_state:
+                return
+            sensors = rows[:, -1]
+            if (sensors == sensors[0]).all():
+                changes = self._epoch_changes_of_rows(int(sensors[0]), rows)
             else:
-                self._temp_min_histeresis_state = -self._temp_blind_zone
-                self._temp_max_histeresis_state = +self._temp_blind_zone
-        self._is_in_epoch_condition['TEMPERATURE'] = now_in_condition
+                for sensor in numpy.unique(sensors):
+                    changes.extend(self._epoch_changes_of_rows(
+                        int(sensor), rows[sensors == sensor]))
+        for change in changes:
+            self._on_epoch_change(*change)
+        self.events.flush(self._sample_time())
+
+    def _epoch_changes_of_rows(self, sensor, rows):
+        # requires `_lock`
+        state = self._epoch_states[sensor]
+        if self._vibration is not None:
+            rows = numpy.hstack((rows, self._vibration[sensor].update(rows[:, :3])))
+        return [(sensor,) + change for change in self.rules.evaluate_batch(state, rows)]
+
+    def _react_for_epoch_condition(self, *item):
+        sensor = int(item[-1])
+        with self._lock:
+            if self._config_state:
+                return
+            changes = self.rules.evaluate(self._epoch_states[sensor], item)
+        for i, now, n, item in changes:
+            self._on_epoch_change(sensor, i, now, n, item)
+
+    def _sample_time(self):
+        # time of the latest sample of any sensor
+        return max(state.samples for state in self._epoch_states) * self.dt
+
+    def _on_epoch_change(self, sensor, i, now, n, item):
+        event = self.rules.rules[i].event
+        name = self.sensors[sensor].name
+        log.info('met %s Epoch condition of %s: %s', event, name, 'IN' if now else 'OUT')
+        # the end has the sensor only, so that it matches its start
+        data = self.rules.event_data(i, item) if now else {}
+        data['sensor'] = name
+        self.events.epoch(event, now, data, n * self.dt)
 
     def run(self):
+        # debug clients are served from an event loop in both runtimes
+        server_loop = self._loop
+        if self._run_server_at_port is not None:
+            if server_loop is None:
+                server_loop = EventLoop()
+                server_loop.start(name='mpu6050-debug-server')
+            server_loop.call_soon_threadsafe(
+                LoopServer, server_loop, self._run_server_at_port, self.streamer,
+            )
         try:
-            if self._run_server_at_port is None:
-                while True:
-                    time.sleep(1)
-            else:
-                run_server(self._run_server_at_port, self.streamer)
+            while True:
+                time.sleep(1)
         finally:
             log.info('interrupted, exiting gracefully...')
             self._stopped.set()
             self.streamer.request_stop()
             self.streamer.wait_for_end()
+            for process in self.sampler_processes:
+                process.close()
+            for writer in self.capture_writers:
+                writer.close()
+            if server_loop is not None and server_loop is not self._loop:
+                server_loop.stop()
+                server_loop.join()
 
     def on_config_enabled(self, etype, params):
         with self._lock:
             self._config_state = True
-            self._max_angle_deviation = params.get('max_angle_deviation', self._max_angle_deviation)
+            if 'max_angle_deviation' in params:
+                self.rules.set_threshold('ORIENTATION', above=params['max_angle_deviation'])
+        self._configure_events(params)
 
     def on_config_disabled(self, etype, params):
         with self._lock:
             self._config_state = False
 
+    def _configure_events(self, params):
+        # the config's policies replace the current ones for good
+        if 'event_policies' not in params:
+            return
+        try:
+            policies = policy.load_policies(params['event_policies'])
+        except (ValueError, AttributeError) as err:
+            log.warning('ignoring event policies of the config: %s', err)
+            return
+        self.events.configure(policies)
+
+
+class LoopServer(object):
+    """Debug TCP server streaming raw and filtered samples to clients.
+
+    Accepts and serves any number of clients from `loop`; samples reach
+    them through the streamer without involving the sampling thread.
+    """
+
+    def __init__(self, loop, port, streamer):
+        self.loop = loop
+        self.streamer = streamer
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('0.0.0.0', port))
+        self.sock.listen(64)
+        self.sock.setblocking(0)
+        loop.add_reader(self.sock.fileno(), self._on_accept)
 
-def run_server(port, streamer):
-    serversock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    serversock.bind(('0.0.0.0', port))
-    serversock.listen(3)
-    while True:
-        sock, addr = serversock.accept()
-        cons = ClientConsumer(sock, streamer)
+    def _on_accept(self):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        sock.setblocking(0)
+        cons = ClientConsumer(sock, self.streamer, self.loop)
         log.info('connected client: %s -> %r', addr, cons)
-        cid = streamer.add_consumer(cons)
+        cid = self.streamer.add_consumer(cons.send_batch, loop=self.loop,
+                                         **ClientConsumer.BATCHING)
         cons.consumer_id = cid
 
 
 class ClientConsumer(object):
-    def __init__(self, sock, streamer):
+    """Non-blocking writer of samples to one debug client, runs on `loop`.
+
+    The client gets the legacy stream until it subscribes to the framed
+    one, see `debug_protocol`. Whatever the socket doesn't take is kept
+    and written when it becomes writable; a client more than
+    `MAX_BACKLOG` bytes behind is dropped.
+    """
+
+    # samples are sent in batches, one write per batch
+    BATCHING = {'batch_size': 32, 'max_latency': 0.02, 'indexed': True}
+
+    MAX_BACKLOG = 256 * 1024
+
+    def __init__(self, sock, streamer, loop):
         self.sock = sock
         self.streamer = streamer
         self.consumer_id = None
+        self.loop = loop
+        # `debug_protocol.FrameEncoder` once subscribed
+        self.subscription = None
+        self._fd = sock.fileno()
+        self._pending = bytearray()
+        self._request = b''
+        self._closed = False
+        loop.add_reader(self._fd, self._on_readable)
 
-    def __call__(self, *data):
-        packet = struct.pack('f' * len(data), *data)
+    def send_batch(self, samples):
+        if self._closed:
+            return
+        if self.subscription is None:
+            packet = debug_protocol.encode_legacy(samples)
+        else:
+            packet = self.subscription.encode(samples)
+            if not packet:
+                return
+        if self._pending:
+            if len(self._pending) + len(packet) > self.MAX_BACKLOG:
+                log.warning('%r: client is too slow, dropping it', self)
+                self._disconnect()
+                return
+            self._pending += packet
+            return
         try:
-            self.sock.send(packet)
-        except socket.error:
-            if self.consumer_id is not None:
-                self.streamer.remove_consumer(self.consumer_id)
-                self.consumer_id = None
+            sent = self.sock.send(packet)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                self._disconnect()
+                return
+        if sent < len(packet):
+            self._pending += packet[sent:]
+            self.loop.add_writer(self._fd, self._flush)
+
+    def _on_readable(self):
+        try:
+            data = self.sock.recv(256)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._disconnect()
+            return
+        if not data:
+            log.info('%r: client closed connection', self)
+            self._disconnect()
+            return
+        self._request += data
+        size = debug_protocol.SUBSCRIBE.size
+        while len(self._request) >= size:
+            request, self._request = self._request[:size], self._request[size:]
+            try:
+                mask, decimation = debug_protocol.decode_subscribe(request)
+            except ValueError as err:
+                log.warning('%r: %s', self, err)
+                self._disconnect()
+                return
+            self.subscription = debug_protocol.FrameEncoder(mask, decimation)
+            log.info('%r: subscribed to %s, every %d sample(s)', self,
+                     ','.join(debug_protocol.CHANNELS[i]
+                              for i in debug_protocol.mask_channels(mask)),
+                     decimation)
+
+    def _flush(self):
+        try:
+            sent = self.sock.send(self._pending)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._disconnect()
+            return
+        del self._pending[:sent]
+        if not self._pending:
+            self.loop.remove_writer(self._fd)
+
+    def _disconnect(self):
+        if not self._closed:
+            self._closed = True
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+            self.sock.close()
+            self._pending = bytearray()
+        if self.consumer_id is not None:
+            self.streamer.remove_consumer(self.consumer_id)
+            self.consumer_id = None
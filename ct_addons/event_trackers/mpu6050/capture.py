@@ -0,0 +1,462 @@
+"""Chunked binary recordings of sensor samples.
+
+A capture file starts with `FILE_HEADER` and JSON metadata (channel names,
+sampling interval, calibration, ...), followed by chunks: `CHUNK_HEADER`,
+the timestamp of every sample as a little endian float32 offset from the
+first one, and the samples of the chunk as little endian float32 rows, one
+value per channel. Sequence numbers within a chunk are consecutive. A
+file that was closed properly ends with an index of all chunks, (first
+sequence number, first timestamp, file offset) each, and `TRAILER`
+pointing at it; files without it can still be read chunk by chunk.
+
+Version 1 files have no timestamps of every sample, theirs are spread
+evenly between the first and the last one of the chunk.
+
+`CaptureWriter` records files, `CaptureReader` maps one into memory and
+`CaptureReplay` plays a recording back as a sample source.
+"""
+import bisect
+import errno
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from ct_addons.clock import monotonic
+from ct_addons.event_trackers.mpu6050.data_source import SampleRing
+
+
+log = logging.getLogger(__name__)
+
+
+VERSION = 2
+VERSIONS = (1, 2)
+
+RAW_CHANNELS = ('accx', 'accy', 'accz', 'gyrox', 'gyroy', 'gyroz', 'temp')
+
+# magic, version, metadata size
+FILE_HEADER = struct.Struct('>4sHI')
+FILE_MAGIC = b'CTCP'
+
+# magic, number of samples, first sequence number, first and last timestamp
+CHUNK_HEADER = struct.Struct('>4sIQdd')
+CHUNK_MAGIC = b'CHNK'
+
+# magic, number of entries; entries follow
+INDEX_HEADER = struct.Struct('>4sI')
+INDEX_MAGIC = b'CTIX'
+INDEX_ENTRY = struct.Struct('>QdQ')
+
+# index offset, magic
+TRAILER = struct.Struct('>Q4s')
+TRAILER_MAGIC = b'CTIE'
+
+_bodies = {}
+
+
+def body_struct(n_values):
+    try:
+        return _bodies[n_values]
+    except KeyError:
+        return _bodies.setdefault(n_values, struct.Struct('<{}f'.format(n_values)))
+
+
+def times_size(version, n_samples):
+    # bytes of the timestamps of a chunk of `n_samples`
+    return 4 * n_samples if version >= 2 else 0
+
+
+class CaptureWriter(object):
+    """Records samples appended by the sampling thread from a thread of its own.
+
+    `append` only puts the sample into a `SampleRing`; the writer thread
+    drains it in chunks of up to `chunk_samples`, writing whatever it has
+    at least every `flush_interval` seconds. If it falls behind by more
+    than `ring_size` samples, the oldest ones are lost and counted.
+
+    Files are named by `path_template` formatted with `time` (local time
+    at file start) and `index` (number of the file since start), and a
+    new one is started when the current one grows over `rotate_bytes` or
+    gets older than `rotate_seconds`.
+    """
+
+    def __init__(self, path_template, channels, dt, metadata=None,
+                 chunk_samples=1024, flush_interval=1.0, rotate_bytes=None,
+                 rotate_seconds=None, ring_size=8192):
+        self.path_template = path_template
+        self.channels = tuple(channels)
+        self.dt = dt
+        self.metadata = dict(metadata or {})
+        self.chunk_samples = chunk_samples
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.files = []
+        self._ring = SampleRing(ring_size)
+        self._cursor = self._ring.cursor()
+        self._file = None
+        self._file_started_at = None
+        self._index = []
+        self._thread = threading.Thread(target=self._run, name='capture-writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def append(self, item):
+        self._ring.append(item)
+
+    def close(self):
+        self._ring.close()
+        self._thread.join()
+
+    @property
+    def lost(self):
+        return self._cursor.overruns
+
+    def _run(self):
+        samples = []
+        flushed_at = monotonic()
+        try:
+            while True:
+                more = self._ring.wait(self._cursor, self.flush_interval)
+                samples.extend(self._cursor.read(indexed=True))
+                while len(samples) >= self.chunk_samples:
+                    self._write(samples[:self.chunk_samples])
+                    del samples[:self.chunk_samples]
+                    flushed_at = monotonic()
+                if not more or monotonic() - flushed_at >= self.flush_interval:
+                    if samples:
+                        self._write(samples)
+                        samples = []
+                    if self._file is not None:
+                        self._file.flush()
+                    flushed_at = monotonic()
+                if not more:
+                    break
+        except Exception:
+            log.exception('capture writer failed')
+        finally:
+            self._close_file()
+            if self.lost:
+                log.warning('capture writer lost %d samples', self.lost)
+
+    def _write(self, samples):
+        # one chunk per run of consecutive sequence numbers
+        start = 0
+        for i in range(1, len(samples) + 1):
+            if i == len(samples) or samples[i][0] != samples[i - 1][0] + 1:
+                self._write_chunk(samples[start:i])
+                start = i
+
+    def _write_chunk(self, samples):
+        self._rotate_if_needed()
+        values = [x for _, _, item in samples for x in item]
+        offset = self._file.tell()
+        t_first = samples[0][1]
+        self._file.write(CHUNK_HEADER.pack(
+            CHUNK_MAGIC, len(samples), samples[0][0], t_first, samples[-1][1],
+        ))
+        # timestamps keep the recorded jitter, to about a microsecond
+        self._file.write(body_struct(len(samples)).pack(
+            *[timestamp - t_first for _, timestamp, _ in samples]))
+        self._file.write(body_struct(len(values)).pack(*values))
+        self._index.append((samples[0][0], samples[0][1], offset))
+
+    def _rotate_if_needed(self):
+        if self._file is not None:
+            too_big = self.rotate_bytes and self._file.tell() >= self.rotate_bytes
+            too_old = (self.rotate_seconds and
+                       time.time() - self._file_started_at >= self.rotate_seconds)
+            if not (too_big or too_old):
+                return
+            self._close_file()
+        self._open_file()
+
+    def _open_file(self):
+        self._file_started_at = time.time()
+        path = self.path_template.format(
+            time=time.strftime('%Y%m%d-%H%M%S', time.localtime(self._file_started_at)),
+            index=len(self.files),
+        )
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                # another sensor's writer may have just created it
+                if e.errno != errno.EEXIST:
+                    raise
+        metadata = dict(self.metadata, channels=self.channels, dt=self.dt,
+                        started_at=self._file_started_at)
+        metadata = json.dumps(metadata, sort_keys=True).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(FILE_HEADER.pack(FILE_MAGIC, VERSION, len(metadata)))
+        self._file.write(metadata)
+        self._index = []
+        self.files.append(path)
+        log.info('capturing samples to %s', path)
+
+    def _close_file(self):
+        if self._file is None:
+            return
+        index_offset = self._file.tell()
+        self._file.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self._index)))
+        for entry in self._index:
+            self._file.write(INDEX_ENTRY.pack(*entry))
+        self._file.write(TRAILER.pack(index_offset, TRAILER_MAGIC))
+        self._file.close()
+        self._file = None
+
+
+def capture(generator, writer):
+    """Passes items of `generator` through, recording them with `writer`."""
+    try:
+        for item in generator:
+            writer.append(item)
+            yield item
+    finally:
+        writer.close()
+
+
+def capture_sensors(generator, writers):
+    """`capture` for (sensor number, item) pairs, with a writer per sensor."""
+    try:
+        for i, item in generator:
+            writers[i].append(item)
+            yield i, item
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def is_capture(path):
+    with open(path, 'rb') as f:
+        return f.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+
+class CaptureReader(object):
+    """Memory-mapped capture file.
+
+    `chunks` holds (first sequence number, number of samples, first and
+    last timestamp, offset) of every chunk, from the index if the file has
+    one. Chunk bodies are read in place: `chunk_array` returns a read-only
+    NumPy view of the mapping, `chunk_rows` tuples.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = FILE_HEADER.unpack_from(self._mmap, 0)
+        if magic != FILE_MAGIC or version not in VERSIONS:
+            self._mmap.close()
+            raise ValueError("Not a capture file: {}".format(path))
+        self.version = version
+        start = FILE_HEADER.size
+        self.metadata = json.loads(self._mmap[start:start + size].decode('utf-8'))
+        self.channels = tuple(self.metadata['channels'])
+        self.dt = self.metadata['dt']
+        self._data_offset = start + size
+        offsets = self._read_index()
+        if offsets is None:
+            log.warning('%s has no index, it was not closed properly', path)
+            offsets = self._scan()
+        self.chunks = [self._chunk_at(offset) for offset in offsets]
+        self._seqs = [chunk[0] for chunk in self.chunks]
+        self._times = [chunk[2] for chunk in self.chunks]
+
+    def __len__(self):
+        return sum(chunk[1] for chunk in self.chunks)
+
+    @property
+    def start_time(self):
+        return self.chunks[0][2] if self.chunks else None
+
+    @property
+    def end_time(self):
+        return self.chunks[-1][3] if self.chunks else None
+
+    def close(self):
+        self._mmap.close()
+
+    def chunk_array(self, i):
+        import numpy as np
+        _, n_samples, _, _, offset = self.chunks[i]
+        return np.frombuffer(
+            self._mmap, dtype='<f4', count=n_samples * len(self.channels),
+            offset=self._rows_offset(offset, n_samples),
+        ).reshape(n_samples, len(self.channels))
+
+    def chunk_rows(self, i):
+        _, n_samples, _, _, offset = self.chunks[i]
+        n_channels = len(self.channels)
+        values = body_struct(n_samples * n_channels).unpack_from(
+            self._mmap, self._rows_offset(offset, n_samples))
+        return [values[j:j + n_channels]
+                for j in range(0, len(values), n_channels)]
+
+    def chunk_times(self, i):
+        _, n_samples, t_first, t_last, offset = self.chunks[i]
+        if self.version >= 2:
+            offsets = body_struct(n_samples).unpack_from(
+                self._mmap, offset + CHUNK_HEADER.size)
+            return [t_first + t for t in offsets]
+        # version 1 only has the first and the last timestamp
+        step = (t_last - t_first) / (n_samples - 1) if n_samples > 1 else 0.0
+        return [t_first + j * step for j in range(n_samples)]
+
+    def locate_seq(self, seq):
+        """(chunk, row) of sample `seq` or of the first one after it, None
+        if there is none."""
+        i = max(bisect.bisect_right(self._seqs, seq) - 1, 0)
+        first, n_samples = self.chunks[i][:2]
+        if seq < first:
+            return i, 0
+        if seq < first + n_samples:
+            return i, seq - first
+        return (i + 1, 0) if i + 1 < len(self.chunks) else None
+
+    def locate_time(self, timestamp):
+        """(chunk, row) of the first sample not before `timestamp`, None
+        if there is none."""
+        i = max(bisect.bisect_right(self._times, timestamp) - 1, 0)
+        for j, t in enumerate(self.chunk_times(i)):
+            if t >= timestamp:
+                return i, j
+        return (i + 1, 0) if i + 1 < len(self.chunks) else None
+
+    def _read_index(self):
+        size = len(self._mmap)
+        if size < self._data_offset + INDEX_HEADER.size + TRAILER.size:
+            return None
+        index_offset, magic = TRAILER.unpack_from(self._mmap, size - TRAILER.size)
+        if magic != TRAILER_MAGIC or index_offset >= size:
+            return None
+        magic, n_entries = INDEX_HEADER.unpack_from(self._mmap, index_offset)
+        if magic != INDEX_MAGIC:
+            return None
+        start = index_offset + INDEX_HEADER.size
+        return [INDEX_ENTRY.unpack_from(self._mmap, start + i * INDEX_ENTRY.size)[2]
+                for i in range(n_entries)]
+
+    def _scan(self):
+        # chunks up to the first incomplete or damaged one
+        offsets = []
+        offset = self._data_offset
+        row_size = 4 * len(self.channels)
+        while offset + CHUNK_HEADER.size <= len(self._mmap):
+            magic, n_samples = CHUNK_HEADER.unpack_from(self._mmap, offset)[:2]
+            end = self._rows_offset(offset, n_samples) + n_samples * row_size
+            if magic != CHUNK_MAGIC or end > len(self._mmap):
+                break
+            offsets.append(offset)
+            offset = end
+        return offsets
+
+    def _chunk_at(self, offset):
+        magic, n_samples, seq, t_first, t_last = CHUNK_HEADER.unpack_from(self._mmap, offset)
+        if magic != CHUNK_MAGIC:
+            raise ValueError("Bad chunk at {} in {}".format(offset, self.path))
+        return seq, n_samples, t_first, t_last, offset
+
+    def _rows_offset(self, offset, n_samples):
+        # samples of the chunk at `offset` start after its timestamps
+        return offset + CHUNK_HEADER.size + times_size(self.version, n_samples)
+
+
+class CaptureReplay(object):
+    """Replays capture files, in the given order, as a sample source.
+
+    Iterating yields samples as tuples, like `mpu6050_data_generator`;
+    `blocks` yields NumPy views of whole chunks for
+    `motiontracker_batch_generator`. Samples are paced by their recorded
+    timestamps divided by `speed`, 0 replays as fast as possible. Replay
+    starts at sample `start_seq` or `start_time` seconds into the
+    recording, and ends early once `stopped` is set.
+
+    Like `DeadlineScheduler`, `last_dt` is the recorded interval before
+    the latest sample, so the replay can be given to
+    `motiontracker_data_generator` as `timing`.
+    """
+
+    def __init__(self, paths, speed=1.0, start_seq=None, start_time=None,
+                 stopped=None):
+        self.readers = []
+        for path in paths:
+            reader = CaptureReader(path)
+            if reader.chunks:
+                self.readers.append(reader)
+            else:
+                reader.close()
+        if not self.readers:
+            raise ValueError("No samples in {}".format(', '.join(paths)))
+        self.speed = speed
+        self.start_seq = start_seq
+        self.start_time = start_time
+        self.stopped = stopped or threading.Event()
+        self.metadata = self.readers[0].metadata
+        self.last_dt = self.readers[0].dt
+        # (monotonic time, recorded timestamp) of the first sample
+        self._started_at = None
+
+    def __iter__(self):
+        previous = None
+        for reader, i, row in self._chunks():
+            times = reader.chunk_times(i)
+            for t, item in zip(times[row:], reader.chunk_rows(i)[row:]):
+                if self._wait(t):
+                    return
+                if previous is not None:
+                    self.last_dt = t - previous
+                previous = t
+                yield item
+
+    def blocks(self):
+        for reader, i, row in self._chunks():
+            if self._wait(reader.chunks[i][3]):
+                return
+            yield reader.chunk_array(i)[row:]
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+
+    def _chunks(self):
+        # (reader, chunk, first row) from the start position on
+        started = False
+        if self.start_time is not None:
+            start_time = self.readers[0].start_time + self.start_time
+        for reader in self.readers:
+            if started:
+                position = 0, 0
+            elif self.start_seq is not None:
+                position = reader.locate_seq(self.start_seq)
+            elif self.start_time is not None:
+                position = reader.locate_time(start_time)
+            else:
+                position = 0, 0
+            if position is None:
+                continue
+            started = True
+            first, row = position
+            for i in range(first, len(reader.chunks)):
+                yield reader, i, row
+                row = 0
+        if not started:
+            log.warning('replay start is past the end of the recording')
+
+    def _wait(self, timestamp):
+        # True if stopped meanwhile
+        if self.stopped.isSet():
+            return True
+        if not self.speed:
+            return False
+        now = monotonic()
+        if self._started_at is None:
+            self._started_at = now, timestamp
+        started_at, first_timestamp = self._started_at
+        delay = started_at + (timestamp - first_timestamp) / self.speed - now
+        if delay > 0:
+            return self.stopped.wait(delay)
+        return False
@@ -1,43 +1,109 @@
 import time
-import Queue
 import threading
 import logging
+from ct_addons.clock import monotonic
+from ct_addons.event_trackers.mpu6050.scheduler import DeadlineScheduler
 
 
 log = logging.getLogger(__name__)
 
 
-def mpu6050_data_generator(dt, stopped):
-    from mpu6050 import mpu6050
-    sensor = mpu6050(0x68)
+def mpu6050_data_generator(dt, stopped, fifo=False, burst_interval=0.05,
+                           scheduler=None, report_interval=60, sensor=None):
+    """Yields (accx, accy, accz, gyrox, gyroy, gyroz, temp) every `dt` sec.
 
+    Every sample is a single burst read of all data registers, paced by
+    `scheduler` (`DeadlineScheduler` with default policy if not given); its
+    `last_dt` is the real interval before the latest item. With `fifo` the
+    sensor samples on its own clock and the FIFO is drained every
+    `burst_interval` seconds instead; `scheduler` is then a `FifoTiming`,
+    if given, and gets the sensor's interval.
+
+    `sensor` is read instead of the MPU6050 at 0x68 if given, e.g. a
+    `SimulatedMpu6050`.
+    """
+    if sensor is None:
+        open_sensor = _open_default_sensor
+    else:
+        open_sensor = lambda: sensor
+    for _, item in mpu6050_bus_generator(dt, stopped, [open_sensor], fifo,
+                                         burst_interval, scheduler, report_interval):
+        yield item
+
+
+def mpu6050_bus_generator(dt, stopped, open_sensors, fifo=False, burst_interval=0.05,
+                          scheduler=None, report_interval=60):
+    """Samples several sensors sharing a bus, yields (sensor number, item).
+
+    Sensors are opened by calling `open_sensors` from the sampling thread
+    and are read one after another on every tick, or FIFO burst, with
+    items laid out like those of `mpu6050_data_generator`.
+    """
+    sensors = [open_sensor() for open_sensor in open_sensors]
+    for sensor in sensors:
+        _wait_configured(sensor)
+
+    if fifo:
+        for sensor in sensors:
+            sensor.start_fifo(dt)
+        if scheduler is not None:
+            # sensors of a bus are asked for the same interval
+            scheduler.last_dt = sensors[0].fifo_dt
+        try:
+            while not stopped.isSet():
+                for i, sensor in enumerate(sensors):
+                    for item in sensor.read_fifo():
+                        yield i, item
+                stopped.wait(burst_interval)
+        finally:
+            for sensor in sensors:
+                sensor.stop_fifo()
+        return
+
+    if scheduler is None:
+        scheduler = DeadlineScheduler(dt)
+    report_at = time.time() + report_interval
+    while not stopped.isSet():
+        scheduler.wait()
+        for i, sensor in enumerate(sensors):
+            yield i, sensor.read()
+        if time.time() > report_at:
+            report_at += report_interval
+            log.info('sampling stats: %s', scheduler.stats())
+
+
+class FifoTiming(object):
+    """Timing of FIFO sampling for filters, like a scheduler's:
+    `last_dt` is the interval the sensors sample at, `dt` until they
+    start."""
+
+    def __init__(self, dt):
+        self.last_dt = dt
+
+
+def _open_default_sensor():
+    from ct_addons.event_trackers.mpu6050.sensor import Mpu6050Reader
+    return Mpu6050Reader(0x68)
+
+
+def _wait_configured(sensor):
     # try to poll the sensor until it configures properly
     started_at = time.time()
     last_err = None
     while time.time() < started_at + 1:
         try:
-            sensor.get_all_data()
+            sensor.read()
         except IOError as err:
             last_err = err
             time.sleep(0.02)
         else:
-            break
-    else:
-        raise IOError('MPU6050 reading fails: {}'.format(str(last_err)))
-
-    while not stopped.isSet():
-        start = time.time()
-        accel = sensor.get_accel_data()
-        gyro = sensor.get_gyro_data()
-        temp = sensor.get_temp()
-        item = accel['x'], accel['y'], accel['z'], gyro['x'], gyro['y'], gyro['z'], temp
-        yield item
-        duration = time.time() - start
-        if dt > duration:
-            time.sleep(dt - duration)
+            return
+    raise IOError('MPU6050 reading fails: {}'.format(str(last_err)))
 
 
-def motiontracker_data_generator(mpu_generator, tracker, calibrate_n=0):
+def motiontracker_data_generator(mpu_generator, tracker, calibrate_n=0, timing=None):
+    # `timing` is the scheduler of `mpu_generator`, when given the tracker
+    # integrates over real intervals between samples instead of nominal dt
     if calibrate_n > 0:
         log.info('starting calibration, don\'t move the device...')
         tracker.start_calibration()
@@ -47,36 +113,240 @@ def motiontracker_data_generator(mpu_generator, tracker, calibrate_n=0):
         tracker.finish_calibration()
         log.info('calibration finished')
     for item in mpu_generator:
-        tracker.add_data(*item[:-1])  # last item is temperature
+        if timing is None:
+            tracker.add_data(*item[:-1])  # last item is temperature
+        else:
+            tracker.add_data(*item[:-1], dt=timing.last_dt)
         yield item + tracker.angles + tracker.coordinates
 
 
+def multi_motiontracker_data_generator(tagged_generator, trackers, sensor_ids,
+                                       calibrate_n=0, timing=None):
+    """`motiontracker_data_generator` for items of several sensors.
+
+    Consumes (sensor number, item) pairs, e.g. of `mpu6050_bus_generator`,
+    filters every sensor with its own one of `trackers` and yields items
+    of `motiontracker_data_generator` followed by that sensor's entry in
+    `sensor_ids`. Each sensor is calibrated on its first `calibrate_n`
+    items.
+    """
+    calibrating = [calibrate_n] * len(trackers)
+    if calibrate_n > 0:
+        log.info('starting calibration, don\'t move the device...')
+        for tracker in trackers:
+            tracker.start_calibration()
+    for i, item in tagged_generator:
+        tracker = trackers[i]
+        if calibrating[i]:
+            tracker.add_data(*item[:-1])  # last item is temperature
+            calibrating[i] -= 1
+            if not calibrating[i]:
+                tracker.finish_calibration()
+                log.info('calibration of sensor %s finished', sensor_ids[i])
+            continue
+        if timing is None:
+            tracker.add_data(*item[:-1])
+        else:
+            tracker.add_data(*item[:-1], dt=timing.last_dt)
+        yield item + tracker.angles + tracker.coordinates + (sensor_ids[i],)
+
+
+def motiontracker_batch_generator(block_generator, tracker, calibrate_n=0):
+    """Batch counterpart of `motiontracker_data_generator`.
+
+    Consumes (N, 7) NumPy blocks laid out like the items of
+    `mpu6050_data_generator` and yields (N, 13) blocks laid out like the
+    items of `motiontracker_data_generator`.
+    """
+    import numpy as np
+    if calibrate_n > 0:
+        log.info('starting calibration, don\'t move the device...')
+        tracker.start_calibration()
+    for block in block_generator:
+        if calibrate_n > 0:
+            head, block = block[:calibrate_n], block[calibrate_n:]
+            tracker.add_batch(head[:, :-1])  # last column is temperature
+            calibrate_n -= len(head)
+            if calibrate_n > 0:
+                continue
+            tracker.finish_calibration()
+            log.info('calibration finished')
+        if len(block):
+            yield np.hstack((block, tracker.add_batch(block[:, :-1])))
+
+
+class SampleRing(object):
+    """Preallocated ring of the latest `size` items, any writers and readers.
+
+    Each item is stored once, along with the time it was written; readers
+    keep their own `RingCursor` and a reader that falls more than `size`
+    items behind loses the oldest ones.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = [None] * size
+        self._times = [0.0] * size
+        self._seq = 0  # number of items ever written
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self._n_waiting = 0
+
+    def append(self, item):
+        with self._cond:
+            slot = self._seq % self.size
+            self._items[slot] = item
+            self._times[slot] = time.time()
+            self._seq += 1
+            if self._n_waiting:
+                self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def cursor(self, policy='drop-oldest'):
+        return RingCursor(self, policy)
+
+    def wait(self, cursor, timeout):
+        """Blocks until there are items for `cursor`, the ring is closed or
+        `timeout` passes. Returns False if there's nothing more to read."""
+        with self._cond:
+            if cursor.position == self._seq and not self._closed:
+                self._n_waiting += 1
+                self._cond.wait(timeout)
+                self._n_waiting -= 1
+            return not (self._closed and cursor.position == self._seq)
+
+    def wakeup(self):
+        with self._cond:
+            self._cond.notify_all()
+
+
+class RingCursor(object):
+    """Read position of one consumer in a `SampleRing`.
+
+    With 'drop-oldest' policy a lagging reader gets up to `size` latest
+    items, with 'latest-only' just the newest one; the skipped ones are
+    counted in `overruns`.
+    """
+
+    POLICIES = ('drop-oldest', 'latest-only')
+
+    def __init__(self, ring, policy='drop-oldest'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown policy: {}".format(policy))
+        self.ring = ring
+        self.policy = policy
+        self.position = ring._seq
+        self.overruns = 0
+        self.delivered = 0
+        self.closed = False
+
+    def read(self, indexed=False):
+        """Returns the items written since the last call, oldest first.
+
+        With `indexed` every item comes as (sequence number, timestamp, item).
+        """
+        ring = self.ring
+        seq = ring._seq
+        oldest = seq - (1 if self.policy == 'latest-only' else ring.size)
+        if self.position < oldest:
+            self.overruns += oldest - self.position
+            self.position = oldest
+        size = ring.size
+        if indexed:
+            items = [(i, ring._times[i % size], ring._items[i % size])
+                     for i in range(self.position, seq)]
+        else:
+            items = [ring._items[i % size] for i in range(self.position, seq)]
+        # items overwritten while they were copied are dropped too, the
+        # slot of the item being written right now included
+        lost = ring._seq + 1 - size - self.position
+        if lost > 0:
+            del items[:lost]
+            self.overruns += lost
+        self.position = seq
+        self.delivered += len(items)
+        return items
+
+
 class DataStreamer(object):
+    """Runs `generator` in its own thread and fans items out to consumers.
 
-    def __init__(self, generator, max_queue_size=1000, consumer_timeout=0.01):
+    More generators can be run into the same stream with `add_source`,
+    each in a thread of its own; the stream ends when all of them do.
+
+    Items are written once into a shared `SampleRing` of `max_queue_size`
+    items which every consumer reads at its own pace, so slow consumers
+    lose their oldest items and never hold up the generator. By default
+    every consumer has a thread of its own. Consumers added with an
+    `EventLoop`, or all of them if one is given as `loop`, are called on
+    the loop thread instead.
+
+    Consumers are called with the fields of every item as arguments, or
+    with lists of items if they ask for batches in `add_consumer`.
+    """
+
+    def __init__(self, generator, max_queue_size=1000, consumer_timeout=0.01,
+                 loop=None):
         self.max_queue_size = max_queue_size
         self.consumer_timeout = consumer_timeout
+        self._ring = SampleRing(max_queue_size)
         self._consumers = {}
         self._next_id = 1
         self._lock = threading.Lock()
         self._stopped = threading.Event()
-        self._generator = generator
-        self._thread = threading.Thread(target=self._run)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        self._loop = loop
+        # loops with consumers -> whether dispatch is scheduled on them
+        self._loops = {}
+        self._threads = []
+        self._running = 0
+        self.add_source(generator)
 
-    def add_consumer(self, function):
+    def add_source(self, generator):
+        with self._lock:
+            self._running += 1
+            thread = threading.Thread(target=self._run, args=(generator,))
+            thread.setDaemon(True)
+            self._threads.append(thread)
+        thread.start()
+
+    def add_consumer(self, function, policy='drop-oldest', batch_size=None,
+                     max_latency=0, as_array=False, indexed=False, loop=None):
+        """`policy` is what a lagging consumer gets, see `RingCursor`.
+
+        With `batch_size`, `function` gets a list of up to that many items,
+        or a NumPy array of them as rows with `as_array`. Items are held
+        back for at most `max_latency` seconds to fill a batch. With
+        `indexed`, batches are of (sequence number, timestamp, item).
+
+        `loop` is the `EventLoop` to call `function` on, if not the
+        streamer's one.
+        """
+        if loop is None:
+            loop = self._loop
+        if batch_size is None:
+            delivery = _ItemDelivery(function)
+        else:
+            delivery = _BatchDelivery(function, batch_size, max_latency, as_array,
+                                      indexed)
         with self._lock:
             if self._stopped.isSet():
                 return
-            queue = Queue.Queue(maxsize=self.max_queue_size)
-            consumer_thread = threading.Thread(target=self._consumer_run,
-                                               args=(queue, function))
-            consumer_thread.setDaemon(True)
-            consumer_thread.start()
+            cursor = self._ring.cursor(policy)
+            if loop is not None:
+                consumer_thread = None
+                self._loops.setdefault(loop, False)
+            else:
+                consumer_thread = threading.Thread(target=self._consumer_run,
+                                                   args=(cursor, delivery))
+                consumer_thread.setDaemon(True)
+                consumer_thread.start()
             new_id = self._next_id
             self._next_id += 1
-            self._consumers[new_id] = (queue, function, consumer_thread)
+            self._consumers[new_id] = (cursor, delivery, consumer_thread, loop)
         log.info('added new consumer: %r -> %s', function, new_id)
         return new_id
 
@@ -85,61 +355,185 @@ class DataStreamer(object):
 
     def remove_consumer(self, consumer_id):
         with self._lock:
-            q, f, t = self._consumers.pop(consumer_id)
-        try:
-            while True:
-                q.get_nowait()
-        except Queue.Empty:
-            q.put(None)
+            cursor, f, t, loop = self._consumers.pop(consumer_id)
+            if loop is not None and not any(
+                    c[3] is loop for c in self._consumers.values()):
+                del self._loops[loop]
+        cursor.closed = True
+        if t is None:
+            log.info('removing consumer: %r -> %s, %d items, %d lost',
+                     f, consumer_id, cursor.delivered, cursor.overruns)
+            return
+        self._ring.wakeup()
         blocking = threading.currentThread().ident != t.ident
-        log.info('removing consumer: %r -> %s %s',
-                 f, consumer_id, '(blocking)' if blocking else '')
+        log.info('removing consumer: %r -> %s, %d items, %d lost %s',
+                 f, consumer_id, cursor.delivered, cursor.overruns,
+                 '(blocking)' if blocking else '')
         if blocking:
             t.join()
 
+    def consumer_stats(self):
+        """Returns {consumer id: (items delivered, items lost)}."""
+        with self._lock:
+            return dict(
+                (consumer_id, (cursor.delivered, cursor.overruns))
+                for consumer_id, (cursor, _, _, _) in self._consumers.items()
+            )
+
     def wait_for_end(self):
-        self._thread.join()
+        for thread in list(self._threads):
+            thread.join()
         with self._lock:
             consumers = list(self._consumers.values())
-        for q, f, t in consumers:
-            t.join()
+        for _, _, t, _ in consumers:
+            if t is not None:
+                t.join()
 
-    def _run(self):
+    def _run(self, generator):
+        ring = self._ring
         try:
-            for item in self._generator:
+            for item in generator:
                 if self._stopped.isSet():
                     break
-                with self._lock:
-                    consumers = list(self._consumers.values())
-                for q, _, _ in consumers:
-                    try:
-                        q.put(item, timeout=self.consumer_timeout)
-                    except Queue.Full:
-                        pass
+                ring.append(item)
+                if self._loops:
+                    self._schedule_dispatch()
         except:
             log.exception('data generator got an error')
         log.info('data generator finished')
         with self._lock:
-            for q, _, _ in self._consumers.values():
-                q.put(None)
-            for _, _, t in self._consumers.values():
+            self._running -= 1
+            if self._running:
+                return
+        ring.close()
+        with self._lock:
+            consumers = list(self._consumers.values())
+        for _, _, t, _ in consumers:
+            if t is not None:
                 t.join()
 
-    def _consumer_run(self, queue, function):
-        while not self._stopped.isSet():
-            item = queue.get()
-            if item is None:
+    def _schedule_dispatch(self):
+        # every loop is woken up once per batch of items, not per item
+        with self._lock:
+            loops = [loop for loop, scheduled in self._loops.items() if not scheduled]
+            for loop in loops:
+                self._loops[loop] = True
+        for loop in loops:
+            loop.call_soon_threadsafe(self._dispatch, loop)
+
+    def _dispatch(self, loop):
+        with self._lock:
+            if loop in self._loops:
+                self._loops[loop] = False
+            consumers = [c for c in self._consumers.values() if c[3] is loop]
+        for cursor, delivery, _, _ in consumers:
+            delivery.push(cursor.read(delivery.indexed), cursor)
+            time_left = delivery.time_left()
+            if time_left is not None and not delivery.timer_scheduled:
+                delivery.timer_scheduled = True
+                loop.call_later(time_left, self._flush_due, loop, cursor, delivery)
+
+    def _flush_due(self, loop, cursor, delivery):
+        delivery.timer_scheduled = False
+        if cursor.closed:
+            return
+        time_left = delivery.time_left()
+        if time_left:
+            delivery.timer_scheduled = True
+            loop.call_later(time_left, self._flush_due, loop, cursor, delivery)
+        elif time_left is not None:
+            delivery.flush()
+
+    def _consumer_run(self, cursor, delivery):
+        while not self._stopped.isSet() and not cursor.closed:
+            timeout = self.consumer_timeout
+            time_left = delivery.time_left()
+            if time_left is not None:
+                timeout = min(timeout, time_left)
+            more = self._ring.wait(cursor, timeout)
+            delivery.push(cursor.read(delivery.indexed), cursor)
+            if delivery.time_left() == 0:
+                delivery.flush()
+            if not more:
+                delivery.flush()
                 break
-            function(*item)
-        log.info('stopped consumer %r', function)
-
-
-def dump_to_file(generator, filename, n_entries):
-    log.info("start dumping to file %s from %r", filename, generator)
-    with open(filename, 'w') as f:
-        for _, item in zip(range(n_entries), generator):
-            f.write(' '.join(map(str, item)) + '\n')
-            yield item
-    log.info("DONE dumping to file %s from %r", filename, generator)
-    for item in generator:
-        yield item
+        log.info('stopped consumer %r', delivery)
+
+
+class _ItemDelivery(object):
+    # calls `function` with the fields of every item
+
+    timer_scheduled = False
+    indexed = False
+
+    def __init__(self, function):
+        self.function = function
+
+    def push(self, items, cursor):
+        for item in items:
+            self.function(*item)
+            if cursor.closed:
+                break
+
+    def time_left(self):
+        return None
+
+    def flush(self):
+        pass
+
+    def __repr__(self):
+        return repr(self.function)
+
+
+class _BatchDelivery(object):
+    # collects items into batches for `function`
+
+    def __init__(self, function, batch_size, max_latency, as_array, indexed):
+        if as_array and indexed:
+            raise ValueError("Indexed batches can't be arrays")
+        self.function = function
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.as_array = as_array
+        self.indexed = indexed
+        self.timer_scheduled = False
+        self._items = []
+        self._deadline = None
+
+    def push(self, items, cursor):
+        if not items:
+            return
+        if not self._items:
+            self._deadline = monotonic() + self.max_latency
+        self._items.extend(items)
+        while len(self._items) >= self.batch_size and not cursor.closed:
+            batch = self._items[:self.batch_size]
+            del self._items[:self.batch_size]
+            self._deliver(batch)
+        if not self._items:
+            self._deadline = None
+        elif self._deadline <= monotonic():
+            self.flush()
+
+    def time_left(self):
+        """Seconds until the incomplete batch is due, None if it's empty."""
+        if self._deadline is None:
+            return None
+        return max(0, self._deadline - monotonic())
+
+    def flush(self):
+        if self._items:
+            batch = self._items
+            self._items = []
+            self._deadline = None
+            self._deliver(batch)
+
+    def _deliver(self, batch):
+        if self.as_array:
+            import numpy as np
+            batch = np.array(batch)
+        self.function(batch)
+
+    def __repr__(self):
+        return repr(self.function)
+
@@ -0,0 +1,146 @@
+"""Framed protocol of the mpu6050 debug server.
+
+A client that never writes gets the legacy stream: 13 native floats per
+sample, back to back, of samples from every sensor. Writing a `SUBSCRIBE`
+request switches it to frames of several samples each, `FRAME_HEADER`
+followed by big endian float32 values of the subscribed channels, sample
+by sample. Samples are numbered for each sensor, and only those whose
+number is divisible by the decimation factor are sent. A frame holds
+samples of one sensor, given in its header, and never spans lost samples.
+The request can be repeated to change the subscription.
+
+Legacy data already on its way may precede the first frame, so clients
+look for the first valid frame header after subscribing.
+"""
+import struct
+
+
+VERSION = 1
+
+CHANNELS = (
+    'accx', 'accy', 'accz', 'gyrox', 'gyroy', 'gyroz', 'temp',
+    'anglex', 'angley', 'anglez', 'latx', 'laty', 'latz', 'sensor',
+)
+ALL_CHANNELS = (1 << len(CHANNELS)) - 1
+SENSOR = CHANNELS.index('sensor')
+LEGACY_CHANNELS = 13
+
+# magic, version, channel mask, decimation
+SUBSCRIBE = struct.Struct('>4sBHH')
+SUBSCRIBE_MAGIC = b'CTDS'
+
+# magic, version, sensor, channel mask, decimation, number of samples,
+# the sensor's sample number and timestamps of the first and the last
+# sample
+FRAME_HEADER = struct.Struct('>4sBBHHHQdd')
+FRAME_MAGIC = b'CTDF'
+
+_bodies = {}
+_legacy = {}
+
+
+def channel_mask(names):
+    mask = 0
+    for name in names:
+        if name not in CHANNELS:
+            raise ValueError("Unknown channel: {}".format(name))
+        mask |= 1 << CHANNELS.index(name)
+    return mask
+
+
+def mask_channels(mask):
+    """Indices of channels in `mask`, in frame order."""
+    return [i for i in range(len(CHANNELS)) if mask & (1 << i)]
+
+
+def encode_subscribe(mask=ALL_CHANNELS, decimation=1):
+    return SUBSCRIBE.pack(SUBSCRIBE_MAGIC, VERSION, mask, decimation)
+
+
+def decode_subscribe(data):
+    """Returns (channel mask, decimation), raises ValueError if invalid."""
+    magic, version, mask, decimation = SUBSCRIBE.unpack(data)
+    if magic != SUBSCRIBE_MAGIC or version != VERSION:
+        raise ValueError("Bad subscribe request: {!r}".format(data))
+    if not mask or mask & ~ALL_CHANNELS or not decimation:
+        raise ValueError("Bad subscription: mask={}, decimation={}".format(mask, decimation))
+    return mask, decimation
+
+
+def body_struct(n_values):
+    try:
+        return _bodies[n_values]
+    except KeyError:
+        return _bodies.setdefault(n_values, struct.Struct('>{}f'.format(n_values)))
+
+
+def legacy_struct(n_values):
+    try:
+        return _legacy[n_values]
+    except KeyError:
+        return _legacy.setdefault(n_values, struct.Struct('{}f'.format(n_values)))
+
+
+def encode_legacy(samples):
+    """Encodes (seq, timestamp, item) tuples for clients not subscribed."""
+    values = [x for _, _, item in samples for x in item[:LEGACY_CHANNELS]]
+    return legacy_struct(len(values)).pack(*values)
+
+
+class FrameEncoder(object):
+    """Encodes (seq, timestamp, item) tuples into frames of a subscription
+    to `mask` channels of every `decimation`-th sample.
+
+    Samples of every sensor are numbered in the order the client gets
+    them, from 0, across calls of `encode`. Gaps in `seq` are lost
+    samples and end the frames of all sensors.
+    """
+
+    def __init__(self, mask, decimation):
+        self.mask = mask
+        self.decimation = decimation
+        self._channels = mask_channels(mask)
+        # sensor -> number of its next sample
+        self._numbers = {}
+        self._next_seq = None
+
+    def encode(self, samples):
+        """Returns a string of frames of `samples`."""
+        frames = []
+        # sensor -> [(number, timestamp, item)] not in a frame yet
+        runs = {}
+        for seq, timestamp, item in samples:
+            if seq != self._next_seq and self._next_seq is not None:
+                frames.extend(self._encode_runs(runs))
+                runs = {}
+            self._next_seq = seq + 1
+            sensor = int(item[SENSOR])
+            number = self._numbers.get(sensor, 0)
+            self._numbers[sensor] = number + 1
+            if number % self.decimation == 0:
+                runs.setdefault(sensor, []).append((number, timestamp, item))
+        frames.extend(self._encode_runs(runs))
+        return b''.join(frames)
+
+    def _encode_runs(self, runs):
+        return [self._encode_frame(sensor, run) for sensor, run in sorted(runs.items())]
+
+    def _encode_frame(self, sensor, run):
+        values = [item[i] for _, _, item in run for i in self._channels]
+        header = FRAME_HEADER.pack(
+            FRAME_MAGIC, VERSION, sensor, self.mask, self.decimation, len(run),
+            run[0][0], run[0][1], run[-1][1],
+        )
+        return header + body_struct(len(values)).pack(*values)
+
+
+def decode_frame_header(data):
+    """Returns (sensor, mask, decimation, number of samples, first sample
+    number, first timestamp, last timestamp, body size) of the header in
+    `data`."""
+    magic, version, sensor, mask, decimation, n_samples, number, t_first, t_last = \
+        FRAME_HEADER.unpack(data)
+    if magic != FRAME_MAGIC or version != VERSION:
+        raise ValueError("Bad frame header: {!r}".format(data))
+    n_values = n_samples * len(mask_channels(mask))
+    return sensor, mask, decimation, n_samples, number, t_first, t_last, 4 * n_values
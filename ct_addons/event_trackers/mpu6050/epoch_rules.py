@@ -0,0 +1,295 @@
+"""Epoch conditions declared as data.
+
+An `EpochRule` is met while an expression of sample channels is above
+and/or below a threshold. The tracker sends the rule's event when that
+starts. `EpochRules` compiles all rules of a tracker into one function
+that computes every rule's value at once. The function runs on a single
+sample with `math`, or on the columns of a NumPy batch with NumPy. Batches
+then go through the threshold, hysteresis and duration logic of all rules
+together, and Python only loops over the rules whose state changes.
+
+Besides the channels of samples, rules can use the vibration features of
+`vibration.FEATURES`, which are 0 unless the tracker computes them.
+"""
+from __future__ import absolute_import
+import ast
+import math
+from ct_addons.event_trackers.mpu6050.debug_protocol import CHANNELS
+from ct_addons.event_trackers.mpu6050.vibration import FEATURES
+
+
+# functions available in expressions, for single samples and for arrays
+FUNCTIONS = ('abs', 'min', 'max', 'sqrt', 'hypot')
+
+DEFAULT_RULES = [
+    {
+        'event': 'MOVEMENT',
+        'value': 'sqrt(latx**2 + laty**2 + latz**2)',
+        'above': 0.2,
+        'data': {'x': 'latx', 'y': 'laty', 'z': 'latz'},
+    },
+    {
+        'event': 'ORIENTATION',
+        'value': 'max(abs(anglex), abs(angley), abs(anglez))',
+        'above': 30.0,
+        'data': {'x': 'anglex', 'y': 'angley', 'z': 'anglez'},
+    },
+    {
+        'event': 'TEMPERATURE',
+        'value': 'temp',
+        'below': 15,
+        'above': 45,
+        'hysteresis': 1,
+        'data': {'temp': 'temp'},
+    },
+    {
+        'event': 'VIBRATION',
+        'value': 'vib_rms',
+        'above': 0.5,
+        'hysteresis': 0.1,
+        'min_duration': 0.1,
+        'data': {
+            'rms': 'vib_rms', 'peak': 'vib_peak', 'crest': 'vib_crest',
+            'low': 'vib_low', 'mid': 'vib_mid', 'high': 'vib_high',
+        },
+    },
+]
+
+_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Call, ast.Name, ast.Num,
+    ast.Load, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod,
+    ast.USub, ast.UAdd,
+)
+
+
+class EpochRule(object):
+    """Condition of epochs of `event`, met while `value`, an expression of
+    channels and `FUNCTIONS`, is above `above` or below `below`.
+
+    The value has to get `hysteresis` past a threshold for the condition
+    to be met, and back by as much for it to end. A change has to last
+    `min_duration` seconds to count. `data` maps fields of the event to
+    expressions of the sample that starts the epoch.
+    """
+
+    def __init__(self, event, value, above=None, below=None, hysteresis=0.0,
+                 min_duration=0.0, data=None):
+        if above is None and below is None:
+            raise ValueError("Rule of {} needs a threshold".format(event))
+        if hysteresis < 0 or min_duration < 0:
+            raise ValueError("Rule of {} has negative hysteresis or duration".format(event))
+        self.event = event
+        self.value = value
+        self.above = above
+        self.below = below
+        self.hysteresis = hysteresis
+        self.min_duration = min_duration
+        self.data = dict(data or {})
+        # channels and features the rule uses
+        self.names = set()
+        for expression in [value] + list(self.data.values()):
+            self.names.update(_check(expression))
+
+    @classmethod
+    def from_config(cls, config):
+        try:
+            return cls(**config)
+        except TypeError:
+            raise ValueError("Bad epoch rule: {!r}".format(config))
+
+    def __repr__(self):
+        return '<EpochRule {} {!r}>'.format(self.event, self.value)
+
+
+class EpochRules(object):
+    """`rules` compiled for samples of `CHANNELS` taken every `dt` sec.
+
+    The state of the rules for each sample source comes from `new_state`.
+    `evaluate` takes one sample and `evaluate_batch` takes an array of
+    samples as rows. Both return the rules whose condition changed, as
+    (rule number, whether it is met now, sample number, sample), samples
+    numbered from 0 for each state.
+    """
+
+    def __init__(self, rules, dt):
+        self.rules = list(rules)
+        self.dt = dt
+        inf = float('inf')
+        self._above = [inf if rule.above is None else rule.above for rule in self.rules]
+        self._below = [-inf if rule.below is None else rule.below for rule in self.rules]
+        self._hysteresis = [rule.hysteresis for rule in self.rules]
+        # min_duration in samples, at least the one that changes it
+        self._min_samples = [max(1, int(math.ceil(rule.min_duration / dt - 1e-9)))
+                             for rule in self.rules]
+        self._values = self._compile([rule.value for rule in self.rules],
+                                     _scalar_functions())
+        self._array_values = None
+        self._data = [
+            (list(rule.data), self._compile(list(rule.data.values()), _scalar_functions()))
+            for rule in self.rules
+        ]
+
+    def set_threshold(self, event, above=None, below=None):
+        """Changes thresholds of the rules of `event` given as not None."""
+        for i, rule in enumerate(self.rules):
+            if rule.event != event:
+                continue
+            if above is not None:
+                rule.above = self._above[i] = above
+            if below is not None:
+                rule.below = self._below[i] = below
+
+    def new_state(self):
+        return _RulesState(len(self.rules))
+
+    def event_data(self, i, item):
+        """Event fields of rule `i` for `item`, a sequence of floats."""
+        keys, values = self._data[i]
+        return dict(zip(keys, values(*item)))
+
+    def evaluate(self, state, item):
+        values = self._values(*item)
+        index = state.samples
+        state.samples += 1
+        above, below, hysteresis = self._above, self._below, self._hysteresis
+        trigger, met, pending = state.trigger, state.met, state.pending
+        changes = []
+        for i, value in enumerate(values):
+            h = hysteresis[i]
+            if trigger[i]:
+                now = value > above[i] - h or value < below[i] + h
+            else:
+                now = value > above[i] + h or value < below[i] - h
+            trigger[i] = now
+            if now == met[i]:
+                pending[i] = 0
+                continue
+            pending[i] += 1
+            if pending[i] >= self._min_samples[i]:
+                met[i] = now
+                pending[i] = 0
+                changes.append((i, now, index, item))
+        return changes
+
+    def evaluate_batch(self, state, rows):
+        """`evaluate` over the rows of a 2D array, oldest first, returns
+        changes in the order of samples with rows as sequences of floats."""
+        import numpy as np
+        n = len(rows)
+        first = state.samples
+        state.samples += n
+        if not n or not self.rules:
+            return []
+        if self._array_values is None:
+            self._array_values = self._compile([rule.value for rule in self.rules],
+                                               _array_functions(np))
+        values = np.empty((len(self.rules), n))
+        for i, column in enumerate(self._array_values(*rows.T)):
+            values[i] = column
+        above = np.array(self._above)[:, None]
+        below = np.array(self._below)[:, None]
+        h = np.array(self._hysteresis)[:, None]
+        enter = (values > above + h) | (values < below - h)
+        stay = (values > above - h) | (values < below + h)
+        # hysteresis: met where entered, not where left, else as before
+        decided = np.where(enter, 1, np.where(stay, -1, 0))
+        last = np.where(decided >= 0, np.arange(n), -1)
+        np.maximum.accumulate(last, axis=1, out=last)
+        rule_index = np.arange(len(self.rules))[:, None]
+        before = np.array(state.trigger, dtype=bool)[:, None]
+        trigger = np.where(last >= 0, decided[rule_index, np.maximum(last, 0)] == 1,
+                           before)
+        state.trigger = trigger[:, -1].tolist()
+
+        # Python only for rules that aren't where they were all along
+        met = np.array(state.met, dtype=bool)[:, None]
+        changing = (trigger != met).any(axis=1) | np.array(state.pending, dtype=bool)
+        changes = []
+        for i in np.flatnonzero(changing):
+            changes.extend((i, now, j) for j, now in self._debounce(state, i, trigger[i]))
+        changes.sort(key=lambda change: change[2])
+        return [(int(i), now, first + j, rows[j].tolist()) for i, now, j in changes]
+
+    def _debounce(self, state, i, trigger):
+        # yields (row, met) where the condition of rule `i` changes, runs
+        # of samples on the other side than the condition are counted up
+        # to the rule's duration, across batches too
+        met, pending, needed = state.met[i], state.pending[i], self._min_samples[i]
+        starts = [0] + [int(j) + 1 for j in (trigger[1:] != trigger[:-1]).nonzero()[0]]
+        ends = starts[1:] + [len(trigger)]
+        for start, end in zip(starts, ends):
+            if bool(trigger[start]) == met:
+                pending = 0
+                continue
+            if end - start >= needed - pending:
+                met = not met
+                yield start + needed - pending - 1, met
+                pending = 0
+            else:
+                pending += end - start
+        state.met[i] = met
+        state.pending[i] = pending
+
+    def _compile(self, expressions, functions):
+        # one function of all channels and features returning a list of
+        # all values
+        arguments = CHANNELS + tuple('{}=0.0'.format(name) for name in FEATURES)
+        source = 'lambda {}: [{}]'.format(
+            ', '.join(arguments), ', '.join('({})'.format(e) for e in expressions))
+        namespace = dict(functions, __builtins__={})
+        return eval(compile(source, '<epoch rules>', 'eval'), namespace)
+
+
+class _RulesState(object):
+    # conditions of all rules for one sample source
+
+    def __init__(self, n_rules):
+        # whether past the thresholds, with hysteresis
+        self.trigger = [False] * n_rules
+        # whether the condition is met, after min_duration
+        self.met = [False] * n_rules
+        # samples the trigger has been different from met for
+        self.pending = [0] * n_rules
+        # samples evaluated
+        self.samples = 0
+
+
+def _scalar_functions():
+    return {'abs': abs, 'min': min, 'max': max, 'sqrt': math.sqrt, 'hypot': math.hypot}
+
+
+def _array_functions(np):
+    return {
+        'abs': np.abs,
+        'min': lambda *args: reduce(np.minimum, args),
+        'max': lambda *args: reduce(np.maximum, args),
+        'sqrt': np.sqrt,
+        'hypot': np.hypot,
+    }
+
+
+def _check(expression):
+    # returns the names of channels and features in `expression`
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        raise ValueError("Bad expression: {!r}".format(expression))
+    for node in ast.walk(tree):
+        if not isinstance(node, _NODES):
+            raise ValueError("Unsupported expression: {!r}".format(expression))
+        if isinstance(node, ast.Name) and node.id not in CHANNELS + FEATURES + FUNCTIONS:
+            raise ValueError("Unknown name {!r} in {!r}".format(node.id, expression))
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS
+                    or node.keywords or node.starargs or node.kwargs):
+                raise ValueError("Unsupported call in {!r}".format(expression))
+            if node.func.id in ('min', 'max') and len(node.args) < 2:
+                raise ValueError("{} needs several arguments in {!r}".format(
+                    node.func.id, expression))
+    return set(node.id for node in ast.walk(tree)
+               if isinstance(node, ast.Name) and node.id not in FUNCTIONS)
+
+
+def load_rules(configs):
+    """`EpochRule`s of a list of dicts, e.g. of JSON config."""
+    return [EpochRule.from_config(config) for config in configs]
@@ -6,27 +6,48 @@ log = logging.getLogger(__name__)
 
 
 class MotionTracker(object):
+
+    # vectors are preallocated 3-item lists updated in place and rotations
+    # are row-major 9-item lists, so that `add_data` allocates no tuples
+    __slots__ = (
+        'time_term', 'rot_decay', 'bufsize', 'dt',
+        'world_pos', 'velocity', 'basis_x', 'basis_y', 'basis_z',
+        '_init_basis_x', '_init_basis_y', '_init_basis_z',
+        '_gyro_moment', '_gyro_integrated',
+        '_calibration_state', '_calibration_sums', '_calibration_n',
+        '_init_gravity', '_gravity', '_init_gravity_value',
+        '_gyro_offs', '_acc_offs', '_gyro_rot', '_fix_rot',
+    )
+
     def __init__(self, time_term, read_interval, bufsize=20, accel_offsets=(0, 0, 0)):
         # TODO document this
-        self.rot_decay = float(time_term) / (time_term + read_interval)
+        self.time_term = float(time_term)
+        self.rot_decay = self.time_term / (time_term + read_interval)
         self.bufsize = bufsize
         self.dt = read_interval
-        self.world_pos = _ZERO
-        self.basis_x = _X_AXIS
-        self.basis_y = _Y_AXIS
+        self.world_pos = list(_ZERO)
+        self.velocity = list(_ZERO)
+        self.basis_x = list(_X_AXIS)
+        self.basis_y = list(_Y_AXIS)
+        self.basis_z = list(_Z_AXIS)
+        self._init_basis_x = _X_AXIS
+        self._init_basis_y = _Y_AXIS
+        self._init_basis_z = _Z_AXIS
 
-        self._gyro_moment = _ZERO
-        self._gyro_integrated = _ZERO
+        self._gyro_moment = list(_ZERO)
+        self._gyro_integrated = list(_ZERO)
 
         self._calibration_state = False
         self._init_gravity = _ZERO
-        self._gravity = _ZERO
+        self._gravity = list(_ZERO)
         self._init_gravity_value = 0
         self._gyro_offs = _ZERO
         self._calibration_sums = None
         self._calibration_n = 0
 
-        self._acc_offs = accel_offsets
+        self._acc_offs = tuple(accel_offsets)
+        self._gyro_rot = list(_IDENTITY)
+        self._fix_rot = list(_IDENTITY)
 
     def start_calibration(self):
         self._calibration_state = True
@@ -36,84 +57,218 @@ class MotionTracker(object):
     def finish_calibration(self):
         self._calibration_state = False
         calib_means = [x / self._calibration_n for x in self._calibration_sums]
-        self._gravity = calib_means[:3]
-        self._gyro_offs = calib_means[3:]
+        self._gyro_offs = tuple(calib_means[3:])
 
-        self._gravity = _sub(self._gravity, self._acc_offs)
-        self._init_gravity = self._gravity
+        self._init_gravity = _sub(calib_means[:3], self._acc_offs)
+        self._gravity[:] = self._init_gravity
         self._init_gravity_value = dist(*self._gravity)
 
-        self._init_basis_x = _X_AXIS
-        self._init_basis_y = _Y_AXIS
-        self._init_basis_z = _cross(self._init_basis_x, self._init_basis_y)
-
-        self._gyro_moment = _ZERO
-        self._gyro_integrated = _ZERO
+        self._gyro_moment[:] = _ZERO
+        self._gyro_integrated[:] = _ZERO
 
-        self.world_pos = _ZERO
-        self.velocity = _ZERO
-        self.basis_x = self._init_basis_x
-        self.basis_y = self._init_basis_y
-        self.basis_z = self._init_basis_z
+        self.world_pos[:] = _ZERO
+        self.velocity[:] = _ZERO
+        self.basis_x[:] = self._init_basis_x
+        self.basis_y[:] = self._init_basis_y
+        self.basis_z[:] = self._init_basis_z
 
         log.info('gyro offsets = ({})'.format(_fmt(self._gyro_offs)))
         log.info('accelerometer offsets = ({})'.format(_fmt(self._acc_offs)))
         log.info('gravity value = {:.3f}'.format(dist(*self._gravity)))
 
-    def add_data(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z):
+    def add_data(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=None):
+        # `dt` is the real interval since previous sample, nominal
+        # `read_interval` is used if it is not known
         if self._calibration_state:
             data_tuple = acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z
             for i in range(len(data_tuple)):
                 self._calibration_sums[i] += data_tuple[i]
             self._calibration_n += 1
-        else:
-            gyro = _sub((gyro_x, gyro_y, gyro_z), self._gyro_offs)
-            acc = _sub((acc_x, acc_y, acc_z), self._acc_offs)
+            return
 
-            dt = self.dt
-            self._gyro_moment = _mul(gyro, dt * _DEG2RAD)
-            self._gyro_integrated = _add(self._gyro_integrated, self._gyro_moment)
+        acc_offs = self._acc_offs
+        ax = acc_x - acc_offs[0]
+        ay = acc_y - acc_offs[1]
+        az = acc_z - acc_offs[2]
 
+        if dt is None:
+            dt = self.dt
             hpf = self.rot_decay
-            lpf = 1 - hpf
-
-            angle, axis = _gyro_to_angleaxis(self._gyro_moment)
-            newbasis_g_x = _rotate(self.basis_x, axis, angle)
-            newbasis_g_y = _rotate(self.basis_y, axis, angle)
-            gravity_g = _rotate(self._gravity, axis, angle)
-            gravity_a = _mul(acc, self._init_gravity_value / dist(*acc))
-
-            gravity_f = _add(_mul(gravity_a, lpf), _mul(gravity_g, hpf))
-            fix_angle = _angle_between(gravity_g, gravity_f)
-            fix_axis = _cross(gravity_f, gravity_g)
-
-            self._gravity = gravity_a
-
-            self.basis_x = _rotate(newbasis_g_x, fix_axis, fix_angle)
-            self.basis_y = _rotate(newbasis_g_y, fix_axis, fix_angle)
-
-            self.basis_z = _cross(self.basis_x, self.basis_y)
-
-            acceleration = _sub(acc, gravity_f)
-            new_velocity = _add(self.velocity, _mul(acceleration, dt))
-            self.world_pos = _add(
-                self.world_pos,
-                _mul(self.velocity, dt / 2),
-                _mul(new_velocity, dt / 2),
-            )
-            self.velocity = _mul(new_velocity, 0.99)
+        else:
+            hpf = self.time_term / (self.time_term + dt)
+        lpf = 1 - hpf
+
+        k = dt * _DEG2RAD
+        gyro_offs = self._gyro_offs
+        moment = self._gyro_moment
+        moment[0] = mx = (gyro_x - gyro_offs[0]) * k
+        moment[1] = my = (gyro_y - gyro_offs[1]) * k
+        moment[2] = mz = (gyro_z - gyro_offs[2]) * k
+        integrated = self._gyro_integrated
+        integrated[0] += mx
+        integrated[1] += my
+        integrated[2] += mz
+
+        # one rotation per sample, shared by both basis vectors and gravity
+        basis_x = self.basis_x
+        basis_y = self.basis_y
+        gravity = self._gravity
+        rot = self._gyro_rot
+        angle = sqrt(mx * mx + my * my + mz * mz)
+        if angle >= 0.00001:
+            _set_rotation(rot, -mx / angle, -my / angle, -mz / angle, angle)
+            _apply_rotation(rot, basis_x)
+            _apply_rotation(rot, basis_y)
+            _apply_rotation(rot, gravity)
+        ggx, ggy, ggz = gravity
+
+        k = self._init_gravity_value / sqrt(ax * ax + ay * ay + az * az)
+        gravity[0] = gax = ax * k
+        gravity[1] = gay = ay * k
+        gravity[2] = gaz = az * k
+
+        gfx = gax * lpf + ggx * hpf
+        gfy = gay * lpf + ggy * hpf
+        gfz = gaz * lpf + ggz * hpf
+
+        # correction: rotation around gravity_f x gravity_g by the angle
+        # between the two gravity estimates
+        fx = gfy * ggz - gfz * ggy
+        fy = gfz * ggx - gfx * ggz
+        fz = gfx * ggy - gfy * ggx
+        fix_d = sqrt(fx * fx + fy * fy + fz * fz)
+        if fix_d >= 0.00001:
+            cos_fix = ((ggx * gfx + ggy * gfy + ggz * gfz) /
+                       sqrt((ggx * ggx + ggy * ggy + ggz * ggz) *
+                            (gfx * gfx + gfy * gfy + gfz * gfz)))
+            rot = self._fix_rot
+            _set_rotation(rot, fx / fix_d, fy / fix_d, fz / fix_d,
+                          acos(min(1.0, cos_fix)))
+            _apply_rotation(rot, basis_x)
+            _apply_rotation(rot, basis_y)
+
+        x1, y1, z1 = basis_x
+        x2, y2, z2 = basis_y
+        basis_z = self.basis_z
+        basis_z[0] = y1 * z2 - z1 * y2
+        basis_z[1] = z1 * x2 - x1 * z2
+        basis_z[2] = x1 * y2 - y1 * x2
+
+        velocity = self.velocity
+        pos = self.world_pos
+        half_dt = dt / 2
+        vx, vy, vz = velocity
+        nvx = vx + (ax - gfx) * dt
+        nvy = vy + (ay - gfy) * dt
+        nvz = vz + (az - gfz) * dt
+        pos[0] += (vx + nvx) * half_dt
+        pos[1] += (vy + nvy) * half_dt
+        pos[2] += (vz + nvz) * half_dt
+        velocity[0] = nvx * 0.99
+        velocity[1] = nvy * 0.99
+        velocity[2] = nvz * 0.99
+
+    def add_batch(self, block):
+        """Vectorized version of `add_data` for offline processing.
+
+        `block` is an (N, 6) array of accelerometer and gyro readings in the
+        same order as `add_data` arguments. Returns an (N, 6) array with
+        `angles` and `coordinates` after every sample, or None while
+        calibrating. Requires NumPy.
+        """
+        import numpy as np
+        block = np.asarray(block, dtype=float).reshape(-1, 6)
+        if self._calibration_state:
+            sums = block.sum(axis=0)
+            for i in range(len(self._calibration_sums)):
+                self._calibration_sums[i] += sums[i]
+            self._calibration_n += len(block)
+            return None
+        n = len(block)
+        result = np.empty((n, 6))
+        if n == 0:
+            return result
+
+        acc = block[:, :3] - self._acc_offs
+        gyro = block[:, 3:] - self._gyro_offs
+
+        dt = self.dt
+        hpf = self.rot_decay
+        lpf = 1 - hpf
+
+        moments = gyro * (dt * _DEG2RAD)
+        self._gyro_moment[:] = moments[-1]
+        self._gyro_integrated[:] = self._gyro_integrated + moments.sum(axis=0)
+        gyro_rot = _rotation_matrices(-moments)
+
+        # gravity before every sample is the accelerometer reading of the
+        # previous one, so the whole complementary filter step can be done
+        # for all samples at once
+        gravity_a = acc * (self._init_gravity_value /
+                           np.sqrt((acc * acc).sum(axis=1)))[:, None]
+        gravity_prev = np.empty_like(gravity_a)
+        gravity_prev[0] = self._gravity
+        gravity_prev[1:] = gravity_a[:-1]
+        gravity_g = np.einsum('nij,nj->ni', gyro_rot, gravity_prev)
+        gravity_f = gravity_a * lpf + gravity_g * hpf
+
+        fix_axis = np.cross(gravity_f, gravity_g)
+        fix_angle = _angles_between(gravity_g, gravity_f)
+        fix_norm = np.sqrt((fix_axis * fix_axis).sum(axis=1))
+        fix_norm[fix_norm < 0.00001] = np.inf
+        fix_rot = _rotation_matrices(fix_axis * (fix_angle / fix_norm)[:, None])
+
+        # basis vectors are the only true recurrence: the rotation of every
+        # step is known upfront, so the running product is a prefix scan
+        steps = np.matmul(fix_rot, gyro_rot)
+        shift = 1
+        while shift < n:
+            steps[shift:] = np.matmul(steps[shift:], steps[:-shift])
+            shift *= 2
+        basis_x = np.einsum('nij,j->ni', steps, self.basis_x)
+        basis_y = np.einsum('nij,j->ni', steps, self.basis_y)
+        basis_z = np.cross(basis_x, basis_y)
+
+        result[:, 0] = _angles_between(basis_x, self._init_basis_x) * _RAD2DEG
+        result[:, 1] = _angles_between(basis_y, self._init_basis_y) * _RAD2DEG
+        result[:, 2] = _angles_between(basis_z, self._init_basis_z) * _RAD2DEG
+
+        acceleration = (acc - gravity_f) * dt
+        vx, vy, vz = self.velocity
+        px, py, pz = self.world_pos
+        half_dt = dt / 2
+        coordinates = []
+        for ax, ay, az in acceleration.tolist():
+            nvx, nvy, nvz = vx + ax, vy + ay, vz + az
+            px += (vx + nvx) * half_dt
+            py += (vy + nvy) * half_dt
+            pz += (vz + nvz) * half_dt
+            coordinates.append((px, py, pz))
+            vx, vy, vz = nvx * 0.99, nvy * 0.99, nvz * 0.99
+        result[:, 3:] = coordinates
+
+        self._gravity[:] = gravity_a[-1]
+        self.basis_x[:] = basis_x[-1]
+        self.basis_y[:] = basis_y[-1]
+        self.basis_z[:] = basis_z[-1]
+        self.velocity[:] = vx, vy, vz
+        self.world_pos[:] = px, py, pz
+        return result
 
     @property
     def angles(self):
+        # initial basis is the identity, so the cosine with it is simply
+        # the matching component of the normalized current basis vector
+        bx, by, bz = self.basis_x, self.basis_y, self.basis_z
         return (
-            _angle_between(self.basis_x, self._init_basis_x) * _RAD2DEG,
-            _angle_between(self.basis_y, self._init_basis_y) * _RAD2DEG,
-            _angle_between(self.basis_z, self._init_basis_z) * _RAD2DEG,
+            acos(max(-1.0, min(1.0, bx[0] / dist(*bx)))) * _RAD2DEG,
+            acos(max(-1.0, min(1.0, by[1] / dist(*by)))) * _RAD2DEG,
+            acos(max(-1.0, min(1.0, bz[2] / dist(*bz)))) * _RAD2DEG,
         )
 
     @property
     def coordinates(self):
-        return self.world_pos
+        return tuple(self.world_pos)
 
 
 def dist(*args):
@@ -135,72 +290,66 @@ def get_z_angle(vector):
     return -atan2(z, dist(x, y))
 
 
-def _add(*vectors):
-    return tuple(sum(xs) for xs in zip(*vectors))
-
-
 def _sub(v1, v2):
     return tuple(x1 - x2 for x1, x2 in zip(v1, v2))
 
 
-def _mul(v, k):
-    return tuple(k * x for x in v)
-
-
-def _dot(v1, v2):
-    return sum(x1 * x2 for x1, x2 in zip(v1, v2))
-
-
-def _cross(v1, v2):
-    x1, y1, z1 = v1
-    x2, y2, z2 = v2
-    return y1*z2-z1*y2, z1*x2-x1*z2, x1*y2-y1*x2
-
-
-def _norm(vector, with_d=False):
-    d = dist(*vector)
-    if d > 0.00001:
-        vector = _mul(vector, 1/d)
-    if with_d:
-        return vector, d
-    else:
-        return vector
-
-
-def _rotate(vector, axis, angle):
-    axis, d = _norm(axis, with_d=True)
-    if d < 0.00001:
-        return vector
-
-    rotbasis_y = -axis[1], axis[0], 0
-    if dist(*rotbasis_y) < 0.2:
-        rotbasis_y = 0, axis[2], -axis[1]
-    rotbasis_y = _norm(rotbasis_y)
-    rotbasis_z = _cross(axis, rotbasis_y)
-
-    b_x = _dot(vector, axis)
-    b_y = _dot(vector, rotbasis_y)
-    b_z = _dot(vector, rotbasis_z)
-
-    cos_a = cos(angle)
-    sin_a = sin(angle)
-
-    a_y = cos_a * b_y - sin_a * b_z
-    a_z = cos_a * b_z + sin_a * b_y
-
-    return _add(_mul(axis, b_x), _mul(rotbasis_y, a_y), _mul(rotbasis_z, a_z))
-
-
-def _gyro_to_angleaxis(gyro):
-    angle = dist(*gyro)
-    if angle < 0.00001:
-        return 0, _X_AXIS
-    axis = _mul(gyro, -1/angle)
-    return angle, axis
-
-
-def _angle_between(v1, v2):
-    return acos(_dot(v1, v2) / (dist(*v1) * dist(*v2)))
+def _set_rotation(matrix, x, y, z, angle):
+    # Rodrigues rotation matrix around unit axis (x, y, z), written in place
+    c = cos(angle)
+    s = sin(angle)
+    t = 1 - c
+    matrix[0] = c + t * x * x
+    matrix[1] = t * x * y - s * z
+    matrix[2] = t * x * z + s * y
+    matrix[3] = t * y * x + s * z
+    matrix[4] = c + t * y * y
+    matrix[5] = t * y * z - s * x
+    matrix[6] = t * z * x - s * y
+    matrix[7] = t * z * y + s * x
+    matrix[8] = c + t * z * z
+
+
+def _apply_rotation(matrix, vector):
+    # rotates 3-item list in place
+    m0, m1, m2, m3, m4, m5, m6, m7, m8 = matrix
+    x, y, z = vector
+    vector[0] = m0 * x + m1 * y + m2 * z
+    vector[1] = m3 * x + m4 * y + m5 * z
+    vector[2] = m6 * x + m7 * y + m8 * z
+
+
+def _rotation_matrices(rotvecs):
+    # Rodrigues formula for an (N, 3) array of rotation vectors, same
+    # layout as `_set_rotation`
+    import numpy as np
+    angles = np.sqrt((rotvecs * rotvecs).sum(axis=1))
+    safe = np.where(angles < 0.00001, 1.0, angles)
+    kx, ky, kz = (rotvecs / safe[:, None]).T
+    c = np.cos(angles)
+    s = np.sin(angles)
+    t = 1 - c
+    result = np.empty((len(rotvecs), 3, 3))
+    result[:, 0, 0] = c + t * kx * kx
+    result[:, 0, 1] = t * kx * ky - s * kz
+    result[:, 0, 2] = t * kx * kz + s * ky
+    result[:, 1, 0] = t * ky * kx + s * kz
+    result[:, 1, 1] = c + t * ky * ky
+    result[:, 1, 2] = t * ky * kz - s * kx
+    result[:, 2, 0] = t * kz * kx - s * ky
+    result[:, 2, 1] = t * kz * ky + s * kx
+    result[:, 2, 2] = c + t * kz * kz
+    return result
+
+
+def _angles_between(v1, v2):
+    # angles between rows of (N, 3) arrays; v2 may be a single vector
+    import numpy as np
+    v1 = np.asarray(v1)
+    v2 = np.asarray(v2)
+    dots = (v1 * v2).sum(axis=-1)
+    norms = np.sqrt((v1 * v1).sum(axis=-1) * (v2 * v2).sum(axis=-1))
+    return np.arccos(np.clip(dots / norms, -1.0, 1.0))
 
 
 def _fmt(vector):
@@ -210,6 +359,7 @@ _ZERO = 0.0, 0.0, 0.0
 _X_AXIS = 1.0, 0.0, 0.0
 _Y_AXIS = 0.0, 1.0, 0.0
 _Z_AXIS = 0.0, 0.0, 1.0
+_IDENTITY = 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0
 
 _DEG2RAD = pi / 180.0
 _RAD2DEG = 180.0 / pi
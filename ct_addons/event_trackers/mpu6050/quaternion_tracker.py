@@ -0,0 +1,168 @@
+import logging
+from math import sqrt, acos
+from ct_addons.event_trackers.mpu6050.motion_tracker import (
+    dist, _sub, _fmt, _ZERO, _DEG2RAD, _RAD2DEG,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class QuaternionMotionTracker(object):
+    """Drop-in alternative to `MotionTracker` keeping a unit quaternion.
+
+    Orientation is integrated from the gyro as a quaternion and pulled
+    towards the accelerometer gravity direction Mahony-style, with
+    `1 - rot_decay` as the proportional gain, so `time_term` has the same
+    meaning as for `MotionTracker`. A sample costs two quaternion products
+    and no trigonometry; `angles` are derived from the quaternion on demand.
+    """
+
+    def __init__(self, time_term, read_interval, bufsize=20, accel_offsets=(0, 0, 0)):
+        self.time_term = float(time_term)
+        self.rot_decay = self.time_term / (time_term + read_interval)
+        self.bufsize = bufsize
+        self.dt = read_interval
+        self.world_pos = _ZERO
+        self.velocity = _ZERO
+
+        # rotation from the calibration frame to the current sensor frame
+        self._qw, self._qx, self._qy, self._qz = 1.0, 0.0, 0.0, 0.0
+
+        self._calibration_state = False
+        self._init_gravity = _ZERO
+        self._init_gravity_value = 0
+        self._gyro_offs = _ZERO
+        self._calibration_sums = None
+        self._calibration_n = 0
+
+        self._acc_offs = accel_offsets
+
+    def start_calibration(self):
+        self._calibration_state = True
+        self._calibration_sums = [0, 0, 0, 0, 0, 0]
+        self._calibration_n = 0
+
+    def finish_calibration(self):
+        self._calibration_state = False
+        calib_means = [x / self._calibration_n for x in self._calibration_sums]
+        self._gyro_offs = tuple(calib_means[3:])
+        self._init_gravity = _sub(calib_means[:3], self._acc_offs)
+        self._init_gravity_value = dist(*self._init_gravity)
+
+        self._qw, self._qx, self._qy, self._qz = 1.0, 0.0, 0.0, 0.0
+        self.world_pos = _ZERO
+        self.velocity = _ZERO
+
+        log.info('gyro offsets = ({})'.format(_fmt(self._gyro_offs)))
+        log.info('accelerometer offsets = ({})'.format(_fmt(self._acc_offs)))
+        log.info('gravity value = {:.3f}'.format(self._init_gravity_value))
+
+    def add_data(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=None):
+        if self._calibration_state:
+            data_tuple = acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z
+            for i in range(len(data_tuple)):
+                self._calibration_sums[i] += data_tuple[i]
+            self._calibration_n += 1
+            return
+
+        if dt is None:
+            dt = self.dt
+            hpf = self.rot_decay
+        else:
+            hpf = self.time_term / (self.time_term + dt)
+        lpf = 1 - hpf
+        gyro_offs = self._gyro_offs
+        acc_offs = self._acc_offs
+        ax = acc_x - acc_offs[0]
+        ay = acc_y - acc_offs[1]
+        az = acc_z - acc_offs[2]
+
+        # world vectors seen from the sensor turn opposite to the sensor
+        k = -0.5 * dt * _DEG2RAD
+        rx = k * (gyro_x - gyro_offs[0])
+        ry = k * (gyro_y - gyro_offs[1])
+        rz = k * (gyro_z - gyro_offs[2])
+        qw, qx, qy, qz = self._qw, self._qx, self._qy, self._qz
+        qw, qx, qy, qz = (
+            qw - rx * qx - ry * qy - rz * qz,
+            qx + rx * qw + ry * qz - rz * qy,
+            qy - rx * qz + ry * qw + rz * qx,
+            qz + rx * qy - ry * qx + rz * qw,
+        )
+
+        # gravity predicted by the gyro, in the sensor frame
+        g0 = self._init_gravity_value
+        gx, gy, gz = self._init_gravity
+        tx = 2 * (qy * gz - qz * gy)
+        ty = 2 * (qz * gx - qx * gz)
+        tz = 2 * (qx * gy - qy * gx)
+        px = gx + qw * tx + qy * tz - qz * ty
+        py = gy + qw * ty + qz * tx - qx * tz
+        pz = gz + qw * tz + qx * ty - qy * tx
+
+        # pull the prediction towards measured gravity
+        acc_d = sqrt(ax * ax + ay * ay + az * az)
+        k = 0.5 * lpf / (g0 * acc_d)
+        rx = k * (py * az - pz * ay)
+        ry = k * (pz * ax - px * az)
+        rz = k * (px * ay - py * ax)
+        qw, qx, qy, qz = (
+            qw - rx * qx - ry * qy - rz * qz,
+            qx + rx * qw + ry * qz - rz * qy,
+            qy - rx * qz + ry * qw + rz * qx,
+            qz + rx * qy - ry * qx + rz * qw,
+        )
+        n = 1 / sqrt(qw * qw + qx * qx + qy * qy + qz * qz)
+        self._qw, self._qx, self._qy, self._qz = qw * n, qx * n, qy * n, qz * n
+
+        k = g0 / acc_d
+        gfx = (ax * k) * lpf + px * hpf
+        gfy = (ay * k) * lpf + py * hpf
+        gfz = (az * k) * lpf + pz * hpf
+
+        vx, vy, vz = self.velocity
+        nvx = vx + (ax - gfx) * dt
+        nvy = vy + (ay - gfy) * dt
+        nvz = vz + (az - gfz) * dt
+        wx, wy, wz = self.world_pos
+        half_dt = dt / 2
+        self.world_pos = (
+            wx + (vx + nvx) * half_dt,
+            wy + (vy + nvy) * half_dt,
+            wz + (vz + nvz) * half_dt,
+        )
+        self.velocity = nvx * 0.99, nvy * 0.99, nvz * 0.99
+
+    def add_batch(self, block):
+        """Same contract as `MotionTracker.add_batch`, computed per sample:
+        the filter is recursive and has no vectorized form, so a batch
+        saves only the generator's per-sample overhead."""
+        import numpy as np
+        block = np.asarray(block, dtype=float).reshape(-1, 6)
+        if self._calibration_state:
+            for item in block.tolist():
+                self.add_data(*item)
+            return None
+        # rows of a list, NumPy item assignment costs more than the filter
+        rows = []
+        for item in block.tolist():
+            self.add_data(*item)
+            rows.append(self.angles + self.world_pos)
+        return np.array(rows).reshape(-1, 6)
+
+    @property
+    def angles(self):
+        # diagonal of the rotation matrix is the cosine between every
+        # current basis vector and the initial one
+        qw, qx, qy, qz = self._qw, self._qx, self._qy, self._qz
+        xx, yy, zz = qx * qx, qy * qy, qz * qz
+        return (
+            acos(max(-1.0, min(1.0, 1 - 2 * (yy + zz)))) * _RAD2DEG,
+            acos(max(-1.0, min(1.0, 1 - 2 * (xx + zz)))) * _RAD2DEG,
+            acos(max(-1.0, min(1.0, 1 - 2 * (xx + yy)))) * _RAD2DEG,
+        )
+
+    @property
+    def coordinates(self):
+        return self.world_pos
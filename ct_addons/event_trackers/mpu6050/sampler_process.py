@@ -0,0 +1,181 @@
+"""Sampling in a process of its own.
+
+Sampling threads share the GIL with everything else the daemon does:
+encoding and sending events, logging, debug clients and filters, so a
+busy daemon delays samples. A `SamplerProcess` runs the sampling loop, and
+optionally the filters, in a child process instead. The child publishes
+items into a `SharedRing` which the daemon reads straight from shared
+memory, without pickling them or passing them through a pipe.
+"""
+from __future__ import absolute_import
+import ctypes
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class SharedRing(object):
+    """Ring of the latest `size` rows of `width` floats in shared memory,
+    written by one process and read by another.
+
+    A row is written in place and then published by advancing the
+    sequence number. Only that number is accessed under a lock, so the
+    writer never waits for a reader copying rows, and the reader doesn't
+    see a new sequence number before its row, even on weakly ordered CPUs.
+    A reader more than `size` rows behind loses the oldest ones.
+    """
+
+    def __init__(self, size, width):
+        self.size = size
+        self.width = width
+        self._rows = multiprocessing.RawArray(ctypes.c_double, size * width)
+        self._seq = multiprocessing.RawValue(ctypes.c_ulonglong, 0)
+        self._closed = multiprocessing.RawValue(ctypes.c_bool, False)
+        self._lock = multiprocessing.Lock()
+
+    def append(self, row):
+        # the writer is the only one to change the sequence number
+        seq = self._seq.value
+        start = seq % self.size * self.width
+        self._rows[start:start + self.width] = row
+        with self._lock:
+            self._seq.value = seq + 1
+
+    def close(self):
+        with self._lock:
+            self._closed.value = True
+
+    @property
+    def closed(self):
+        with self._lock:
+            return self._closed.value
+
+    def read(self, position):
+        """Returns (rows written since `position`, new position, number of
+        rows lost), rows as tuples."""
+        with self._lock:
+            seq = self._seq.value
+        lost = max(0, seq - self.size - position)
+        position += lost
+        size, width = self.size, self.width
+        values = []
+        start = position % size
+        end = start + seq - position
+        if end > size:
+            values.extend(self._rows[start * width:size * width])
+            start, end = 0, end - size
+        values.extend(self._rows[start * width:end * width])
+        rows = [tuple(values[i:i + width]) for i in range(0, len(values), width)]
+        # rows overwritten while they were copied are dropped too, the
+        # slot of the row being written right now included
+        with self._lock:
+            overwritten = self._seq.value + 1 - size - position
+        if overwritten > 0:
+            del rows[:overwritten]
+            lost += min(overwritten, seq - position)
+        return rows, seq, lost
+
+
+class SamplerProcess(object):
+    """Runs a sample source in a child process, see the module doc.
+
+    `make_source(stopped)` is called in the child and returns an iterator
+    of (sensor number, item) pairs, items of `width` floats, that ends
+    once `stopped` is set; `timing` is its scheduler, if it has one.
+    `samples` yields the pairs in this process and keeps `last_dt`, the
+    real interval before the latest item, so the process can stand in for
+    the scheduler as `timing` of a filter.
+
+    The child ignores SIGINT; it stops with the daemon's `stopped` event,
+    on `close` or when the daemon dies.
+    """
+
+    def __init__(self, make_source, width, dt, stopped, timing=None,
+                 ring_size=4096, poll_interval=0.005, name='mpu6050-sampler'):
+        self.dt = dt
+        self.last_dt = dt
+        self.poll_interval = poll_interval
+        self.overruns = 0
+        self._make_source = make_source
+        self._timing = timing
+        self._stopped = stopped
+        self._child_stopped = multiprocessing.Event()
+        # rows are (sensor number, interval) followed by the item
+        self._ring = SharedRing(ring_size, width + 2)
+        self._process = multiprocessing.Process(target=self._child_run, name=name)
+        self._process.daemon = True
+
+    def start(self):
+        self._process.start()
+        log.info('started sampling process %s (%s)', self._process.name,
+                 self._process.pid)
+
+    def samples(self):
+        ring = self._ring
+        position = 0
+        while True:
+            if self._stopped.isSet():
+                self._child_stopped.set()
+            # checked before reading, so that the last rows aren't missed
+            finished = ring.closed or not self._process.is_alive()
+            rows, position, lost = ring.read(position)
+            if lost:
+                self.overruns += lost
+                log.warning('%s: %d samples lost, reading them is too slow',
+                            self._process.name, lost)
+            for row in rows:
+                self.last_dt = row[1]
+                yield int(row[0]), row[2:]
+            if not rows:
+                if finished:
+                    break
+                time.sleep(self.poll_interval)
+
+    def close(self, timeout=2.0):
+        self._child_stopped.set()
+        self._process.join(timeout)
+        if self._process.is_alive():
+            log.warning('sampling process %s is still running, terminating it',
+                        self._process.name)
+            self._process.terminate()
+            self._process.join()
+
+    def _child_run(self):
+        # the daemon stops sampling, not Ctrl-C of the whole process group
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        parent = os.getppid()
+        check_parent_at = time.time() + 1
+        ring = self._ring
+        timing = self._timing
+        try:
+            for i, item in self._make_source(_ThreadingEvent(self._child_stopped)):
+                dt = self.dt if timing is None else timing.last_dt
+                ring.append((i, dt) + tuple(item))
+                if time.time() > check_parent_at:
+                    check_parent_at = time.time() + 1
+                    if os.getppid() != parent:
+                        log.warning('daemon is gone, stopping sampling')
+                        self._child_stopped.set()
+        except:
+            log.exception('sampling process got an error')
+        finally:
+            ring.close()
+        log.info('sampling process finished')
+
+
+class _ThreadingEvent(object):
+    # multiprocessing event with the `threading.Event` spelling of generators
+
+    def __init__(self, event):
+        self._event = event
+
+    def isSet(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
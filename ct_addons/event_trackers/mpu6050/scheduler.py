@@ -0,0 +1,82 @@
+import collections
+import time
+import logging
+from ct_addons.clock import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+class DeadlineScheduler(object):
+    """Paces a sampling loop by absolute deadlines on a monotonic clock.
+
+    Deadlines are `start + n * dt`, so sleep inaccuracy does not accumulate
+    into drift. When a tick is late by a whole period or more, `policy`
+    decides how to catch up:
+
+    * `skip` - drop missed deadlines and continue on the original grid
+    * `burst` - keep all deadlines, late ticks are returned back to back
+    * `stretch` - restart the grid from now, i.e. that period gets longer
+    """
+
+    POLICIES = ('skip', 'burst', 'stretch')
+
+    def __init__(self, dt, policy='skip', history=1000, clock=monotonic, sleep=time.sleep):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown catch-up policy: {}".format(policy))
+        self.dt = dt
+        self.policy = policy
+        self.last_dt = dt
+        self.ticks = 0
+        self.overruns = 0
+        self.missed_ticks = 0
+        self._clock = clock
+        self._sleep = sleep
+        self._jitter = collections.deque(maxlen=history)
+        self._started_at = None
+        self._last_tick = None
+        self._deadline = None
+
+    def wait(self):
+        """Blocks until next deadline, returns real time since previous tick."""
+        now = self._clock()
+        if self._deadline is None:
+            self._started_at = self._last_tick = self._deadline = now
+            self.ticks += 1
+            return self.last_dt
+
+        dt = self.dt
+        self._deadline += dt
+        delay = self._deadline - now
+        if delay > 0:
+            self._sleep(delay)
+            now = self._clock()
+        elif -delay >= dt:
+            self.overruns += 1
+            if self.policy == 'skip':
+                missed = int(-delay // dt)
+                self.missed_ticks += missed
+                self._deadline += missed * dt
+            elif self.policy == 'stretch':
+                self._deadline = now
+        self._jitter.append(now - self._deadline)
+        self.last_dt = now - self._last_tick
+        self._last_tick = now
+        self.ticks += 1
+        return self.last_dt
+
+    def stats(self):
+        jitter = sorted(self._jitter)
+        result = {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'missed_ticks': self.missed_ticks,
+            'nominal_rate': 1 / self.dt,
+            'effective_rate': 0.0,
+        }
+        if self.ticks > 1 and self._last_tick > self._started_at:
+            result['effective_rate'] = (self.ticks - 1) / (self._last_tick - self._started_at)
+        for p in (50, 90, 99):
+            value = jitter[min(len(jitter) - 1, len(jitter) * p // 100)] if jitter else 0.0
+            result['jitter_p{}_ms'.format(p)] = value * 1000
+        return result
@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+import struct
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+# register map, see MPU-6000/MPU-6050 Register Map and Descriptions
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+GYRO_CONFIG = 0x1B
+ACCEL_CONFIG = 0x1C
+FIFO_EN = 0x23
+INT_STATUS = 0x3A
+ACCEL_XOUT_H = 0x3B
+USER_CTRL = 0x6A
+FIFO_COUNT_H = 0x72
+FIFO_R_W = 0x74
+
+FIFO_EN_ALL = 0xF8  # temperature, gyro x/y/z, accel
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+INT_STATUS_FIFO_OFLOW = 0x10
+DLPF_CFG_184HZ = 0x01  # also switches gyro output rate to 1 kHz
+
+FIFO_SIZE = 1024
+GRAVITY_MS2 = 9.80665
+
+# accel x/y/z, temperature, gyro x/y/z; same layout in data registers
+# and in FIFO when all of them are enabled in FIFO_EN
+_SAMPLE = struct.Struct('>7h')
+SAMPLE_SIZE = _SAMPLE.size
+
+# SMBus block transfers are limited to 32 bytes
+_BLOCK_SAMPLES = 32 // SAMPLE_SIZE
+
+_ACCEL_SCALES = {0x00: 16384.0, 0x08: 8192.0, 0x10: 4096.0, 0x18: 2048.0}
+_GYRO_SCALES = {0x00: 131.0, 0x08: 65.5, 0x10: 32.8, 0x18: 16.4}
+
+
+def fifo_interval(dt):
+    """Interval the sensor samples into its FIFO at when asked for `dt`,
+    a whole number of milliseconds of the 1 kHz gyro output rate."""
+    return max(1, min(256, int(round(dt * 1000)))) / 1000.0
+
+
+class Mpu6050Reader(object):
+    """Reads all MPU6050 data registers in one I2C block transaction.
+
+    Items are tuples of accelerometer x/y/z (m/s^2), gyro x/y/z (deg/s) and
+    temperature (C), same as values returned by the `mpu6050` driver.
+    """
+
+    def __init__(self, address=0x68, bus=1):
+        from mpu6050 import mpu6050
+        # driver takes care of opening the bus and waking the chip up
+        self.sensor = mpu6050(address, bus)
+        self.bus = self.sensor.bus
+        self.address = address
+        self._accel_k = None
+        self._gyro_k = None
+        self.fifo_dt = None
+
+    def read(self):
+        if self._accel_k is None:
+            self._read_ranges()
+        raw = self.bus.read_i2c_block_data(self.address, ACCEL_XOUT_H, SAMPLE_SIZE)
+        return self._convert(bytearray(raw))
+
+    def start_fifo(self, dt):
+        """Lets the sensor sample into its FIFO every `dt` seconds.
+
+        Actual interval is rounded to whole milliseconds and is available
+        as `fifo_dt`.
+        """
+        self._read_ranges()
+        self.fifo_dt = fifo_interval(dt)
+        divider = int(round(self.fifo_dt * 1000)) - 1
+        write = self.bus.write_byte_data
+        write(self.address, USER_CTRL, 0)
+        write(self.address, FIFO_EN, 0)
+        write(self.address, CONFIG, DLPF_CFG_184HZ)
+        write(self.address, SMPLRT_DIV, divider)
+        self.reset_fifo()
+        write(self.address, FIFO_EN, FIFO_EN_ALL)
+        log.info('MPU6050 FIFO enabled, sample interval %.3f sec', self.fifo_dt)
+
+    def stop_fifo(self):
+        self.bus.write_byte_data(self.address, FIFO_EN, 0)
+        self.bus.write_byte_data(self.address, USER_CTRL, 0)
+        self.fifo_dt = None
+
+    def reset_fifo(self):
+        self.bus.write_byte_data(self.address, USER_CTRL, USER_CTRL_FIFO_RESET)
+        self.bus.write_byte_data(self.address, USER_CTRL, USER_CTRL_FIFO_EN)
+
+    def read_fifo(self):
+        """Returns list of all complete samples currently in the FIFO."""
+        status = self.bus.read_byte_data(self.address, INT_STATUS)
+        if status & INT_STATUS_FIFO_OFLOW:
+            # sample boundaries are lost after overflow, start over
+            log.warning('MPU6050 FIFO overflow, resetting')
+            self.reset_fifo()
+            return []
+        count_h, count_l = self.bus.read_i2c_block_data(self.address, FIFO_COUNT_H, 2)
+        n_samples = ((count_h << 8) | count_l) // SAMPLE_SIZE
+        items = []
+        while n_samples > 0:
+            n = min(n_samples, _BLOCK_SAMPLES)
+            raw = bytearray(self.bus.read_i2c_block_data(
+                self.address, FIFO_R_W, n * SAMPLE_SIZE
+            ))
+            for offset in range(0, len(raw), SAMPLE_SIZE):
+                items.append(self._convert(raw, offset))
+            n_samples -= n
+        return items
+
+    def _read_ranges(self):
+        accel_range = self.bus.read_byte_data(self.address, ACCEL_CONFIG) & 0x18
+        gyro_range = self.bus.read_byte_data(self.address, GYRO_CONFIG) & 0x18
+        self._accel_k = GRAVITY_MS2 / _ACCEL_SCALES[accel_range]
+        self._gyro_k = 1 / _GYRO_SCALES[gyro_range]
+
+    def _convert(self, raw, offset=0):
+        ax, ay, az, temp, gx, gy, gz = _SAMPLE.unpack_from(raw, offset)
+        ak = self._accel_k
+        gk = self._gyro_k
+        return ax * ak, ay * ak, az * ak, gx * gk, gy * gk, gz * gk, temp / 340.0 + 36.53
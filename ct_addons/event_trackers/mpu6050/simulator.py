@@ -0,0 +1,251 @@
+"""Simulated MPU6050 for running the daemon without the sensor."""
+from __future__ import absolute_import
+import logging
+import math
+import random
+from ct_addons.clock import monotonic
+from ct_addons.event_trackers.mpu6050.sensor import GRAVITY_MS2
+
+
+log = logging.getLogger(__name__)
+
+
+# resolution and range of the default +-2g and +-250 deg/s settings
+ACCEL_K = GRAVITY_MS2 / 16384.0
+GYRO_K = 1 / 131.0
+TEMP_K = 1 / 340.0
+INT16_MAX = 32767
+
+
+class SimulatedMpu6050(object):
+    """Stand-in for `Mpu6050Reader` reading physically plausible motion.
+
+    The device rests, tilts away and back, spins and takes shocks, the
+    accelerometer sees gravity in the current orientation plus linear
+    acceleration, the gyro the angular rate plus a drifting bias, and the
+    temperature ramps between random targets. Readings get sensor noise,
+    `accel_offsets` and the resolution and saturation of the default
+    ranges. The device stays still for `still_for` seconds first, for
+    calibration.
+
+    `read` advances the simulation by the `clock` time since the previous
+    read. With `start_fifo`, `read_fifo` returns a sample for every `dt`
+    elapsed; unlike the chip's, this FIFO has no size limit nor a 1 kHz
+    cap, so rates of several kHz can be used for load testing.
+    """
+
+    ACCEL_NOISE = 0.03  # m/s^2
+    GYRO_NOISE = 0.05  # deg/s
+    TEMP_NOISE = 0.02  # C
+    GYRO_DRIFT = 0.02  # deg/s per sqrt(s)
+    MAX_STEP = 0.001  # s, longest integration step in `read`
+
+    # (kind, weight)
+    EPISODES = (('still', 4), ('tilt', 3), ('spin', 2), ('shock', 1))
+
+    def __init__(self, accel_offsets=(0.0, 0.0, 0.0), seed=None, still_for=10.0,
+                 clock=monotonic):
+        self.accel_offsets = tuple(accel_offsets)
+        self.clock = clock
+        self.fifo_dt = None
+        self._random = random.Random(seed)
+        self._t = 0.0
+        # body to world rotation, w x y z
+        self._q = (1.0, 0.0, 0.0, 0.0)
+        self._bias = [self._random.uniform(-2, 2) for _ in range(3)]
+        self._temp = 25.0
+        self._temp_target = 25.0
+        self._temp_rate = 0.0
+        self._temp_hold_until = still_for
+        self._episode = self._still
+        self._episode_start = 0.0
+        self._episode_end = still_for
+        self._params = {}
+        # body angular rate (deg/s), world linear acceleration (m/s^2)
+        self._omega = (0.0, 0.0, 0.0)
+        self._linear = (0.0, 0.0, 0.0)
+        self._last_read_at = None
+        self._fifo_at = None
+
+    def read(self):
+        now = self.clock()
+        if self._last_read_at is not None:
+            elapsed = now - self._last_read_at
+            while elapsed > self.MAX_STEP:
+                self._step(self.MAX_STEP)
+                elapsed -= self.MAX_STEP
+            self._step(elapsed)
+        self._last_read_at = now
+        return self._sample()
+
+    def start_fifo(self, dt):
+        self.fifo_dt = dt
+        self._fifo_at = self.clock()
+        log.info('simulated MPU6050 FIFO enabled, sample interval %.6f sec', dt)
+
+    def stop_fifo(self):
+        self.fifo_dt = None
+
+    def reset_fifo(self):
+        self._fifo_at = self.clock()
+
+    def read_fifo(self):
+        n_samples = int((self.clock() - self._fifo_at) / self.fifo_dt)
+        self._fifo_at += n_samples * self.fifo_dt
+        items = []
+        for _ in range(n_samples):
+            self._step(self.fifo_dt)
+            items.append(self._sample())
+        return items
+
+    def _step(self, dt):
+        self._t += dt
+        while self._t >= self._episode_end:
+            self._next_episode()
+        self._omega, self._linear = self._episode(self._t - self._episode_start)
+        wx, wy, wz = [math.radians(w) for w in self._omega]
+        self._q = _normalize(_multiply(self._q, _rotation(wx * dt, wy * dt, wz * dt)))
+        drift = self.GYRO_DRIFT * math.sqrt(dt)
+        self._bias = [b + self._random.gauss(0, drift) for b in self._bias]
+        self._step_temperature(dt)
+
+    def _sample(self):
+        gauss = self._random.gauss
+        lx, ly, lz = self._linear
+        # accelerometer measures reaction to gravity plus acceleration
+        ax, ay, az = _rotate(_conjugate(self._q), (lx, ly, lz + GRAVITY_MS2))
+        ox, oy, oz = self.accel_offsets
+        accel = [_quantize(a + o + gauss(0, self.ACCEL_NOISE), ACCEL_K)
+                 for a, o in ((ax, ox), (ay, oy), (az, oz))]
+        gyro = [_quantize(w + b + gauss(0, self.GYRO_NOISE), GYRO_K)
+                for w, b in zip(self._omega, self._bias)]
+        temp = round((self._temp + gauss(0, self.TEMP_NOISE)) / TEMP_K) * TEMP_K
+        return tuple(accel) + tuple(gyro) + (temp,)
+
+    def _step_temperature(self, dt):
+        if self._temp_rate == 0.0:
+            if self._t >= self._temp_hold_until:
+                # ramps sometimes leave the tracker's default 15..45 C
+                self._temp_target = self._random.uniform(5, 55)
+                rate = self._random.uniform(0.02, 0.3)
+                self._temp_rate = rate if self._temp_target > self._temp else -rate
+            return
+        self._temp += self._temp_rate * dt
+        if (self._temp_rate > 0) == (self._temp >= self._temp_target):
+            self._temp = self._temp_target
+            self._temp_rate = 0.0
+            self._temp_hold_until = self._t + self._random.uniform(10, 60)
+
+    def _next_episode(self):
+        rnd = self._random
+        total = sum(weight for _, weight in self.EPISODES)
+        pick = rnd.uniform(0, total)
+        for kind, weight in self.EPISODES:
+            pick -= weight
+            if pick <= 0:
+                break
+        self._episode_start = self._episode_end
+        if kind == 'still':
+            duration = rnd.uniform(1, 6)
+            self._params = {}
+        elif kind == 'tilt':
+            # away about a horizontal body axis, hold, and back
+            heading = rnd.uniform(0, 2 * math.pi)
+            move = rnd.uniform(0.3, 2)
+            hold = rnd.uniform(0.5, 5)
+            self._params = {
+                'axis': (math.cos(heading), math.sin(heading), 0.0),
+                'angle': rnd.uniform(10, 70) * rnd.choice((-1, 1)),
+                'move': move,
+                'hold': hold,
+            }
+            duration = 2 * move + hold
+        elif kind == 'spin':
+            duration = rnd.uniform(0.5, 3)
+            self._params = {
+                'axis': (0.0, 0.0, 1.0),
+                'angle': rnd.uniform(30, 360) * rnd.choice((-1, 1)),
+                'move': duration,
+                'hold': 0.0,
+            }
+        else:
+            duration = 0.4
+            heading = rnd.uniform(0, 2 * math.pi)
+            amplitude = rnd.uniform(5, 40)
+            self._params = {
+                'accel': (amplitude * math.cos(heading),
+                          amplitude * math.sin(heading),
+                          rnd.uniform(-0.3, 0.3) * amplitude),
+                'frequency': rnd.uniform(15, 60),
+                'decay': rnd.uniform(0.03, 0.1),
+                'rate': rnd.uniform(5, 50),
+            }
+        self._episode = getattr(self, '_' + kind)
+        self._episode_end = self._episode_start + duration
+
+    def _still(self, t):
+        return (0.0, 0.0, 0.0), (0.0, 0.0, 0.0)
+
+    def _tilt(self, t):
+        # rate follows half a sine wave, so the angle is reached smoothly
+        params = self._params
+        move, hold = params['move'], params['hold']
+        if t < move:
+            sign = 1
+        elif t < move + hold:
+            return (0.0, 0.0, 0.0), (0.0, 0.0, 0.0)
+        else:
+            sign = -1
+            t -= move + hold
+        rate = sign * params['angle'] * math.pi / (2 * move) * math.sin(math.pi * t / move)
+        return tuple(a * rate for a in params['axis']), (0.0, 0.0, 0.0)
+
+    # a spin is a tilt about the vertical axis that ends before return
+    _spin = _tilt
+
+    def _shock(self, t):
+        # decaying oscillation in a horizontal direction, with some wobble
+        params = self._params
+        envelope = math.exp(-t / params['decay'])
+        wave = envelope * math.cos(2 * math.pi * params['frequency'] * t)
+        wobble = params['rate'] * envelope * math.sin(2 * math.pi * params['frequency'] * t)
+        return ((wobble, -wobble, 0.0),
+                tuple(a * wave for a in params['accel']))
+
+
+def _quantize(value, k):
+    return max(-INT16_MAX - 1, min(INT16_MAX, int(round(value / k)))) * k
+
+
+def _multiply(a, b):
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    )
+
+
+def _conjugate(q):
+    return q[0], -q[1], -q[2], -q[3]
+
+
+def _normalize(q):
+    norm = math.sqrt(sum(x * x for x in q))
+    return tuple(x / norm for x in q)
+
+
+def _rotation(x, y, z):
+    # quaternion of rotation by vector (x, y, z) in radians
+    angle = math.sqrt(x * x + y * y + z * z)
+    if angle < 1e-12:
+        return 1.0, 0.0, 0.0, 0.0
+    k = math.sin(angle / 2) / angle
+    return math.cos(angle / 2), x * k, y * k, z * k
+
+
+def _rotate(q, v):
+    _, x, y, z = _multiply(_multiply(q, (0.0,) + tuple(v)), _conjugate(q))
+    return x, y, z
@@ -0,0 +1,138 @@
+"""Sliding window vibration features of the acceleration.
+
+Features are taken from the acceleration less its centered moving
+average, which removes gravity and its slow changes as the device turns,
+and combine the three axes so that they don't depend on orientation.
+They are channels of epoch rules, see `FEATURES`.
+"""
+from __future__ import absolute_import
+
+
+# channels of every sample, over the window ending at it:
+# - vib_rms: RMS of the acceleration around its mean, m/s^2
+# - vib_peak: largest distances from the mean of every axis combined, m/s^2
+# - vib_crest: crest factor, peak / rms
+# - vib_low, vib_mid, vib_high: mean square below, between and above the
+#   two band edges, (m/s^2)^2, of the latest spectrum
+FEATURES = ('vib_rms', 'vib_peak', 'vib_crest', 'vib_low', 'vib_mid', 'vib_high')
+
+
+class VibrationFeatures(object):
+    """`FEATURES` of one sensor over the latest `window` seconds of samples
+    taken every `dt` seconds, needs NumPy.
+
+    `update` takes an array of (accx, accy, accz) rows, and returns an
+    array with the features of each sample. Samples are first detrended
+    by their average over `detrend` seconds around them, so features lag
+    by half of that. Mean and RMS come from running
+    sums. The peak comes from a sliding maximum and minimum in the manner
+    of van Herk and Gil-Werman: running extremes of the current block of
+    window size, and extremes from every offset to the end of the previous
+    block. Both cost O(1) per sample and axis and are vectorized over the
+    rows. Band energies come from an FFT of the window once `hop` samples,
+    a quarter window by default, have been added since the previous one,
+    and apply from the next `update` on. Memory is a few arrays of window
+    size.
+    """
+
+    def __init__(self, dt, window=1.0, bands=(5.0, 20.0), hop=None, detrend=0.2):
+        import numpy as np
+        self._np = np
+        self._half_detrend = max(1, int(round(detrend / dt / 2)))
+        self._raw = None  # latest samples, for the moving average
+        self.size = max(2, int(round(window / dt)))
+        self.hop = hop or max(1, self.size // 4)
+        self.dt = dt
+        n = self.size
+        freqs = np.fft.rfftfreq(n, dt)
+        low, high = bands
+        self._bins = [freqs < low, (freqs >= low) & (freqs < high), freqs >= high]
+        self._taper = np.hanning(n)
+        # one sided spectrum of the tapered window to mean square
+        self._scale = np.full((len(freqs), 1), 2.0 / (n * np.sum(self._taper ** 2)))
+        self._scale[0] /= 2
+        if n % 2 == 0:
+            self._scale[-1] /= 2
+        self._values = np.zeros((n, 3))  # sample t at t % n
+        self._seen = 0
+        self._spectrum_at = 0
+        self._sum = np.zeros(3)
+        self._sum_sq = np.zeros(3)
+        self._prefix_max = np.empty((n, 3))
+        self._prefix_min = np.empty((n, 3))
+        # one more for windows that start with the current block
+        self._suffix_max = np.full((n + 1, 3), -np.inf)
+        self._suffix_min = np.full((n + 1, 3), np.inf)
+        self._bands = (0.0, 0.0, 0.0)
+
+    def update(self, accel):
+        accel = self._detrend(accel)
+        features = self._np.empty((len(accel), len(FEATURES)))
+        start = 0
+        while start < len(accel):
+            # runs of samples within one block
+            offset = self._seen % self.size
+            end = start + min(len(accel) - start, self.size - offset)
+            self._update_run(accel[start:end], offset, features[start:end])
+            start = end
+        features[:, 3:] = self._bands
+        if self._seen >= self.size and self._seen - self._spectrum_at >= self.hop:
+            self._spectrum_at = self._seen
+            self._bands = self._band_energy()
+        return features
+
+    def _detrend(self, accel):
+        np = self._np
+        h = self._half_detrend
+        if self._raw is None:
+            self._raw = np.repeat(accel[:1], 2 * h, axis=0)
+        raw = np.vstack((self._raw, accel))
+        self._raw = raw[-2 * h:]
+        sums = np.vstack((np.zeros((1, 3)), np.cumsum(raw, axis=0)))
+        average = (sums[2 * h + 1:] - sums[:-2 * h - 1]) / (2 * h + 1)
+        return raw[h:-h] - average
+
+    def _update_run(self, x, offset, features):
+        np = self._np
+        n, k = self.size, len(x)
+        # samples leaving the window, zeros while it fills up
+        leaving = self._values[offset:offset + k].copy()
+        self._values[offset:offset + k] = x
+        sums = self._sum + np.cumsum(x - leaving, axis=0)
+        sums_sq = self._sum_sq + np.cumsum(x * x - leaving * leaving, axis=0)
+        self._sum, self._sum_sq = sums[-1], sums_sq[-1]
+        counts = np.minimum(np.arange(self._seen + 1, self._seen + k + 1), n)[:, None]
+        mean = sums / counts
+        rms = np.sqrt(np.maximum(sums_sq / counts - mean * mean, 0).sum(axis=1))
+
+        running_max = np.maximum.accumulate(x, axis=0)
+        running_min = np.minimum.accumulate(x, axis=0)
+        if offset:
+            np.maximum(running_max, self._prefix_max[offset - 1], out=running_max)
+            np.minimum(running_min, self._prefix_min[offset - 1], out=running_min)
+        self._prefix_max[offset:offset + k] = running_max
+        self._prefix_min[offset:offset + k] = running_min
+        window_max = np.maximum(running_max, self._suffix_max[offset + 1:offset + k + 1])
+        window_min = np.minimum(running_min, self._suffix_min[offset + 1:offset + k + 1])
+        peak = np.sqrt((np.maximum(window_max - mean, mean - window_min) ** 2).sum(axis=1))
+
+        features[:, 0] = rms
+        features[:, 1] = peak
+        features[:, 2] = np.where(rms > 0, peak / np.where(rms > 0, rms, 1), 0)
+
+        self._seen += k
+        if self._seen % n == 0:
+            # a block is complete, the next one's windows start in it;
+            # the sums are recomputed so that rounding errors don't add up
+            self._suffix_max[:n] = np.maximum.accumulate(self._values[::-1], axis=0)[::-1]
+            self._suffix_min[:n] = np.minimum.accumulate(self._values[::-1], axis=0)[::-1]
+            self._sum = self._values.sum(axis=0)
+            self._sum_sq = (self._values ** 2).sum(axis=0)
+
+    def _band_energy(self):
+        np = self._np
+        window = np.roll(self._values, -(self._seen % self.size), axis=0)
+        window = (window - window.mean(axis=0)) * self._taper[:, None]
+        spectrum = np.fft.rfft(window, axis=0)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self._scale
+        return tuple(power[bins].sum() for bins in self._bins)
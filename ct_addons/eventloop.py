@@ -0,0 +1,224 @@
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import select
+import socket
+import threading
+from ct_addons.clock import monotonic
+
+
+log = logging.getLogger(__name__)
+
+
+class EventLoop(object):
+    """Minimal single-threaded reactor on top of epoll (select elsewhere).
+
+    Callbacks registered with `add_reader`/`add_writer`, `call_soon` and
+    `call_later` run on the loop thread and must not block. The only
+    methods safe to call from other threads are `call_soon_threadsafe`
+    and `stop`.
+    """
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._ready = collections.deque()
+        self._poller = _EpollPoller() if hasattr(select, 'epoll') else _SelectPoller()
+        self._wakeup_socks = socket.socketpair()
+        self._wakeup_socks[0].setblocking(0)
+        self._wakeup_socks[1].setblocking(0)
+        self._wakeup_lock = threading.Lock()
+        self._wakeup_pending = False
+        self._stopped = threading.Event()
+        self._thread = None
+        self._thread_ident = None
+        self.add_reader(self._wakeup_socks[0].fileno(), self._on_wakeup)
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._ready.append((callback, args))
+        if threading.current_thread().ident != self._thread_ident:
+            self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(monotonic() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.when, next(self._timer_seq), timer))
+        return timer
+
+    def in_loop_thread(self):
+        return threading.current_thread().ident == self._thread_ident
+
+    def start(self, name='ct-eventloop'):
+        """Runs the loop in a new daemon thread."""
+        if self._thread is not None:
+            raise RuntimeError("Already started")
+        self._thread = threading.Thread(target=self.run_forever, name=name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_forever(self):
+        self._thread_ident = threading.current_thread().ident
+        self._stopped.clear()
+        try:
+            while not self._stopped.isSet():
+                self._run_once()
+        finally:
+            self._thread_ident = None
+
+    def _run_once(self):
+        timeout = None
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = max(0, self._timers[0][0] - monotonic())
+
+        for fd, readable, writable in self._poller.poll(timeout):
+            if readable and fd in self._readers:
+                self._invoke(*self._readers[fd])
+            if writable and fd in self._writers:
+                self._invoke(*self._writers[fd])
+
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self._ready.append((timer.callback, timer.args))
+
+        # callbacks scheduled by these callbacks run on the next iteration
+        for _ in range(len(self._ready)):
+            self._invoke(*self._ready.popleft())
+
+    def _invoke(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            log.exception('error in event loop callback %r', callback)
+
+    def _update(self, fd):
+        self._poller.register(fd, fd in self._readers, fd in self._writers)
+
+    def _wakeup(self):
+        with self._wakeup_lock:
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        try:
+            self._wakeup_socks[1].send(b'\0')
+        except socket.error:
+            pass
+
+    def _on_wakeup(self):
+        with self._wakeup_lock:
+            self._wakeup_pending = False
+        try:
+            while self._wakeup_socks[0].recv(4096):
+                pass
+        except socket.error as err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+class Timer(object):
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._masks = {}
+
+    def register(self, fd, readable, writable):
+        mask = (select.EPOLLIN if readable else 0) | (select.EPOLLOUT if writable else 0)
+        old_mask = self._masks.get(fd)
+        if not mask:
+            if old_mask is not None:
+                del self._masks[fd]
+                try:
+                    self._epoll.unregister(fd)
+                except (IOError, OSError, ValueError):
+                    pass  # already closed
+        elif old_mask is None:
+            self._epoll.register(fd, mask)
+            self._masks[fd] = mask
+        elif old_mask != mask:
+            self._epoll.modify(fd, mask)
+            self._masks[fd] = mask
+
+    def poll(self, timeout):
+        try:
+            events = self._epoll.poll(-1 if timeout is None else timeout)
+        except (IOError, OSError) as err:
+            if err.errno == errno.EINTR:
+                return []
+            raise
+        error_mask = select.EPOLLERR | select.EPOLLHUP
+        return [
+            (fd,
+             bool(ev & (select.EPOLLIN | error_mask)),
+             bool(ev & (select.EPOLLOUT | error_mask)))
+            for fd, ev in events
+        ]
+
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self._rfds = set()
+        self._wfds = set()
+
+    def register(self, fd, readable, writable):
+        (self._rfds.add if readable else self._rfds.discard)(fd)
+        (self._wfds.add if writable else self._wfds.discard)(fd)
+
+    def poll(self, timeout):
+        try:
+            rlist, wlist, xlist = select.select(self._rfds, self._wfds, [], timeout)
+        except select.error as err:
+            if err.args[0] == errno.EINTR:
+                return []
+            raise
+        rset = set(rlist)
+        wset = set(wlist)
+        return [(fd, fd in rset, fd in wset) for fd in rset | wset]
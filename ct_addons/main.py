@@ -2,19 +2,52 @@ import argparse
 import logging
 import json
 from .transport import CTSocketClient
+from . import wire
+from . import policy
+from .eventloop import EventLoop
+from .metrics import Registry, StatsReporter
 from .event_trackers import testing, mpu6050
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--client-id', required=True)
+    parser.add_argument('--runtime', default='threads',
+                        choices=['threads', 'eventloop'],
+                        help="'eventloop' serves agent connection, sample "
+                             "dispatch and debug clients from one thread")
+    parser.add_argument('--flush-interval', type=float, default=0.005,
+                        help="seconds to collect outgoing events for before "
+                             "writing them to the agent in one go")
+    parser.add_argument('--buffer-size', type=int, default=10,
+                        help="events to keep in memory while the agent is "
+                             "unreachable")
+    parser.add_argument('--spill-path',
+                        help="keep events for the unreachable agent in this "
+                             "file instead, so they survive restarts")
+    parser.add_argument('--spill-size', type=int, default=1024 * 1024,
+                        help="size of the spill file in bytes")
+    parser.add_argument('--drop-policy', default='oldest',
+                        choices=['oldest', 'newest'],
+                        help="events to drop when the buffer is full")
+    parser.add_argument('--agent-socket',
+                        default=CTSocketClient.CT_AGENT_SOCKET_PATH,
+                        help="Unix socket of the CT agent")
+    parser.add_argument('--codec', default='json', choices=sorted(wire.CODECS),
+                        help="wire format to offer to the agent, JSON is "
+                             "used if the agent doesn't accept it")
+    parser.add_argument('--stats-socket',
+                        help="Unix socket that returns a JSON snapshot of "
+                             "daemon metrics to every connection")
+    parser.add_argument('--stats-interval', type=float,
+                        help="log daemon metrics every that many seconds")
 
     subparsers = parser.add_subparsers()
 
     mock_parser = subparsers.add_parser('testing', help='used for autotests')
     mock_parser.add_argument('program', nargs='*')
     mock_parser.set_defaults(
-        get_tracker=lambda client, args: testing.TestingEventTracker(client, args.program),
+        get_tracker=lambda client, args, loop: testing.TestingEventTracker(client, args.program),
         etype=testing.TestingEventTracker.EVENT_TYPE,
     )
 
@@ -25,26 +58,173 @@ def main():
                                  "debugging")
     mpu_parser.add_argument('--accel-calibration',
                             help="optional JSON file that contains calibration"
-                                 " data for accelerometer")
+                                 " data for accelerometer, either for all "
+                                 "sensors or by sensor name")
+    mpu_parser.add_argument('--epoch-rules',
+                            help="JSON file with a list of epoch rules to use "
+                                 "instead of the default ones")
+    mpu_parser.add_argument('--event-policies',
+                            help="JSON file with rate limits, dwell and "
+                                 "coalescing times of events by event type, "
+                                 "'*' for the other types")
+    mpu_parser.add_argument('--vibration-window', type=float, default=1.0,
+                            help="seconds of samples vibration features are "
+                                 "taken over")
+    mpu_parser.add_argument('--vibration-bands', type=float, nargs=2,
+                            default=[5.0, 20.0], metavar=('LOW', 'HIGH'),
+                            help="frequencies in Hz separating the low, mid "
+                                 "and high vibration bands")
+    mpu_parser.add_argument('--filter', default='axis-angle',
+                            choices=sorted(mpu6050.FILTERS),
+                            help="orientation filter backend")
+    mpu_parser.add_argument('--fifo', action='store_true',
+                            help="let the sensor sample into its hardware FIFO"
+                                 " and read it in bursts")
+    mpu_parser.add_argument('--catch-up', default='skip',
+                            choices=mpu6050.scheduler.DeadlineScheduler.POLICIES,
+                            help="what to do with missed sampling deadlines")
+    mpu_parser.add_argument('--sample-interval', type=float, default=0.011,
+                            help="seconds between samples")
+    mpu_parser.add_argument('--simulate', action='store_true',
+                            help="read a simulated sensor instead of the "
+                                 "MPU6050, for testing without hardware; with "
+                                 "--fifo it keeps up with intervals well below "
+                                 "a millisecond")
+    mpu_parser.add_argument('--simulation-seed', type=int,
+                            help="seed of the simulated motion, random if not "
+                                 "given")
+    mpu_parser.add_argument('--sampling-process',
+                            choices=['sampling', 'filtering'],
+                            help="read the sensors of every bus, or read and "
+                                 "filter them, in a process of its own, away "
+                                 "from the GIL of the rest of the daemon")
+    mpu_parser.add_argument('--capture',
+                            help="record raw samples to binary capture files "
+                                 "at this path, '{time}', '{index}' and "
+                                 "'{sensor}' are replaced with file start "
+                                 "time, number and sensor name")
+    mpu_parser.add_argument('--capture-rotate-size', type=float,
+                            help="start a new capture file after this many MB")
+    mpu_parser.add_argument('--capture-rotate-time', type=float,
+                            help="start a new capture file after this many "
+                                 "minutes")
+    mpu_parser.add_argument('--replay', action='append', metavar='CAPTURE',
+                            help="replay samples from capture files instead "
+                                 "of the sensor, can be given several times")
+    mpu_parser.add_argument('--replay-speed', type=float, default=1.0,
+                            help="replay this many times faster than "
+                                 "recorded, 0 replays as fast as possible")
+    mpu_parser.add_argument('--replay-start', type=float,
+                            help="start replay this many seconds into the "
+                                 "recording")
+    mpu_parser.add_argument('--replay-start-sample', type=int,
+                            help="start replay at this sample number")
+
+    def parse_sensor(spec):
+        # [NAME=]BUS:ADDRESS, named after location by default
+        name, _, location = spec.rpartition('=')
+        bus, address = location.split(':')
+        bus, address = int(bus), int(address, 0)
+        return name or '{}-{:#04x}'.format(bus, address), bus, address
+
+    mpu_parser.add_argument('--sensor', action='append', dest='sensors',
+                            type=parse_sensor, metavar='[NAME=]BUS:ADDRESS',
+                            help="sample this sensor, e.g. 1:0x69, can be "
+                                 "given several times; 1:0x68 by default")
     mpu_parser.set_defaults(
-        get_tracker=lambda client, args: load_mpu6050_eventtracker(
-            client, args.server_port, args.accel_calibration
+        get_tracker=lambda client, args, loop: load_mpu6050_eventtracker(
+            client, args, loop,
         ),
         etype=mpu6050.Mpu6050EventTracker.EVENT_TYPE,
     )
 
-    def load_mpu6050_eventtracker(client, server_port, accel_calibration):
-        if accel_calibration:
-            with open(accel_calibration) as f:
-                data = json.load(f)
-            accel_offsets = data['x_offs'], data['y_offs'], data['z_offs']
+    def load_mpu6050_eventtracker(client, args, loop):
+        calibration = {}
+        if args.accel_calibration:
+            with open(args.accel_calibration) as f:
+                calibration = json.load(f)
+        default_offsets = 0.42, -1.11, 0.255
+
+        def accel_offsets(name):
+            # one set of offsets for all sensors, or one per sensor name
+            data = calibration.get(name, calibration)
+            if 'x_offs' not in data:
+                log.info('using development accelerometer calibration params for %s',
+                         name)
+                return default_offsets
+            return data['x_offs'], data['y_offs'], data['z_offs']
+
+        if args.replay:
+            if args.sensors:
+                mpu_parser.error("--replay reads the sensor recorded in the "
+                                 "capture, --sensor doesn't apply")
+            # replay uses the calibration it was recorded with, unless
+            # there is one for the recorded sensor
+            sensors = None
+            offsets = None
+            try:
+                reader = mpu6050.capture.CaptureReader(args.replay[0])
+            except ValueError as err:
+                mpu_parser.error(str(err))
+            name = reader.metadata.get('sensor', 'replay')
+            reader.close()
+            if 'x_offs' in calibration.get(name, calibration):
+                offsets = accel_offsets(name)
+            else:
+                log.info('using recorded accelerometer calibration params for %s', name)
         else:
-            log.info('using development accelerometer calibration params')
-            accel_offsets = 0.42, -1.11, 0.255
+            sensors = [
+                mpu6050.SensorConfig(name, bus, address, accel_offsets(name))
+                for name, bus, address in args.sensors or [parse_sensor('1:0x68')]
+            ]
+            offsets = None
+            if len(set(sensor.name for sensor in sensors)) < len(sensors):
+                mpu_parser.error("sensor names must be unique")
+            if args.capture and len(sensors) > 1 and '{sensor}' not in args.capture:
+                mpu_parser.error("--capture needs '{sensor}' with several sensors")
+            if args.capture and args.sampling_process == 'filtering':
+                mpu_parser.error("--capture needs raw samples, use "
+                                 "--sampling-process sampling")
+        rules = None
+        if args.epoch_rules:
+            with open(args.epoch_rules) as f:
+                try:
+                    rules = mpu6050.epoch_rules.load_rules(json.load(f))
+                except ValueError as err:
+                    mpu_parser.error(str(err))
+        event_policies = None
+        if args.event_policies:
+            with open(args.event_policies) as f:
+                try:
+                    event_policies = policy.load_policies(json.load(f))
+                except (ValueError, AttributeError) as err:
+                    mpu_parser.error("bad event policies: {}".format(err))
         return mpu6050.Mpu6050EventTracker(
             client,
-            run_server_at_port=server_port,
-            accel_offsets=accel_offsets,
+            accel_offsets=offsets,
+            sensors=sensors,
+            run_server_at_port=args.server_port,
+            filter_name=args.filter,
+            fifo=args.fifo,
+            catch_up=args.catch_up,
+            loop=loop,
+            capture_path=args.capture,
+            capture_rotate_bytes=(int(args.capture_rotate_size * 1024 * 1024)
+                                  if args.capture_rotate_size else None),
+            capture_rotate_seconds=(args.capture_rotate_time * 60
+                                    if args.capture_rotate_time else None),
+            replay_paths=args.replay,
+            replay_speed=args.replay_speed,
+            replay_start_seq=args.replay_start_sample,
+            replay_start_time=args.replay_start,
+            dt=args.sample_interval,
+            simulate=args.simulate,
+            simulation_seed=args.simulation_seed,
+            sampling_process=args.sampling_process,
+            rules=rules,
+            vibration_window=args.vibration_window,
+            vibration_bands=tuple(args.vibration_bands),
+            event_policies=event_policies,
         )
 
     logging.basicConfig(level=logging.INFO)
@@ -56,12 +236,37 @@ def main():
         tracker.on_config_enabled(etype, params)
 
     def on_config_disabled(etype, params):
-        tracker.on_config_enabled(etype, params)
+        tracker.on_config_disabled(etype, params)
+
+    if args.codec == 'msgpack' and wire.msgpack is None:
+        log.warning('no msgpack package, its pure Python encoder is slower than JSON')
+
+    loop = EventLoop() if args.runtime == 'eventloop' else None
+    registry = Registry()
 
     client = CTSocketClient(args.client_id, [args.etype],
-                            on_config_enabled, on_config_disabled)
+                            on_config_enabled, on_config_disabled, loop=loop,
+                            socket_path=args.agent_socket,
+                            flush_interval=args.flush_interval,
+                            bufsize=args.buffer_size,
+                            spill_path=args.spill_path,
+                            spill_size=args.spill_size,
+                            drop_policy=args.drop_policy,
+                            codec=args.codec,
+                            metrics=registry)
 
-    tracker = args.get_tracker(client, args)
+    tracker = args.get_tracker(client, args, loop)
+    if loop is not None:
+        loop.start()
+    reporter = None
+    if args.stats_socket or args.stats_interval:
+        stats_loop = loop
+        if stats_loop is None:
+            stats_loop = EventLoop()
+            stats_loop.start(name='ct-stats')
+        reporter = StatsReporter(stats_loop, registry, args.stats_socket,
+                                 args.stats_interval)
+        reporter.start()
     client.start()
     try:
         tracker.run()
@@ -69,3 +274,11 @@ def main():
         pass
     finally:
         client.stop()
+        if reporter is not None:
+            reporter.stop()
+            if reporter.loop is not loop:
+                reporter.loop.stop()
+                reporter.loop.join()
+        if loop is not None:
+            loop.stop()
+            loop.join()
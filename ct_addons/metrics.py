@@ -0,0 +1,192 @@
+import bisect
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class Counter(object):
+    """Monotonic count. Updated without a lock: increments come from a
+    single thread or under the owner's lock."""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(object):
+    """Value read from `function` when a snapshot is taken."""
+
+    __slots__ = ('function',)
+
+    def __init__(self, function):
+        self.function = function
+
+    def snapshot(self):
+        return self.function()
+
+
+class Histogram(object):
+    """Counts of observed values in fixed buckets, by default exponential
+    from 10us to about 40s, good for latencies in seconds."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum', 'max')
+
+    DEFAULT_BOUNDS = tuple(1e-5 * 2 ** i for i in range(23))
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the `q` quantile, no more than
+        # the largest value observed
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class Registry(object):
+    """Named metrics of the daemon, `snapshot` returns all their values."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name):
+        return self._add(name, Counter())
+
+    def gauge(self, name, function):
+        return self._add(name, Gauge(function))
+
+    def histogram(self, name, bounds=Histogram.DEFAULT_BOUNDS):
+        return self._add(name, Histogram(bounds))
+
+    def snapshot(self):
+        result = {'time': time.time()}
+        for name, metric in sorted(self._metrics.items()):
+            result[name] = metric.snapshot()
+        return result
+
+    def _add(self, name, metric):
+        if name in self._metrics:
+            raise ValueError("Metric already exists: {}".format(name))
+        self._metrics[name] = metric
+        return metric
+
+
+class StatsReporter(object):
+    """Publishes `registry` snapshots from an `EventLoop`.
+
+    With `path`, every connection to that Unix socket gets the current
+    snapshot as a JSON line and is closed (`socat - UNIX:<path>`). With
+    `interval`, snapshots are also logged every `interval` seconds.
+    """
+
+    def __init__(self, loop, registry, path=None, interval=None):
+        self.loop = loop
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self._sock = None
+        self._timer = None
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self._start)
+
+    def stop(self):
+        if self.loop.in_loop_thread():
+            self._stop()
+            return
+        done = threading.Event()
+
+        def stop():
+            self._stop()
+            done.set()
+
+        self.loop.call_soon_threadsafe(stop)
+        done.wait(1)
+
+    def _start(self):
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self._sock = socket.socket(socket.AF_UNIX)
+            self._sock.setblocking(0)
+            self._sock.bind(self.path)
+            self._sock.listen(8)
+            self.loop.add_reader(self._sock.fileno(), self._on_accept)
+            log.info('serving stats at %s', self.path)
+        if self.interval:
+            self._timer = self.loop.call_later(self.interval, self._report)
+
+    def _stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._sock is not None:
+            self.loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _report(self):
+        log.info('stats: %s', json.dumps(self.registry.snapshot(), sort_keys=True))
+        self._timer = self.loop.call_later(self.interval, self._report)
+
+    def _on_accept(self):
+        try:
+            conn, _ = self._sock.accept()
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        try:
+            # a snapshot is a few KB and fits into an empty socket buffer
+            conn.setblocking(0)
+            conn.send(json.dumps(self.registry.snapshot(), sort_keys=True) + '\n')
+        except socket.error as err:
+            log.warning('failed to send stats: %s', err)
+        finally:
+            conn.close()
@@ -0,0 +1,221 @@
+"""Rate limiting, debouncing and coalescing of events on their way to the
+agent.
+
+`EventPolicies` stands between a tracker and `CTSocketClient`. Each event
+type gets an `EventPolicy`:
+- epochs are accepted only once they have started, or ended, for `dwell`
+  seconds;
+- events are sent while a token bucket of `burst` tokens, refilled at
+  `rate` per second, has tokens;
+- events that come within `coalesce` seconds of a sent one, or find the
+  bucket empty, are merged. The merged event is sent when the window ends
+  and a token is available: it has the fields of the latest event, their
+  'min' and 'max', and 'count', the number of events merged.
+
+Events and epochs are told apart by their fields that aren't numbers,
+like the sensor's name, so each sensor has its own dwell and coalescing.
+
+Times are those of the samples when the caller gives them: epochs of a
+batch of samples, of a FIFO burst or of a replay faster than real time
+reach the policies all at once, but are judged by when they happened.
+"""
+import logging
+import numbers
+import threading
+from ct_addons.clock import monotonic
+from ct_addons.metrics import Registry
+
+
+log = logging.getLogger(__name__)
+
+
+class EventPolicy(object):
+    """How events of one type are sent, see the module doc; `rate` None
+    doesn't limit them."""
+
+    def __init__(self, rate=None, burst=1, dwell=0.0, coalesce=0.0):
+        rate = None if rate is None else float(rate)
+        burst, dwell, coalesce = float(burst), float(dwell), float(coalesce)
+        if rate is not None and rate <= 0 or burst < 1 or dwell < 0 or coalesce < 0:
+            raise ValueError("Bad event policy: rate={}, burst={}, dwell={}, coalesce={}".format(
+                rate, burst, dwell, coalesce))
+        self.rate = rate
+        self.burst = burst
+        self.dwell = dwell
+        self.coalesce = coalesce
+
+    @classmethod
+    def from_config(cls, config):
+        try:
+            return cls(**config)
+        except TypeError:
+            raise ValueError("Bad event policy: {!r}".format(config))
+
+    def __repr__(self):
+        return '<EventPolicy rate={} burst={} dwell={} coalesce={}>'.format(
+            self.rate, self.burst, self.dwell, self.coalesce)
+
+
+def load_policies(config):
+    """{event type: `EventPolicy`} of {event type: dict}, e.g. of JSON
+    config; type '*' is the default for other types."""
+    return dict((event_type, EventPolicy.from_config(policy))
+                for event_type, policy in config.items())
+
+
+class EventPolicies(object):
+    """Sends events to `client` according to `policies`, a dict of
+    `EventPolicy` by event type with '*' for the other ones.
+
+    `epoch` takes starts and ends of epochs, `send_event` events that
+    aren't epochs. `flush` sends what's due, it has to be called every
+    now and then, e.g. with every batch of samples. All of them take the
+    time `now` in seconds, `clock` by default; the caller has to stick to
+    one of the two. Counters are kept in `metrics` under 'policy.'.
+    """
+
+    def __init__(self, client, policies=None, clock=monotonic, metrics=None):
+        self.client = client
+        self.clock = clock
+        self._policies = None
+        self._lock = threading.Lock()
+        # event type -> [tokens, time of the latest refill]
+        self._buckets = {}
+        # (event type, key) -> [accepted, (started, since, data) or None]
+        self._epochs = {}
+        # (event type, key) -> [window end, merged event or None]
+        self._windows = {}
+        self.metrics = metrics if metrics is not None else Registry()
+        self._events_sent = self.metrics.counter('policy.events_sent')
+        self._events_merged = self.metrics.counter('policy.events_merged')
+        self._epochs_rejected = self.metrics.counter('policy.epochs_rejected')
+        self.configure(policies or {})
+
+    def configure(self, policies):
+        """Replaces all policies with `policies`, types without a policy
+        and no '*' aren't limited."""
+        policies = dict(policies)
+        policies.setdefault('*', EventPolicy())
+        with self._lock:
+            self._policies = policies
+            self._buckets.clear()
+        log.info('event policies: %s', self._policies)
+
+    def policy(self, event_type):
+        return self._policies.get(event_type) or self._policies['*']
+
+    def epoch(self, event_type, started, data, now=None):
+        """An epoch of `event_type` started or ended at `now`, `data` are
+        fields of its event."""
+        key = (event_type, _key(data))
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            state = self._epochs.setdefault(key, [False, None])
+            if started == state[0]:
+                if state[1] is not None:
+                    # flipped back before the dwell time
+                    self._epochs_rejected.inc()
+                    state[1] = None
+                return
+            state[1] = (started, now, data)
+            sends = self._accept_due(now)
+            self._events_sent.inc(len(sends))
+        self._send(sends)
+
+    def send_event(self, event_type, data, now=None):
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            sends = self._emit(event_type, _key(data), data, now)
+            self._events_sent.inc(len(sends))
+        self._send(sends)
+
+    def flush(self, now=None):
+        if now is None:
+            now = self.clock()
+        with self._lock:
+            sends = self._accept_due(now)
+            for (event_type, key), window in self._windows.items():
+                if window[1] is not None and now >= window[0] and self._take(event_type, now):
+                    sends.append((event_type, window[1].data()))
+                    window[0] = now + self.policy(event_type).coalesce
+                    window[1] = None
+            self._events_sent.inc(len(sends))
+        self._send(sends)
+
+    def _accept_due(self, now):
+        # requires `_lock`, returns events to send
+        sends = []
+        for (event_type, key), state in self._epochs.items():
+            if state[1] is None:
+                continue
+            started, since, data = state[1]
+            if now - since < self.policy(event_type).dwell:
+                continue
+            state[0] = started
+            state[1] = None
+            if started:
+                sends.extend(self._emit(event_type, key, data, now))
+        return sends
+
+    def _emit(self, event_type, key, data, now):
+        # requires `_lock`, returns events to send now
+        window = self._windows.setdefault((event_type, key), [now, None])
+        if window[1] is None and now >= window[0] and self._take(event_type, now):
+            window[0] = now + self.policy(event_type).coalesce
+            return [(event_type, data)]
+        if window[1] is None:
+            window[1] = _Merged()
+        window[1].add(data)
+        self._events_merged.inc()
+        return []
+
+    def _take(self, event_type, now):
+        # requires `_lock`, whether a token of the type's bucket was taken
+        policy = self.policy(event_type)
+        if policy.rate is None:
+            return True
+        bucket = self._buckets.setdefault(event_type, [policy.burst, now])
+        # sample times of several sensors may go back a little
+        if now > bucket[1]:
+            bucket[0] = min(policy.burst, bucket[0] + (now - bucket[1]) * policy.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def _send(self, sends):
+        # outside `_lock`, the client takes locks of its own
+        for event_type, data in sends:
+            self.client.send_event(event_type, data)
+
+
+class _Merged(object):
+    # events coalesced into one
+
+    def __init__(self):
+        self.count = 0
+        self.latest = None
+        self.min = {}
+        self.max = {}
+
+    def add(self, data):
+        self.count += 1
+        self.latest = data
+        for name, value in data.items():
+            if isinstance(value, numbers.Number):
+                self.min[name] = min(value, self.min.get(name, value))
+                self.max[name] = max(value, self.max.get(name, value))
+
+    def data(self):
+        if self.count == 1:
+            return self.latest
+        return dict(self.latest, count=self.count, min=self.min, max=self.max)
+
+
+def _key(data):
+    # fields that aren't numbers tell events of a type apart
+    return tuple(sorted((name, value) for name, value in data.items()
+                        if not isinstance(value, numbers.Number)))
@@ -0,0 +1,182 @@
+import os
+import mmap
+import struct
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+class SpillLog(object):
+    """Bounded append-only message log in a memory-mapped file.
+
+    Data area is a circular buffer of records (4-byte length + payload)
+    that never wrap in the middle; a record that doesn't fit before the end
+    of the area starts from its beginning. Header with the positions lives
+    in the same mapping, so the log survives process restarts.
+
+    When full, `drop_policy` decides whether the oldest records are
+    discarded ('oldest') or new ones are rejected ('newest').
+    """
+
+    DROP_POLICIES = ('oldest', 'newest')
+
+    _MAGIC = b'CTSP'
+    _VERSION = 1
+    # magic, version, capacity, head, tail, count, dropped
+    _HEADER = struct.Struct('>4sIIIIIQ')
+    _LENGTH = struct.Struct('>I')
+    _WRAP = 0xFFFFFFFF
+
+    def __init__(self, path, size=1024 * 1024, drop_policy='oldest'):
+        if drop_policy not in self.DROP_POLICIES:
+            raise ValueError("Unknown drop policy: {}".format(drop_policy))
+        self.path = path
+        self.drop_policy = drop_policy
+        self.capacity = size - self._HEADER.size
+        if self.capacity < 1024:
+            raise ValueError("Spill log size is too small: {}".format(size))
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, version, capacity, head, tail, count, dropped = \
+            self._HEADER.unpack_from(self._map, 0)
+        if (magic, version, capacity) == (self._MAGIC, self._VERSION, self.capacity):
+            self._head, self._tail, self._count, self.dropped = head, tail, count, dropped
+            if count:
+                log.info('spill log %s has %d messages from previous run', path, count)
+        else:
+            self._head = self._tail = self._count = self.dropped = 0
+            self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, payload):
+        """Returns False if the record was dropped."""
+        size = self._LENGTH.size + len(payload)
+        if size > self.capacity:
+            self._drop_new(payload)
+            return False
+        while True:
+            offset = self._find_room(size)
+            if offset is not None:
+                break
+            if self.drop_policy == 'newest' or not self._count:
+                self._drop_new(payload)
+                return False
+            self._pop()
+            self.dropped += 1
+        if offset < self._tail:
+            # not enough room at the end, mark the wrap if there's space
+            if self.capacity - self._tail >= self._LENGTH.size:
+                self._LENGTH.pack_into(self._map, self._data(self._tail), self._WRAP)
+        start = self._data(offset)
+        self._LENGTH.pack_into(self._map, start, len(payload))
+        self._map[start + self._LENGTH.size:start + size] = payload
+        self._tail = offset + size
+        self._count += 1
+        self._write_header()
+        return True
+
+    def pop_all(self):
+        """Returns all records in order and empties the log."""
+        if not self._count:
+            return []
+        # at most two contiguous reads: head..end and beginning..tail
+        if self._tail > self._head:
+            chunks = [self._map[self._data(self._head):self._data(self._tail)]]
+        else:
+            chunks = [
+                self._map[self._data(self._head):self._data(self.capacity)],
+                self._map[self._data(0):self._data(self._tail)],
+            ]
+        records = []
+        for chunk in chunks:
+            pos = 0
+            while pos + self._LENGTH.size <= len(chunk) and len(records) < self._count:
+                [length] = self._LENGTH.unpack_from(chunk, pos)
+                if length == self._WRAP:
+                    break
+                pos += self._LENGTH.size
+                records.append(chunk[pos:pos + length])
+                pos += length
+        self.clear()
+        return records
+
+    def pop(self, max_bytes):
+        """Removes and returns the oldest records, the first one and the
+        following ones while they take up to `max_bytes` of the log with
+        their lengths."""
+        records = []
+        size = 0
+        while self._count:
+            record = self._pop(max_bytes - size - self._LENGTH.size if records else None)
+            if record is None:
+                break
+            records.append(record)
+            size += self._LENGTH.size + len(record)
+        self._write_header()
+        return records
+
+    def clear(self):
+        self._head = self._tail = self._count = 0
+        self._write_header()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+
+    def _find_room(self, size):
+        # offset in data area where `size` bytes fit, None if log is full
+        if not self._count:
+            self._head = self._tail = 0
+            return 0
+        if self._tail > self._head:
+            if self.capacity - self._tail >= size:
+                return self._tail
+            if self._head >= size:
+                return 0
+            return None
+        if self._head - self._tail >= size:
+            return self._tail
+        return None
+
+    def _pop(self, max_length=None):
+        # removes and returns the oldest record, unless it's longer than
+        # `max_length`; the header is left to the caller
+        if self.capacity - self._head < self._LENGTH.size:
+            self._head = 0
+        [length] = self._LENGTH.unpack_from(self._map, self._data(self._head))
+        if length == self._WRAP:
+            self._head = 0
+            [length] = self._LENGTH.unpack_from(self._map, self._data(0))
+        if max_length is not None and length > max_length:
+            return None
+        start = self._data(self._head) + self._LENGTH.size
+        record = self._map[start:start + length]
+        self._head += self._LENGTH.size + length
+        self._count -= 1
+        if not self._count:
+            self._head = self._tail = 0
+        return record
+
+    def _drop_new(self, payload):
+        self.dropped += 1
+        self._write_header()
+        log.debug('spill log %s is full, dropping message: %s', self.path, payload)
+
+    def _data(self, offset):
+        return self._HEADER.size + offset
+
+    def _write_header(self):
+        self._HEADER.pack_into(
+            self._map, 0, self._MAGIC, self._VERSION, self.capacity,
+            self._head, self._tail, self._count, self.dropped,
+        )
@@ -1,126 +1,383 @@
 import socket
 import json
-import struct
 import threading
-import select
-import time
+import errno
+import collections
 import logging
+from ct_addons.clock import monotonic
+from ct_addons.eventloop import EventLoop
+from ct_addons.metrics import Registry
+from ct_addons.spill import SpillLog
+from ct_addons import wire
 
 
 log = logging.getLogger(__name__)
 
 
 class CTSocketClient(object):
+    """Connection to the CT agent.
+
+    All socket I/O happens on an `EventLoop`: a private one running in its
+    own thread unless a shared `loop` is given, in which case starting and
+    stopping that loop is up to the caller.
+
+    Outgoing frames are collected for up to `flush_interval` seconds or
+    `flush_bytes` bytes and written with a single call.
+
+    While disconnected, messages are kept in memory (up to `bufsize`), or
+    in a `SpillLog` at `spill_path` that survives restarts. `drop_policy`
+    tells which messages to lose when full, 'oldest' or 'newest'.
+
+    `send_event` never blocks: frames are queued and written whenever the
+    socket is writable, a partially written frame is finished before the
+    next one. Once more than `high_watermark` bytes are queued, the client
+    is congested and new messages are buffered as if disconnected, until
+    the queue drains below `low_watermark`. `is_congested` tells the state,
+    `on_congestion(congested)` is called on every change. Buffered
+    messages are sent the same way: a chunk of them up to
+    `high_watermark` at a time, the next one once the queue drains below
+    `low_watermark`, with new messages buffered behind them meanwhile.
+
+    Frames are JSON unless another `codec` from `wire.CODECS` is agreed on:
+    the hello lists it in 'codecs', the agent answers {'codec': name} and
+    sends the following frames in it, the client confirms with the same
+    message and switches too. Buffered messages are always kept as JSON.
+
+    Counters and histograms of the link are kept in `metrics`, a
+    `metrics.Registry` shared with the caller if given, under 'transport.'.
+    """
 
     CT_AGENT_SOCKET_PATH = '/opt/corlina/var/event.sock'
 
+    RECONNECT_BACKOFF = 10
+
     def __init__(self, client_id, event_types,
                  on_config_enabled, on_config_disabled,
-                 socket_path=None, bufsize=10):
+                 socket_path=None, bufsize=10, loop=None,
+                 flush_interval=0.005, flush_bytes=64 * 1024,
+                 spill_path=None, spill_size=1024 * 1024, drop_policy='oldest',
+                 high_watermark=256 * 1024, low_watermark=64 * 1024,
+                 on_congestion=None, codec='json', metrics=None):
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError("Bad watermarks: {}, {}".format(low_watermark, high_watermark))
+        if drop_policy not in SpillLog.DROP_POLICIES:
+            raise ValueError("Unknown drop policy: {}".format(drop_policy))
+        self.codec_name = wire.get_codec(codec).name
+        self._codec = wire.CODECS['json']
         self.client_id = client_id
         self.event_types = event_types
         self.socket_path = socket_path or self.CT_AGENT_SOCKET_PATH
         self.on_config_enabled = on_config_enabled
         self.on_config_disabled = on_config_disabled
         self._sock = None
-        self._interrupt_socks = socket.socketpair()
-        self._thread = None
+        self._loop = loop
+        self._own_loop = loop is None
+        self._started = False
+        self._reconnect_timer = None
         self._stopped = threading.Event()
         self._connected = threading.Event()
-        self._buffer = []
-        self.bufsize = 10
+        self._reader = wire.FrameReader()
+        self.bufsize = bufsize
+        self.drop_policy = drop_policy
+        # JSON encoded messages waiting for connection
+        self._buffer = collections.deque()
+        self._spill = None
+        if spill_path is not None:
+            self._spill = SpillLog(spill_path, spill_size, drop_policy)
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        # (frame, codec) pairs not written yet, first frame may be
+        # written partially up to `_pending_offset`
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_offset = 0
+        self._flush_scheduled = False
+        self._writing = False
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_congestion = on_congestion
+        self._congested = False
 
         # lock guards concurrent access on socket when reconnecting
         self._lock = threading.RLock()
 
+        self.metrics = metrics if metrics is not None else Registry()
+        self._events_sent = self.metrics.counter('transport.events_sent')
+        self._events_buffered = self.metrics.counter('transport.events_buffered')
+        self._events_dropped = self.metrics.counter('transport.events_dropped')
+        self._bytes_sent = self.metrics.counter('transport.bytes_sent')
+        self._writes = self.metrics.counter('transport.writes')
+        self._connects = self.metrics.counter('transport.connects')
+        self._connect_failures = self.metrics.counter('transport.connect_failures')
+        self._congestions = self.metrics.counter('transport.congestions')
+        # from queueing a frame until it's fully written to the socket
+        self._send_latency = self.metrics.histogram('transport.send_latency')
+        self.metrics.gauge('transport.buffer_depth', lambda: len(self._buffer) + (
+            len(self._spill) if self._spill is not None else 0))
+        self.metrics.gauge('transport.pending_bytes', lambda: self._pending_bytes)
+        self.metrics.gauge('transport.connected', self._connected.isSet)
+        self.metrics.gauge('transport.disconnected_seconds', self._disconnected_seconds)
+        self._disconnected_total = 0.0
+        self._disconnected_at = None
+
     def start(self):
-        if self._thread is not None:
+        if self._started:
             raise RuntimeError("Already started")
+        self._started = True
         self._stopped.clear()
-        self._thread = threading.Thread(target=self._loop)
-        self._thread.setDaemon(True)
-        self._thread.start()
+        self._disconnected_at = monotonic()
+        if self._own_loop:
+            self._loop = EventLoop()
+            self._loop.start(name='ct-transport')
+        self._loop.call_soon_threadsafe(self._reconnect)
 
     def send_event(self, event_type, data):
         self._send({'event_type': event_type, 'data': data})
 
+    def is_congested(self):
+        return self._congested
+
     def stop(self):
+        """Writes what the socket takes and closes the connection. Callable
+        from any thread: the loop is interrupted through its wakeup
+        socketpair even while it waits for the agent."""
         self._stopped.set()
-        self._interrupt_socks[1].send('\0')
-        self._thread.join()
-        self._interrupt_socks[0].recv(1)
-        self._thread = None
+        done = threading.Event()
+
+        def shutdown():
+            if self._reconnect_timer is not None:
+                self._reconnect_timer.cancel()
+            self._flush()
+            self._close_if_open()
+            done.set()
+
+        if self._loop.in_loop_thread():
+            shutdown()
+        else:
+            self._loop.call_soon_threadsafe(shutdown)
+            done.wait(1)
+        if self._own_loop:
+            self._loop.stop()
+            self._loop.join()
+            self._loop = None
+        self._started = False
 
     def _reconnect(self):
-        while not self._stopped.isSet():
-            with self._lock:
-                self._close_if_open()
-                self._sock = socket.socket(socket.AF_UNIX)
-                self._sock.setblocking(0)
-            try:
-                self._sock.connect(self.socket_path)
-            except socket.error as exc:
-                log.error('%r: error while connecting: %r; backoff=10sec', self, exc)
-                self._stopped.wait(10)
-            else:
-                self._connected.set()
-                log.info('%r: connected', self)
-                return
+        self._reconnect_timer = None
+        if self._stopped.isSet():
+            return
+        with self._lock:
+            self._close_if_open()
+            self._sock = socket.socket(socket.AF_UNIX)
+            self._sock.setblocking(0)
+        try:
+            self._sock.connect(self.socket_path)
+        except socket.error as exc:
+            log.error('%r: error while connecting: %r; backoff=%dsec',
+                      self, exc, self.RECONNECT_BACKOFF)
+            self._connect_failures.inc()
+            self._close_if_open()
+            self._reconnect_timer = self._loop.call_later(
+                self.RECONNECT_BACKOFF, self._reconnect)
+            return
+        self._connected.set()
+        log.info('%r: connected', self)
+        self._connects.inc()
+        if self._disconnected_at is not None:
+            self._disconnected_total += monotonic() - self._disconnected_at
+            self._disconnected_at = None
+        self._reader = wire.FrameReader()
+        self._codec = wire.CODECS['json']
+        self._loop.add_reader(self._sock.fileno(), self._on_readable)
+        self._send_hello()
+        self._send_buffered()
 
     def _send(self, contents):
         with self._lock:
             if not self._connected.isSet():
-                log.warning('%r: not connected, buffering message: %s', self, contents)
-                self._buffer.append(contents)
-                if len(self._buffer) > self.bufsize:
-                    removed = self._buffer.pop(0)
-                    log.warning('%r: dropping message from buffer: %s', self, removed)
+                log.debug('%r: not connected, buffering message: %s', self, contents)
+                self._buffer_message(json.dumps(contents))
+            elif self._congested:
+                log.debug('%r: congested, buffering message: %s', self, contents)
+                self._buffer_message(json.dumps(contents))
+            elif self._has_buffered():
+                log.debug('%r: sending buffered messages first, buffering message: %s',
+                          self, contents)
+                self._buffer_message(json.dumps(contents))
             else:
-                log.info('%r: sending message: %s', self, contents)
-                data = json.dumps(contents)
-                header = struct.pack('>I', len(data))
-                self._sock.send(header + data)
+                log.debug('%r: sending message: %s', self, contents)
+                self._enqueue(self._codec.encode(contents), self._codec)
+
+    def _buffer_message(self, data):
+        # requires `_lock`
+        self._events_buffered.inc()
+        if self._spill is not None:
+            self._spill_message(data)
+            return
+        if len(self._buffer) >= self.bufsize:
+            self._events_dropped.inc()
+            if self.drop_policy == 'newest':
+                log.debug('%r: buffer is full, dropping message: %s', self, data)
+                return
+            removed = self._buffer.popleft()
+            log.debug('%r: dropping message from buffer: %s', self, removed)
+        self._buffer.append(data)
+
+    def _spill_message(self, data):
+        # requires `_lock`
+        dropped = self._spill.dropped
+        self._spill.append(data)
+        self._events_dropped.inc(self._spill.dropped - dropped)
+
+    def _enqueue(self, data, codec=None):
+        # requires `_lock`; frames with `codec` given go back to buffer
+        # if connection breaks before they are written
+        frame = wire.HEADER.pack(len(data)) + data
+        self._pending.append((frame, codec, monotonic()))
+        self._pending_bytes += len(frame)
+        if self._pending_bytes > self.high_watermark and not self._congested:
+            self._set_congested(True)
+        if self._writing:
+            return  # flushed as soon as socket is writable
+        if self._pending_bytes >= self.flush_bytes or self.flush_interval <= 0:
+            self._flush_scheduled = True
+            self._loop.call_soon_threadsafe(self._flush)
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon_threadsafe(
+                self._loop.call_later, self.flush_interval, self._flush,
+            )
+
+    def _flush(self):
+        with self._lock:
+            self._flush_scheduled = False
+            if not self._pending or not self._connected.isSet():
+                return
+            frames = [frame for frame, _, _ in self._pending]
+            if self._pending_offset:
+                frames[0] = frames[0][self._pending_offset:]
+            try:
+                sent = _sendv(self._sock, frames)
+            except socket.error as err:
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._on_error(err)
+                    return
+                sent = 0
+            self._writes.inc()
+            self._bytes_sent.inc(sent)
+            sent += self._pending_offset
+            n_done = 0
+            now = monotonic()
+            for frame, codec, enqueued_at in self._pending:
+                if sent < len(frame):
+                    break
+                sent -= len(frame)
+                self._pending_bytes -= len(frame)
+                n_done += 1
+                if codec is not None:
+                    self._events_sent.inc()
+                    self._send_latency.observe(now - enqueued_at)
+            del self._pending[:n_done]
+            self._pending_offset = sent
+            if self._pending and not self._writing:
+                self._writing = True
+                self._loop.add_writer(self._sock.fileno(), self._flush)
+            elif not self._pending and self._writing:
+                self._writing = False
+                self._loop.remove_writer(self._sock.fileno())
+            if self._pending_bytes <= self.low_watermark:
+                if self._congested:
+                    self._set_congested(False)
+                if self._has_buffered():
+                    self._send_buffered()
+
+    def _set_congested(self, congested):
+        # requires `_lock`
+        self._congested = congested
+        if congested:
+            self._congestions.inc()
+            log.warning('%r: congested, %d bytes queued', self, self._pending_bytes)
+        else:
+            log.info('%r: congestion cleared', self)
+        if callable(self.on_congestion):
+            self.on_congestion(congested)
+
+    def _requeue_pending(self):
+        # requires `_lock`; unsent messages are older than anything
+        # buffered, which may hold messages spilled while congested, so
+        # they go ahead of it
+        messages = [
+            _to_json(frame[wire.HEADER.size:], codec)
+            for frame, codec, _ in self._pending if codec is not None
+        ]
+        if self._spill is not None:
+            if messages:
+                for data in messages + self._spill.pop_all():
+                    self._spill_message(data)
+        else:
+            self._buffer.extendleft(reversed(messages))
+            while len(self._buffer) > self.bufsize:
+                self._events_dropped.inc()
+                if self.drop_policy == 'newest':
+                    self._buffer.pop()
+                else:
+                    self._buffer.popleft()
+        del self._pending[:]
+        self._pending_bytes = 0
+        self._pending_offset = 0
+        if self._congested:
+            self._set_congested(False)
 
     def _send_hello(self):
-        self._send({
+        hello = {
             'client_id': self.client_id,
             'event_types': self.event_types,
-        })
+        }
+        if self.codec_name != 'json':
+            hello['codecs'] = [self.codec_name, 'json']
+        with self._lock:
+            self._enqueue(json.dumps(hello))
+
+    def _on_codec_ack(self, name):
+        with self._lock:
+            if name != self.codec_name or name == self._codec.name:
+                log.warning('%r: ignoring unexpected codec ack: %s', self, name)
+                return
+            self._enqueue(json.dumps({'codec': name}))
+            self._codec = wire.CODECS[name]
+        log.info('%r: switched to %s codec', self, name)
 
-    def _loop(self):
-        while not self._stopped.isSet():
-            self._reconnect()
-            if self._stopped.isSet():
+    def _on_readable(self):
+        try:
+            n_read = self._reader.recv_from(self._sock)
+        except socket.error as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
                 return
-            try:
-                self._send_hello()
-                self._send_buffered()
-                while not self._stopped.isSet():
-                    self._process_one(self._read_one())
-            except socket.error as err:
-                log.error('%r: Error while reading message: %s', self, err)
-            except _ReadInterrupted:
-                self._close_if_open()
-
-    def _read_one(self):
-        [msg_len] = struct.unpack('>I', self._read_data(_HEADER_LEN))
-        data = self._read_data(msg_len)
-        return json.loads(data)
-
-    def _read_data(self, length):
-        result = ''
-        while len(result) < length and not self._stopped.isSet():
-            rlist, _, _ = select.select([
-                self._sock.fileno(),
-                self._interrupt_socks[0].fileno()
-            ], [], [])
-            if self._interrupt_socks[0].fileno() in rlist:
-                raise _ReadInterrupted
-            result += self._sock.recv(length - len(result))
-        return result
+            self._on_error(err)
+            return
+        if not n_read:
+            self._on_error('connection closed by agent')
+            return
+        # frames are decoded one by one, a codec ack applies to the rest
+        sock = self._sock
+        for frame in self._reader.frames():
+            if self._sock is not sock:
+                break  # connection was closed by one of the messages
+            self._process_one(self._codec.decode(frame))
+
+    def _on_error(self, err, sock=None):
+        if sock is not None and sock is not self._sock:
+            return  # already reconnected
+        log.error('%r: socket error: %s', self, err)
+        self._close_if_open()
+        if not self._stopped.isSet():
+            self._loop.call_soon(self._reconnect)
 
     def _process_one(self, contents):
         log.info('%r: incoming: %s', self, contents)
+        if 'codec' in contents:
+            self._on_codec_ack(contents['codec'])
+            return
         cfg_enabled = contents['config_state_enabled']
         event_type = contents['event_type']
         options = contents['options']
@@ -132,29 +389,72 @@ class CTSocketClient(object):
             if callable(self.on_config_disabled):
                 self.on_config_disabled(event_type, options)
 
+    def _has_buffered(self):
+        # requires `_lock`
+        return bool(self._buffer) or self._spill is not None and len(self._spill) > 0
+
     def _send_buffered(self):
+        # a chunk up to `high_watermark`, `_flush` sends the next one when
+        # the queue drains
         with self._lock:
-            log.info('%r: sending buffered messages')
-            n_messages = len(self._buffer)
-            for _ in range(n_messages):
-                msg = self._buffer.pop(0)
-                self._send(msg)
+            room = self.high_watermark - self._pending_bytes
+            if room <= 0 or not self._has_buffered():
+                return
+            # records of the spill log have a length like frames
+            messages = []
+            if self._spill is not None:
+                messages = self._spill.pop(room)
+            size = sum(wire.HEADER.size + len(data) for data in messages)
+            while self._buffer and size < room:
+                messages.append(self._buffer.popleft())
+                size += wire.HEADER.size + len(messages[-1])
+            log.debug('%r: sending %d buffered messages', self, len(messages))
+            for data in messages:
+                self._enqueue_json(data)
+
+    def _enqueue_json(self, data):
+        # requires `_lock`
+        if self._codec.name != 'json':
+            data = self._codec.encode(json.loads(data))
+        self._enqueue(data, self._codec)
 
     def _close_if_open(self):
         with self._lock:
             if self._sock is not None:
+                self._loop.remove_reader(self._sock.fileno())
+                self._loop.remove_writer(self._sock.fileno())
+                self._writing = False
                 self._sock.close()
                 self._sock = None
                 log.info('%r: closed', self)
-        self._connected.clear()
+            if self._connected.isSet():
+                if not self._stopped.isSet():
+                    log.warning('%r: disconnected, buffering messages', self)
+                self._disconnected_at = monotonic()
+            self._connected.clear()
+            self._requeue_pending()
+
+    def _disconnected_seconds(self):
+        # read from other threads, the loop may reconnect meanwhile
+        total = self._disconnected_total
+        disconnected_at = self._disconnected_at
+        if disconnected_at is not None and self._started:
+            total += monotonic() - disconnected_at
+        return total
 
     def __repr__(self):
         return '<id="{}" addr="{}">'.format(self.client_id, self.socket_path)
 
 
-class _ReadInterrupted(Exception):
-    pass
-
+def _sendv(sock, buffers):
+    # one syscall for all buffers; python 2 sockets have no sendmsg
+    sendmsg = getattr(sock, 'sendmsg', None)
+    if sendmsg is not None:
+        return sendmsg(buffers)
+    return sock.send(b''.join(buffers))
 
-_HEADER_LEN = struct.calcsize('>I')
 
+def _to_json(data, codec):
+    if codec.name == 'json':
+        return data
+    return json.dumps(codec.decode(data))
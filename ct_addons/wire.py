@@ -0,0 +1,266 @@
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# length prefix of every frame on the agent socket
+HEADER = struct.Struct('>I')
+
+
+class JsonCodec(object):
+    """Text codec every agent understands, used until another is agreed on."""
+
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    """MessagePack, several times more compact than JSON for float payloads.
+
+    Uses the `msgpack` package when it's installed, otherwise a pure Python
+    implementation of the subset of the format JSON can express. Both pack
+    native strings, like event types and field names, as msgpack str, and
+    decode strings to unicode, like `json.loads` does.
+    """
+
+    name = 'msgpack'
+
+    def encode(self, obj):
+        if msgpack is not None:
+            # bin would turn Python 2 `str` into bytes for the agent
+            return msgpack.packb(obj, use_bin_type=False)
+        parts = []
+        _pack(obj, parts.append)
+        return b''.join(parts)
+
+    def decode(self, data):
+        if msgpack is not None:
+            return msgpack.unpackb(data, raw=False)
+        obj, end = _unpack(data, 0)
+        if end != len(data):
+            raise ValueError('{} extra bytes after msgpack object'.format(len(data) - end))
+        return obj
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec(),
+    MsgpackCodec.name: MsgpackCodec(),
+}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown codec: {}".format(name))
+
+
+class FrameReader(object):
+    """Splits a byte stream into `HEADER` prefixed frames.
+
+    Data is received straight into a preallocated `bytearray` and frames
+    are cut out of it through a `memoryview`, so every byte is copied once
+    into the payload handed out. The buffer only grows for frames larger
+    than it; the unparsed tail is moved to the front when space runs out.
+    """
+
+    def __init__(self, size=64 * 1024):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def recv_from(self, sock):
+        """Reads from `sock` once, returns number of bytes read, 0 on EOF."""
+        self._make_room()
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def frames(self):
+        """Returns payloads of all complete frames received so far."""
+        result = []
+        header_size = HEADER.size
+        while self._end - self._start >= header_size:
+            [length] = HEADER.unpack_from(self._buf, self._start)
+            stop = self._start + header_size + length
+            if stop > self._end:
+                break
+            result.append(self._view[self._start + header_size:stop].tobytes())
+            self._start = stop
+        if self._start == self._end:
+            self._start = self._end = 0
+        return result
+
+    def _make_room(self):
+        # room for at least the rest of the incomplete frame, if it's known
+        pending = self._end - self._start
+        wanted = HEADER.size
+        if pending >= HEADER.size:
+            wanted += HEADER.unpack_from(self._buf, self._start)[0]
+        if wanted > len(self._buf):
+            buf = bytearray(max(wanted, 2 * len(self._buf)))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+            self._start, self._end = 0, pending
+        elif self._start and len(self._buf) - self._end < wanted - pending:
+            self._buf[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+
+
+_B = struct.Struct('>B')
+_H = struct.Struct('>H')
+_I = struct.Struct('>I')
+_Q = struct.Struct('>Q')
+_b = struct.Struct('>b')
+_h = struct.Struct('>h')
+_i = struct.Struct('>i')
+_q = struct.Struct('>q')
+_d = struct.Struct('>d')
+_f = struct.Struct('>f')
+
+try:
+    _text_type = unicode
+    _int_types = (int, long)
+except NameError:
+    _text_type = str
+    _int_types = (int,)
+
+
+def _pack(obj, write):
+    if obj is None:
+        write(b'\xc0')
+    elif obj is True:
+        write(b'\xc3')
+    elif obj is False:
+        write(b'\xc2')
+    elif isinstance(obj, float):
+        write(b'\xcb' + _d.pack(obj))
+    elif isinstance(obj, _int_types):
+        if 0 <= obj < 0x80:
+            write(_B.pack(obj))
+        elif -0x20 <= obj < 0:
+            write(_b.pack(obj))
+        elif 0 <= obj <= 0xff:
+            write(b'\xcc' + _B.pack(obj))
+        elif 0 <= obj <= 0xffff:
+            write(b'\xcd' + _H.pack(obj))
+        elif 0 <= obj <= 0xffffffff:
+            write(b'\xce' + _I.pack(obj))
+        elif 0 <= obj <= 0xffffffffffffffff:
+            write(b'\xcf' + _Q.pack(obj))
+        elif -0x80 <= obj:
+            write(b'\xd0' + _b.pack(obj))
+        elif -0x8000 <= obj:
+            write(b'\xd1' + _h.pack(obj))
+        elif -0x80000000 <= obj:
+            write(b'\xd2' + _i.pack(obj))
+        elif -0x8000000000000000 <= obj:
+            write(b'\xd3' + _q.pack(obj))
+        else:
+            raise ValueError('Integer out of msgpack range: {}'.format(obj))
+    elif isinstance(obj, (bytes, _text_type)):
+        if isinstance(obj, _text_type):
+            obj = obj.encode('utf-8')
+        n = len(obj)
+        if n < 32:
+            write(_B.pack(0xa0 | n))
+        elif n <= 0xff:
+            write(b'\xd9' + _B.pack(n))
+        elif n <= 0xffff:
+            write(b'\xda' + _H.pack(n))
+        else:
+            write(b'\xdb' + _I.pack(n))
+        write(obj)
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n < 16:
+            write(_B.pack(0x90 | n))
+        elif n <= 0xffff:
+            write(b'\xdc' + _H.pack(n))
+        else:
+            write(b'\xdd' + _I.pack(n))
+        for item in obj:
+            _pack(item, write)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n < 16:
+            write(_B.pack(0x80 | n))
+        elif n <= 0xffff:
+            write(b'\xde' + _H.pack(n))
+        else:
+            write(b'\xdf' + _I.pack(n))
+        for key, value in obj.items():
+            _pack(key, write)
+            _pack(value, write)
+    else:
+        raise TypeError('Cannot pack {!r} to msgpack'.format(obj))
+
+
+# type byte -> (struct of the value or length, kind)
+_FIXED = {
+    0xca: (_f, 'value'), 0xcb: (_d, 'value'),
+    0xcc: (_B, 'value'), 0xcd: (_H, 'value'), 0xce: (_I, 'value'), 0xcf: (_Q, 'value'),
+    0xd0: (_b, 'value'), 0xd1: (_h, 'value'), 0xd2: (_i, 'value'), 0xd3: (_q, 'value'),
+    0xd9: (_B, 'str'), 0xda: (_H, 'str'), 0xdb: (_I, 'str'),
+    0xc4: (_B, 'bin'), 0xc5: (_H, 'bin'), 0xc6: (_I, 'bin'),
+    0xdc: (_H, 'array'), 0xdd: (_I, 'array'),
+    0xde: (_H, 'map'), 0xdf: (_I, 'map'),
+}
+
+
+def _unpack(data, pos):
+    # returns (object, position after it)
+    [t] = _B.unpack_from(data, pos)
+    pos += 1
+    if t < 0x80:
+        return t, pos
+    if t >= 0xe0:
+        return t - 0x100, pos
+    if t <= 0x8f:
+        kind, n = 'map', t & 0x0f
+    elif t <= 0x9f:
+        kind, n = 'array', t & 0x0f
+    elif t <= 0xbf:
+        kind, n = 'str', t & 0x1f
+    elif t == 0xc0:
+        return None, pos
+    elif t == 0xc2:
+        return False, pos
+    elif t == 0xc3:
+        return True, pos
+    elif t in _FIXED:
+        fmt, kind = _FIXED[t]
+        [n] = fmt.unpack_from(data, pos)
+        pos += fmt.size
+        if kind == 'value':
+            return n, pos
+    else:
+        raise ValueError('Unsupported msgpack type 0x{:02x}'.format(t))
+
+    if kind in ('str', 'bin'):
+        if pos + n > len(data):
+            raise ValueError('Truncated msgpack data')
+        raw = data[pos:pos + n]
+        return (raw.decode('utf-8') if kind == 'str' else raw), pos + n
+    if kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = _unpack(data, pos)
+            items.append(item)
+        return items, pos
+    result = {}
+    for _ in range(n):
+        key, pos = _unpack(data, pos)
+        result[key], pos = _unpack(data, pos)
+    return result, pos
@@ -0,0 +1,93 @@
+"""Stand-in for the CT agent socket, for running the daemon without one.
+
+Prints every incoming message, negotiates any codec from `--codecs` the
+client asks for, and optionally enables event types in the client config.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import socket
+import threading
+from ct_addons import wire
+
+
+def read_frames(sock):
+    reader = wire.FrameReader()
+    while reader.recv_from(sock):
+        for frame in reader.frames():
+            yield frame
+
+
+def send_frame(sock, codec, contents):
+    data = codec.encode(contents)
+    sock.sendall(wire.HEADER.pack(len(data)) + data)
+
+
+def serve_client(sock, codecs, enable, options, on_event=None):
+    # `on_event(codec name, message)` is called with every event message
+    json_codec = wire.CODECS['json']
+    # client frames stay JSON until it confirms the switch, agent frames
+    # switch right after the ack
+    in_codec = out_codec = json_codec
+    n_events = 0
+    hello_seen = False
+    for frame in read_frames(sock):
+        contents = in_codec.decode(frame)
+        if not hello_seen:
+            hello_seen = True
+            print('hello: {}'.format(contents))
+            offered = [c for c in contents.get('codecs', []) if c in codecs]
+            if offered and offered[0] != 'json':
+                send_frame(sock, json_codec, {'codec': offered[0]})
+                out_codec = wire.CODECS[offered[0]]
+            for event_type in enable:
+                send_frame(sock, out_codec, {
+                    'config_state_enabled': True,
+                    'event_type': event_type,
+                    'options': options,
+                })
+        elif 'codec' in contents:
+            print('client switched to {}'.format(contents['codec']))
+            in_codec = wire.CODECS[contents['codec']]
+        else:
+            n_events += 1
+            print('event: {}'.format(contents))
+            if on_event is not None:
+                on_event(in_codec.name, contents)
+    print('client disconnected after {} events'.format(n_events))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('socket_path', nargs='?', default='/tmp/ct-agent.sock')
+    parser.add_argument('--codecs', default='json,msgpack',
+                        help="comma separated codecs the agent accepts")
+    parser.add_argument('--enable', action='append', default=[],
+                        metavar='EVENT_TYPE',
+                        help="enable this event type for every client")
+    parser.add_argument('--options', default='{}',
+                        help="JSON options sent with enabled event types")
+    opts = parser.parse_args()
+
+    codecs = opts.codecs.split(',')
+    for name in codecs:
+        wire.get_codec(name)
+    options = json.loads(opts.options)
+
+    if os.path.exists(opts.socket_path):
+        os.unlink(opts.socket_path)
+    server = socket.socket(socket.AF_UNIX)
+    server.bind(opts.socket_path)
+    server.listen(5)
+    print('listening at {}'.format(opts.socket_path))
+    while True:
+        sock, _ = server.accept()
+        thread = threading.Thread(target=serve_client,
+                                  args=(sock, codecs, opts.enable, options))
+        thread.setDaemon(True)
+        thread.start()
+
+
+if __name__ == '__main__':
+    main()
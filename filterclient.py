@@ -4,8 +4,9 @@ import socket
 import struct
 import time
 import threading
+from ct_addons.event_trackers.mpu6050 import capture, debug_protocol
 from ct_addons.event_trackers.mpu6050.motion_tracker import MotionTracker
-from ct_addons.event_trackers.mpu6050.data_source import motiontracker_data_generator
+from ct_addons.event_trackers.mpu6050.data_source import motiontracker_batch_generator
 
 
 def stream_from_socket(host, port):
@@ -19,7 +20,64 @@ def stream_from_socket(host, port):
         yield struct.unpack('fffffffff', packet)
 
 
+def stream_frames_from_socket(host, port, channels=debug_protocol.CHANNELS,
+                              decimation=1):
+    """Subscribes to `channels` of every `decimation`-th sample and yields
+    (sample number, timestamp, values) for every sample received, samples
+    numbered for each sensor."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((host, port))
+    mask = debug_protocol.channel_mask(channels)
+    sock.sendall(debug_protocol.encode_subscribe(mask, decimation))
+
+    header = debug_protocol.FRAME_HEADER
+    n_channels = len(debug_protocol.mask_channels(mask))
+    buf = b''
+    synced = False
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return
+        buf += data
+        while len(buf) >= header.size:
+            if not synced:
+                # skip the legacy stream preceding the first frame
+                start = buf.find(debug_protocol.FRAME_MAGIC)
+                if start < 0:
+                    buf = buf[-3:]
+                    break
+                buf = buf[start:]
+                if len(buf) < header.size:
+                    break
+            try:
+                fields = debug_protocol.decode_frame_header(buf[:header.size])
+            except ValueError:
+                if synced:
+                    raise
+                buf = buf[1:]
+                continue
+            _, frame_mask, frame_decimation, n_samples, seq, t_first, t_last, body_size = fields
+            if not synced and (frame_mask, frame_decimation) != (mask, decimation):
+                buf = buf[1:]
+                continue
+            synced = True
+            if len(buf) < header.size + body_size:
+                break
+            body = buf[header.size:header.size + body_size]
+            buf = buf[header.size + body_size:]
+            values = debug_protocol.body_struct(body_size // 4).unpack(body)
+            step = (t_last - t_first) / (n_samples - 1) if n_samples > 1 else 0
+            for i in range(n_samples):
+                yield (seq + i * decimation, t_first + i * step,
+                       values[i * n_channels:(i + 1) * n_channels])
+
+
 def stream_from_file(filename, dt):
+    # capture files are replayed at recorded pace when `dt` is given
+    if capture.is_capture(filename):
+        for item in capture.CaptureReplay([filename], speed=1.0 if dt > 0 else 0):
+            yield item
+        return
     import numpy as np
     data = np.loadtxt(filename)[:, 1:]
     for item in data:
@@ -28,16 +86,52 @@ def stream_from_file(filename, dt):
             time.sleep(dt)
 
 
+def stream_blocks_from_file(filename, blocksize=4096):
+    # capture files are read chunk by chunk, whatever the `blocksize`
+    if capture.is_capture(filename):
+        for block in capture.CaptureReplay([filename], speed=0).blocks():
+            yield block
+        return
+    import numpy as np
+    data = np.loadtxt(filename)[:, 1:]
+    for start in range(0, len(data), blocksize):
+        yield data[start:start + blocksize]
+
+
+def replay_file(filename, tracker, calibrate_n=0, blocksize=4096):
+    # offline replay goes through the batch filter, which is much faster
+    # than feeding `tracker.add_data` one sample at a time
+    blocks = motiontracker_batch_generator(
+        stream_blocks_from_file(filename, blocksize), tracker, calibrate_n,
+    )
+    for block in blocks:
+        for item in block.tolist():
+            yield tuple(item)
+
+
 def main_terminal():
     parser = argparse.ArgumentParser()
     parser.add_argument('host')
     parser.add_argument('port', type=int)
+    parser.add_argument('--channels',
+                        help="comma separated channels to subscribe to, one"
+                             " of: " + ','.join(debug_protocol.CHANNELS))
+    parser.add_argument('--decimation', type=int, default=1,
+                        help="receive only every n-th sample")
     opts = parser.parse_args()
 
-    streamer = stream_from_socket(opts.host, opts.port)
-    for item in streamer:
+    if opts.channels is None and opts.decimation == 1:
+        streamer = stream_from_socket(opts.host, opts.port)
+        for item in streamer:
+            fmt_item = ' '.join('{:7.2f}'.format(x) for x in item)
+            print(fmt_item)
+        return
+
+    channels = opts.channels.split(',') if opts.channels else debug_protocol.CHANNELS
+    streamer = stream_frames_from_socket(opts.host, opts.port, channels, opts.decimation)
+    for seq, timestamp, item in streamer:
         fmt_item = ' '.join('{:7.2f}'.format(x) for x in item)
-        print(fmt_item)
+        print('{:8d} {:.3f} {}'.format(seq, timestamp, fmt_item))
 
 
 def main_gui():
@@ -54,23 +148,7 @@ def main_gui():
     dt = 0.011
     bufsize = 2000
 
-    streamer = stream_from_file('data.txt', -1)
-    # streamer = stream_from_socket(opts.host, opts.port)
-    streamer = motiontracker_data_generator(
-        streamer,
-        MotionTracker(0.5, dt),
-        calibrate_n=300,
-    )
-
-    # tracker = MotionTracker(0.5, dt)
-
-    # print('Calibrating...')
-    # tracker.start_calibration()
-    # for _ in range(200):
-    #     item = next(streamer)
-    #     tracker.add_data(*item)
-    # tracker.finish_calibration()
-    # print('Calibration done')
+    streamer = replay_file('data.txt', MotionTracker(0.5, dt), calibrate_n=300)
 
     lock = threading.Lock()
     buffers = [[] for _ in range(9)]
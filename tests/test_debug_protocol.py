@@ -0,0 +1,66 @@
+import unittest
+from ct_addons.event_trackers.mpu6050 import debug_protocol
+
+
+def decode_frames(data):
+    # (sensor, [(sample number, timestamp, values)]) per frame
+    header = debug_protocol.FRAME_HEADER
+    frames = []
+    while data:
+        sensor, mask, decimation, n_samples, number, t_first, t_last, body_size = \
+            debug_protocol.decode_frame_header(data[:header.size])
+        body = data[header.size:header.size + body_size]
+        data = data[header.size + body_size:]
+        values = debug_protocol.body_struct(body_size // 4).unpack(body)
+        width = len(debug_protocol.mask_channels(mask))
+        step = (t_last - t_first) / (n_samples - 1) if n_samples > 1 else 0
+        frames.append((sensor, [
+            (number + i * decimation, t_first + i * step, values[i * width:(i + 1) * width])
+            for i in range(n_samples)
+        ]))
+    return frames
+
+
+def interleaved(n, start=0):
+    # samples of sensors 0 and 1 taken in turns, accx is the sample number
+    # of the sensor
+    return [
+        (seq, seq * 0.01, (seq // 2,) + (0.0,) * 12 + (seq % 2,))
+        for seq in range(start, start + n)
+    ]
+
+
+class FrameEncoderTest(unittest.TestCase):
+
+    def encoder(self, decimation):
+        mask = debug_protocol.channel_mask(['accx', 'sensor'])
+        return debug_protocol.FrameEncoder(mask, decimation)
+
+    def test_interleaved_sensors(self):
+        frames = decode_frames(self.encoder(1).encode(interleaved(8)))
+        self.assertEqual([sensor for sensor, _ in frames], [0, 1])
+        for sensor, samples in frames:
+            self.assertEqual([number for number, _, _ in samples], [0, 1, 2, 3])
+            self.assertEqual([values for _, _, values in samples],
+                             [(number, sensor) for number in range(4)])
+
+    def test_decimation_is_per_sensor(self):
+        encoder = self.encoder(2)
+        frames = decode_frames(encoder.encode(interleaved(8)))
+        frames += decode_frames(encoder.encode(interleaved(8, start=8)))
+        numbers = {}
+        for sensor, samples in frames:
+            numbers.setdefault(sensor, []).extend(values[0] for _, _, values in samples)
+        self.assertEqual(numbers, {0: [0, 2, 4, 6], 1: [0, 2, 4, 6]})
+        # one frame per sensor and batch
+        self.assertEqual(len(frames), 4)
+
+    def test_lost_samples_end_frames(self):
+        samples = interleaved(4) + interleaved(4, start=10)
+        frames = decode_frames(self.encoder(1).encode(samples))
+        self.assertEqual([(sensor, len(samples)) for sensor, samples in frames],
+                         [(0, 2), (1, 2), (0, 2), (1, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
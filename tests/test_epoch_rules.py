@@ -0,0 +1,113 @@
+import random
+import unittest
+from ct_addons.event_trackers.mpu6050 import epoch_rules
+from ct_addons.event_trackers.mpu6050.debug_protocol import CHANNELS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DT = 0.01
+
+RULES = [
+    {'event': 'TILT', 'value': 'max(abs(anglex), abs(angley))',
+     'above': 20, 'hysteresis': 3, 'min_duration': 0.05},
+    {'event': 'TEMPERATURE', 'value': 'temp', 'below': 15, 'above': 45, 'hysteresis': 1},
+    {'event': 'MOVEMENT', 'value': 'hypot(latx, laty)', 'above': 0.5, 'min_duration': 0.03},
+    {'event': 'SPIN', 'value': 'gyroz', 'below': -30},
+]
+
+
+def samples(n, seed=0):
+    # random walks that cross every threshold many times
+    rnd = random.Random(seed)
+    values = dict.fromkeys(CHANNELS, 0.0)
+    values['temp'] = 30.0
+    walks = {'anglex': 3.0, 'angley': 3.0, 'temp': 1.5, 'latx': 0.1, 'laty': 0.1, 'gyroz': 8.0}
+    items = []
+    for _ in range(n):
+        for name, step in walks.items():
+            values[name] += rnd.gauss(0, step)
+        values['temp'] = min(60, max(0, values['temp']))
+        for name, decay in [('anglex', 0.98), ('angley', 0.98), ('latx', 0.9),
+                            ('laty', 0.9), ('gyroz', 0.95)]:
+            values[name] *= decay
+        items.append(tuple(values[name] for name in CHANNELS))
+    return items
+
+
+def one_by_one(rules, state, items):
+    changes = []
+    for item in items:
+        changes.extend(rules.evaluate(state, item))
+    return changes
+
+
+def in_batches(rules, state, items, sizes):
+    rows = numpy.array(items)
+    changes = []
+    start = 0
+    for size in sizes:
+        changes.extend(rules.evaluate_batch(state, rows[start:start + size]))
+        start += size
+    changes.extend(rules.evaluate_batch(state, rows[start:]))
+    return changes
+
+
+def value_rule(**kwargs):
+    # rule of anglex alone
+    return epoch_rules.EpochRules([epoch_rules.EpochRule('E', 'anglex', **kwargs)], DT)
+
+
+def anglex(values):
+    return [tuple(value if name == 'anglex' else 0.0 for name in CHANNELS)
+            for value in values]
+
+
+@unittest.skipIf(numpy is None, 'no NumPy')
+class EvaluateBatchTest(unittest.TestCase):
+
+    def assertSameChanges(self, scalar, batch):
+        self.assertEqual([change[:3] for change in batch], [change[:3] for change in scalar])
+        for (_, _, _, item), (_, _, _, row) in zip(scalar, batch):
+            self.assertEqual(tuple(row), item)
+
+    def test_random_walks(self):
+        rules = epoch_rules.EpochRules(epoch_rules.load_rules(RULES), DT)
+        items = samples(5000)
+        rnd = random.Random(1)
+        sizes = [rnd.randint(1, 100) for _ in range(80)]
+        scalar_state, batch_state = rules.new_state(), rules.new_state()
+        scalar = one_by_one(rules, scalar_state, items)
+        batch = in_batches(rules, batch_state, items, sizes)
+        self.assertSameChanges(scalar, batch)
+        # every rule starts and ends epochs
+        for i in range(len(RULES)):
+            self.assertEqual(set(now for rule, now, _, _ in scalar if rule == i),
+                             set([True, False]))
+        for name in ('trigger', 'met', 'pending', 'samples'):
+            self.assertEqual(getattr(batch_state, name), getattr(scalar_state, name))
+
+    def test_hysteresis(self):
+        rules = value_rule(above=10, hysteresis=2)
+        items = anglex([11, 13, 11, 9, 7, 11, 13])
+        scalar = one_by_one(rules, rules.new_state(), items)
+        self.assertEqual([change[1:3] for change in scalar], [(True, 1), (False, 4), (True, 6)])
+        for sizes in ([1] * 7, [2, 3], [7]):
+            self.assertSameChanges(scalar, in_batches(rules, rules.new_state(), items, sizes))
+
+    def test_debounce(self):
+        # 3 samples
+        rules = value_rule(above=10, min_duration=0.03)
+        items = anglex([20, 20, 0, 20, 20, 20, 0, 0, 20, 0, 0, 0])
+        scalar = one_by_one(rules, rules.new_state(), items)
+        self.assertEqual([change[1:3] for change in scalar], [(True, 5), (False, 11)])
+        # runs are counted across batches
+        for sizes in ([1] * 12, [4, 1, 5], [2, 2, 2, 2], [12]):
+            self.assertSameChanges(scalar, in_batches(rules, rules.new_state(), items, sizes))
+
+
+if __name__ == '__main__':
+    unittest.main()
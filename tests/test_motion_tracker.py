@@ -0,0 +1,73 @@
+import math
+import random
+import unittest
+from ct_addons.event_trackers.mpu6050.motion_tracker import MotionTracker
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def samples(n, dt=0.011, seed=0):
+    # accelerometer and gyro of a device wobbling around a tilted rest
+    rnd = random.Random(seed)
+    return [(
+        0.42 + 2.0 * math.sin(i * dt) + rnd.gauss(0, 0.05),
+        -1.11 + 1.5 * math.cos(0.5 * i * dt) + rnd.gauss(0, 0.05),
+        10.05 + rnd.gauss(0, 0.05),
+        40 * math.sin(1.3 * i * dt) + rnd.gauss(0, 0.3),
+        25 * math.cos(0.7 * i * dt) + rnd.gauss(0, 0.3),
+        10 * math.sin(2.1 * i * dt) + rnd.gauss(0, 0.3),
+    ) for i in range(n)]
+
+
+def calibrated(calibration):
+    tracker = MotionTracker(0.5, 0.011, accel_offsets=(0.1, -0.2, 0.3))
+    tracker.start_calibration()
+    for item in calibration:
+        tracker.add_data(*item)
+    tracker.finish_calibration()
+    return tracker
+
+
+@unittest.skipIf(numpy is None, 'no NumPy')
+class AddBatchTest(unittest.TestCase):
+
+    def test_matches_add_data(self):
+        data = samples(2300)
+        calibration, data = data[:300], data[300:]
+        tracker = calibrated(calibration)
+        expected = []
+        for item in data:
+            tracker.add_data(*item)
+            expected.append(tuple(tracker.angles) + tuple(tracker.coordinates))
+
+        tracker = calibrated(calibration)
+        blocks = []
+        start = 0
+        # state carries over blocks of any size
+        for size in [1, 7, 64, 256, 1000, 672]:
+            blocks.append(tracker.add_batch(numpy.array(data[start:start + size])))
+            start += size
+        self.assertEqual(start, len(data))
+        result = numpy.vstack(blocks)
+        expected = numpy.array(expected)
+        self.assertLess(abs(result[:, :3] - expected[:, :3]).max(), 0.01)
+        self.assertTrue(numpy.allclose(result[:, 3:], expected[:, 3:], rtol=1e-6, atol=1e-6))
+        self.assertTrue(numpy.allclose(tracker.angles, expected[-1, :3], atol=0.01))
+
+    def test_calibration(self):
+        calibration = samples(300)
+        tracker = MotionTracker(0.5, 0.011, accel_offsets=(0.1, -0.2, 0.3))
+        tracker.start_calibration()
+        self.assertIsNone(tracker.add_batch(numpy.array(calibration[:100])))
+        self.assertIsNone(tracker.add_batch(numpy.array(calibration[100:])))
+        tracker.finish_calibration()
+        expected = calibrated(calibration)
+        self.assertTrue(numpy.allclose(tracker._gyro_offs, expected._gyro_offs))
+        self.assertTrue(numpy.allclose(tracker._init_gravity, expected._init_gravity))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from ct_addons import policy
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.events = []
+
+    def send_event(self, event_type, data):
+        self.events.append((event_type, data))
+
+
+class EventPoliciesTest(unittest.TestCase):
+
+    def policies(self, **kwargs):
+        self.client = FakeClient()
+        return policy.EventPolicies(self.client, {'E': policy.EventPolicy(**kwargs)})
+
+    def test_token_bucket(self):
+        events = self.policies(rate=1, burst=2)
+        for i in range(5):
+            events.send_event('E', {'x': i}, now=0.0)
+        self.assertEqual([data['x'] for _, data in self.client.events], [0, 1])
+        events.flush(now=0.5)
+        self.assertEqual(len(self.client.events), 2)
+        # a token a second, the rest are merged into one event
+        events.flush(now=1.0)
+        self.assertEqual(self.client.events[2][1],
+                         {'x': 4, 'count': 3, 'min': {'x': 2}, 'max': {'x': 4}})
+        self.assertEqual(events.metrics.snapshot()['policy.events_merged'], 3)
+
+    def test_bucket_holds_burst_tokens(self):
+        events = self.policies(rate=1, burst=2)
+        events.send_event('E', {'x': 0}, now=0.0)
+        for i in range(5):
+            events.send_event('E', {'x': i}, now=100.0)
+        self.assertEqual(len(self.client.events), 3)
+
+    def test_other_types_pass(self):
+        events = self.policies(rate=1, burst=1)
+        for i in range(5):
+            events.send_event('F', {'x': i}, now=0.0)
+        self.assertEqual(len(self.client.events), 5)
+
+    def test_dwell(self):
+        events = self.policies(dwell=0.2)
+        events.epoch('E', True, {'x': 1}, now=0.0)
+        events.flush(now=0.1)
+        self.assertEqual(self.client.events, [])
+        events.flush(now=0.2)
+        self.assertEqual(self.client.events, [('E', {'x': 1})])
+
+    def test_short_epochs_are_rejected(self):
+        events = self.policies(dwell=0.2)
+        events.epoch('E', True, {'x': 1}, now=0.0)
+        events.epoch('E', False, {}, now=0.1)
+        events.flush(now=1.0)
+        self.assertEqual(self.client.events, [])
+        self.assertEqual(events.metrics.snapshot()['policy.epochs_rejected'], 1)
+
+    def test_short_gaps_dont_end_epochs(self):
+        events = self.policies(dwell=0.2)
+        events.epoch('E', True, {'x': 1}, now=0.0)
+        events.flush(now=0.5)
+        events.epoch('E', False, {}, now=0.6)
+        events.epoch('E', True, {'x': 2}, now=0.7)
+        events.flush(now=2.0)
+        self.assertEqual(self.client.events, [('E', {'x': 1})])
+
+    def test_coalesce(self):
+        events = self.policies(coalesce=1.0)
+        events.send_event('E', {'x': 1.0}, now=0.0)
+        events.send_event('E', {'x': 3.0}, now=0.2)
+        events.send_event('E', {'x': 2.0}, now=0.5)
+        events.flush(now=0.9)
+        self.assertEqual(len(self.client.events), 1)
+        events.flush(now=1.0)
+        self.assertEqual(self.client.events[1][1],
+                         {'x': 2.0, 'count': 2, 'min': {'x': 2.0}, 'max': {'x': 3.0}})
+        # the window starts again from the merged event
+        events.send_event('E', {'x': 4.0}, now=1.5)
+        self.assertEqual(len(self.client.events), 2)
+
+    def test_sensors_are_coalesced_apart(self):
+        events = self.policies(coalesce=1.0)
+        events.send_event('E', {'x': 1.0, 'sensor': 'left'}, now=0.0)
+        events.send_event('E', {'x': 1.0, 'sensor': 'right'}, now=0.0)
+        self.assertEqual(len(self.client.events), 2)
+
+    def test_configure_replaces_policies(self):
+        events = self.policies(rate=1, burst=1)
+        events.configure({'F': policy.EventPolicy(rate=1, burst=1)})
+        for i in range(3):
+            events.send_event('E', {'x': i}, now=0.0)
+            events.send_event('F', {'x': i}, now=0.0)
+        self.assertEqual([event_type for event_type, _ in self.client.events],
+                         ['E', 'F', 'E', 'E'])
+
+
+if __name__ == '__main__':
+    unittest.main()
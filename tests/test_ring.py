@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+from ct_addons.event_trackers.mpu6050.data_source import (
+    DataStreamer, RingCursor, SampleRing,
+)
+
+
+def filled(ring, n, start=0):
+    for i in range(start, start + n):
+        ring.append(i)
+    return ring
+
+
+class SampleRingTest(unittest.TestCase):
+
+    def test_read(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor()
+        filled(ring, 5)
+        self.assertEqual(cursor.read(), range(5))
+        self.assertEqual(cursor.read(), [])
+        filled(ring, 3, start=5)
+        self.assertEqual(cursor.read(), [5, 6, 7])
+        self.assertEqual((cursor.delivered, cursor.overruns), (8, 0))
+
+    def test_cursor_starts_at_the_end(self):
+        ring = filled(SampleRing(10), 5)
+        cursor = ring.cursor()
+        filled(ring, 2, start=5)
+        self.assertEqual(cursor.read(), [5, 6])
+
+    def test_indexed(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor()
+        filled(ring, 3)
+        items = cursor.read(indexed=True)
+        self.assertEqual([(seq, item) for seq, _, item in items], [(0, 0), (1, 1), (2, 2)])
+        times = [t for _, t, _ in items]
+        self.assertEqual(times, sorted(times))
+
+    def test_drop_oldest_overrun(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor()
+        filled(ring, 25)
+        # the slot of the next item is given up too, it may be written
+        # while items are copied
+        self.assertEqual(cursor.read(), range(16, 25))
+        self.assertEqual((cursor.delivered, cursor.overruns), (9, 16))
+        filled(ring, 2, start=25)
+        self.assertEqual(cursor.read(), [25, 26])
+
+    def test_latest_only(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor('latest-only')
+        filled(ring, 25)
+        self.assertEqual(cursor.read(), [24])
+        self.assertEqual((cursor.delivered, cursor.overruns), (1, 24))
+
+    def test_cursors_are_independent(self):
+        ring = SampleRing(10)
+        slow = ring.cursor()
+        fast = ring.cursor()
+        for i in range(25):
+            ring.append(i)
+            self.assertEqual(fast.read(), [i])
+        self.assertEqual(fast.overruns, 0)
+        self.assertEqual(slow.read(), range(16, 25))
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, RingCursor, SampleRing(10), 'newest')
+
+    def test_wait(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor()
+        # times out with nothing to read
+        self.assertTrue(ring.wait(cursor, 0.01))
+        self.assertEqual(cursor.read(), [])
+        filled(ring, 2)
+        ring.close()
+        # closed, but there's still something to read
+        self.assertTrue(ring.wait(cursor, 0.01))
+        self.assertEqual(cursor.read(), [0, 1])
+        self.assertFalse(ring.wait(cursor, 0.01))
+
+    def test_wait_wakes_up_on_append(self):
+        ring = SampleRing(10)
+        cursor = ring.cursor()
+        timer = threading.Timer(0.05, ring.append, args=(1,))
+        timer.start()
+        started = time.time()
+        self.assertTrue(ring.wait(cursor, 5))
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual(cursor.read(), [1])
+        timer.join()
+
+
+class SlowConsumerTest(unittest.TestCase):
+
+    N_ITEMS = 5000
+
+    def test_slow_consumer_loses_oldest_items(self):
+        consumers_added = threading.Event()
+        produced = threading.Event()
+
+        def generator():
+            consumers_added.wait(5)
+            for i in range(self.N_ITEMS):
+                yield (i,)
+            produced.set()
+
+        slow_items = []
+        fast_items = []
+
+        def slow(items):
+            slow_items.extend(items)
+            time.sleep(0.05)
+
+        streamer = DataStreamer(generator(), max_queue_size=100)
+        slow_id = streamer.add_consumer(slow, batch_size=10)
+        fast_id = streamer.add_consumer(fast_items.extend, batch_size=10)
+        consumers_added.set()
+        # at the slow consumer's pace this would take 25 s
+        self.assertTrue(produced.wait(5))
+        streamer.wait_for_end()
+
+        stats = streamer.consumer_stats()
+        delivered, lost = stats[slow_id]
+        self.assertEqual(delivered + lost, self.N_ITEMS)
+        self.assertGreater(lost, 0)
+        self.assertEqual(len(slow_items), delivered)
+        # items come in order, whatever is lost
+        self.assertEqual(slow_items, sorted(slow_items))
+        self.assertEqual(slow_items[-1], (self.N_ITEMS - 1,))
+        delivered, lost = stats[fast_id]
+        self.assertEqual(delivered + lost, self.N_ITEMS)
+        self.assertEqual(len(fast_items), delivered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+from ct_addons.spill import SpillLog
+
+# data area of 1024 bytes, 9 records of `record` fit
+SIZE = SpillLog._HEADER.size + 1024
+
+
+def record(i):
+    # 100 bytes, 104 in the log
+    return '{:<100d}'.format(i)
+
+
+def numbers(records):
+    return [int(data) for data in records]
+
+
+class SpillLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def log(self, drop_policy='oldest', size=SIZE):
+        return SpillLog(self.path, size, drop_policy)
+
+    def test_wrap_around(self):
+        spill = self.log()
+        for i in range(9):
+            self.assertTrue(spill.append(record(i)))
+        self.assertEqual(numbers(spill.pop(3 * 104)), [0, 1, 2])
+        # don't fit at the end, start from the beginning
+        for i in range(9, 12):
+            self.assertTrue(spill.append(record(i)))
+        self.assertEqual(spill.dropped, 0)
+        self.assertEqual(numbers(spill.pop_all()), range(3, 12))
+        self.assertEqual(len(spill), 0)
+
+    def test_drop_oldest(self):
+        spill = self.log()
+        for i in range(30):
+            spill.append(record(i))
+        self.assertEqual(len(spill) + spill.dropped, 30)
+        self.assertEqual(numbers(spill.pop_all()), range(spill.dropped, 30))
+
+    def test_drop_newest(self):
+        spill = self.log('newest')
+        results = [spill.append(record(i)) for i in range(30)]
+        self.assertEqual(results, [True] * 9 + [False] * 21)
+        self.assertEqual(spill.dropped, 21)
+        self.assertEqual(numbers(spill.pop_all()), range(9))
+
+    def test_too_long_record_is_dropped(self):
+        spill = self.log()
+        spill.append(record(0))
+        self.assertFalse(spill.append('x' * 1024))
+        self.assertEqual(numbers(spill.pop_all()), [0])
+
+    def test_pop_is_bounded(self):
+        spill = self.log()
+        for i in range(5):
+            spill.append(record(i))
+        # the first record even if it doesn't fit
+        self.assertEqual(numbers(spill.pop(10)), [0])
+        self.assertEqual(numbers(spill.pop(2 * 104 + 103)), [1, 2])
+        self.assertEqual(numbers(spill.pop(10000)), [3, 4])
+        self.assertEqual(spill.pop(10000), [])
+
+    def test_reopen(self):
+        spill = self.log()
+        for i in range(12):
+            spill.append(record(i))
+        spill.pop(104)
+        spill.close()
+        spill = self.log()
+        self.assertEqual(spill.dropped, 3)
+        self.assertEqual(numbers(spill.pop_all()), range(4, 12))
+
+    def test_reopen_after_pop_all(self):
+        spill = self.log()
+        spill.append(record(0))
+        spill.pop_all()
+        spill.close()
+        self.assertEqual(len(self.log()), 0)
+
+    def test_reopen_with_other_size_starts_empty(self):
+        spill = self.log()
+        spill.append(record(0))
+        spill.close()
+        spill = self.log(size=SIZE * 2)
+        self.assertEqual(len(spill), 0)
+        self.assertEqual(spill.pop_all(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from ct_addons.event_trackers.mpu6050 import Mpu6050EventTracker, epoch_rules
+from ct_addons.event_trackers.mpu6050.debug_protocol import CHANNELS
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.events = []
+
+    def send_event(self, event_type, data):
+        self.events.append((event_type, data))
+
+
+def item(anglex):
+    # sample of sensor 0 with `anglex`, every other channel 0
+    values = [0.0] * len(CHANNELS)
+    values[CHANNELS.index('anglex')] = anglex
+    return tuple(values)
+
+
+def tilts(n):
+    # `n` epochs of TILT, 2 samples in and 2 out each
+    return [item(angle) for _ in range(n) for angle in (20, 20, 0, 0)]
+
+
+def tilt_tracker(client):
+    # tracker of a TILT rule, samples are fed by the tests
+    rules = epoch_rules.load_rules([{'event': 'TILT', 'value': 'anglex', 'above': 10}])
+    tracker = Mpu6050EventTracker(client, accel_offsets=(0, 0, 0),
+                                  simulate=True, rules=rules)
+    tracker._stopped.set()
+    tracker.streamer.request_stop()
+    tracker.streamer.wait_for_end()
+    return tracker
+
+
+class EventPoliciesConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.tracker = tilt_tracker(self.client)
+
+    def tilt_events(self):
+        return [data for event_type, data in self.client.events if event_type == 'TILT']
+
+    def test_events_pass_by_default(self):
+        self.tracker._react_for_epoch_batch(tilts(10))
+        self.assertEqual(len(self.tilt_events()), 10)
+
+    def test_config_policies_stay_after_config(self):
+        self.tracker.on_config_enabled('corlina.mpu6050', {
+            'event_policies': {'TILT': {'rate': 1, 'burst': 1}},
+        })
+        self.tracker.on_config_disabled('corlina.mpu6050', {})
+        # 40 samples of 0.011 s, less than a token
+        self.tracker._react_for_epoch_batch(tilts(10))
+        self.assertEqual(len(self.tilt_events()), 1)
+        # the other epochs are merged and sent with the next token
+        self.tracker._react_for_epoch_batch([item(0)] * 100)
+        events = self.tilt_events()
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[1]['count'], 9)
+
+    def test_config_without_policies_keeps_them(self):
+        self.tracker.on_config_enabled('corlina.mpu6050', {
+            'event_policies': {'*': {'rate': 1, 'burst': 1}},
+        })
+        self.tracker.on_config_disabled('corlina.mpu6050', {})
+        self.tracker.on_config_enabled('corlina.mpu6050', {'max_angle_deviation': 30})
+        self.tracker.on_config_disabled('corlina.mpu6050', {})
+        self.tracker._react_for_epoch_batch(tilts(10))
+        self.assertEqual(len(self.tilt_events()), 1)
+
+
+class ReactPathsTest(unittest.TestCase):
+
+    def tracker(self):
+        client = FakeClient()
+        return tilt_tracker(client), client
+
+    @unittest.skipIf(numpy is None, 'no NumPy')
+    def test_array_path_matches_list_path(self):
+        items = tilts(3) + [item(0)] * 3 + tilts(2)
+        tracker, by_list = self.tracker()
+        for i in range(0, len(items), 5):
+            tracker._react_for_epoch_batch(items[i:i + 5])
+        tracker, by_array = self.tracker()
+        rows = numpy.array(items)
+        for i in range(0, len(rows), 5):
+            tracker._react_for_epoch_array(rows[i:i + 5])
+        self.assertEqual(len(by_list.events), 5)
+        self.assertEqual(by_array.events, by_list.events)
+
+    def test_nothing_is_evaluated_while_configuring(self):
+        tracker, client = self.tracker()
+        tracker.on_config_enabled('corlina.mpu6050', {})
+        tracker._react_for_epoch_batch(tilts(2))
+        tracker._react_for_epoch_condition(*item(20))
+        if numpy is not None:
+            tracker._react_for_epoch_array(numpy.array(tilts(2)))
+        self.assertEqual(client.events, [])
+        self.assertEqual(tracker._sample_time(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
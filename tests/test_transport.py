@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+import fakeagent
+from ct_addons import wire
+from ct_addons.spill import SpillLog
+from ct_addons.transport import CTSocketClient
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class AgentTestCase(unittest.TestCase):
+    """Runs `fakeagent` for one client, its events go to `events`."""
+
+    N_EVENTS = 5
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'agent.sock')
+        self.server = socket.socket(socket.AF_UNIX)
+        self.server.bind(self.path)
+        self.server.listen(1)
+        self.events = []
+        self.received = threading.Event()
+        # the agent prints what it gets
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def serve(self):
+        sock, _ = self.server.accept()
+
+        def on_event(codec, message):
+            self.events.append((codec, message))
+            if len(self.events) == self.N_EVENTS:
+                self.received.set()
+        try:
+            fakeagent.serve_client(sock, sorted(wire.CODECS), [], {}, on_event)
+        finally:
+            sock.close()
+
+    def start_agent(self):
+        agent = threading.Thread(target=self.serve)
+        agent.daemon = True
+        agent.start()
+        return agent
+
+
+class FakeAgentTest(AgentTestCase):
+    """The client against `fakeagent`, in every codec."""
+
+    def exchange(self, codec):
+        agent = self.start_agent()
+        client = CTSocketClient('test', ['corlina.mpu6050'], None, None,
+                                socket_path=self.path, codec=codec)
+        client.start()
+        try:
+            self.assertTrue(wait_until(
+                lambda: client._connected.isSet() and client._codec.name == codec))
+            for i in range(self.N_EVENTS):
+                client.send_event('MOVEMENT', {'x': i * 0.5, 'sensor': 'left'})
+            self.assertTrue(self.received.wait(5))
+        finally:
+            client.stop()
+        agent.join(5)
+        self.assertEqual(self.events, [
+            (codec, {'event_type': 'MOVEMENT', 'data': {'x': i * 0.5, 'sensor': 'left'}})
+            for i in range(self.N_EVENTS)
+        ])
+
+    def test_json(self):
+        self.exchange('json')
+
+    def test_msgpack(self):
+        self.exchange('msgpack')
+
+
+class StopTest(AgentTestCase):
+
+    def test_stop_interrupts_waiting_client(self):
+        # the agent never answers
+        accepted = []
+        agent = threading.Thread(target=lambda: accepted.append(self.server.accept()[0]))
+        agent.start()
+        client = CTSocketClient('test', ['corlina.mpu6050'], None, None,
+                                socket_path=self.path)
+        client.start()
+        self.assertTrue(wait_until(client._connected.isSet))
+        agent.join(5)
+        thread = client._loop._thread
+        started = time.time()
+        client.stop()
+        self.assertLess(time.time() - started, 1)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse(client._connected.isSet())
+        # the agent sees the connection closed
+        accepted[0].settimeout(5)
+        data = accepted[0].recv(4096)
+        while data:
+            data = accepted[0].recv(4096)
+        accepted[0].close()
+
+
+class WatermarkClient(CTSocketClient):
+    # keeps the most bytes ever queued
+
+    max_pending_bytes = 0
+
+    def _enqueue(self, data, codec=None):
+        CTSocketClient._enqueue(self, data, codec)
+        self.max_pending_bytes = max(self.max_pending_bytes, self._pending_bytes)
+
+
+class SpillReplayTest(AgentTestCase):
+    """Messages spilled before a restart reach the agent in bounded chunks."""
+
+    N_SPILLED = 500
+    N_EVENTS = N_SPILLED + 5
+
+    def test_replay_is_bounded(self):
+        spill_path = os.path.join(self.directory, 'spill')
+        spill = SpillLog(spill_path)
+        for i in range(self.N_SPILLED):
+            spill.append(json.dumps({'event_type': 'MOVEMENT', 'data': {'n': i}}))
+        spill.close()
+        agent = self.start_agent()
+        client = WatermarkClient('test', ['corlina.mpu6050'], None, None,
+                                 socket_path=self.path, spill_path=spill_path,
+                                 high_watermark=2048, low_watermark=512)
+        client.start()
+        try:
+            self.assertTrue(wait_until(client._connected.isSet))
+            # sent after the spilled ones
+            for i in range(self.N_SPILLED, self.N_EVENTS):
+                client.send_event('MOVEMENT', {'n': i})
+            self.assertTrue(self.received.wait(5))
+        finally:
+            client.stop()
+        agent.join(5)
+        self.assertEqual([message['data']['n'] for _, message in self.events],
+                         range(self.N_EVENTS))
+        # a chunk is cut at the watermark, the hello may come on top
+        self.assertLess(client.max_pending_bytes, 2048 + 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import unittest
+from ct_addons import wire
+
+
+EVENT = {
+    'event_type': 'MOVEMENT',
+    'data': {'x': 0.25, 'y': -1.5, 'sensor': 'left', u'name': u'côté'},
+    'long': 'x' * 40,
+    'count': 300,
+    'flags': [True, False, None],
+}
+
+UNICODE_EVENT = {
+    u'event_type': u'MOVEMENT',
+    u'data': {u'x': 0.25, u'y': -1.5, u'sensor': u'left', u'name': u'côté'},
+    u'long': u'x' * 40,
+    u'count': 300,
+    u'flags': [True, False, None],
+}
+
+
+def is_str(data, pos):
+    # whether the msgpack object at `pos` is a str, not bin
+    t = ord(data[pos:pos + 1])
+    return 0xa0 <= t <= 0xbf or t in (0xd9, 0xda, 0xdb)
+
+
+class MsgpackCodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.msgpack = wire.msgpack
+        self.codec = wire.CODECS['msgpack']
+
+    def tearDown(self):
+        wire.msgpack = self.msgpack
+
+    def paths(self):
+        # with the msgpack package, if it's installed, and without it
+        if self.msgpack is not None:
+            wire.msgpack = self.msgpack
+            yield 'package'
+        wire.msgpack = None
+        yield 'fallback'
+
+    def test_round_trip(self):
+        for path in self.paths():
+            decoded = self.codec.decode(self.codec.encode(EVENT))
+            self.assertEqual(decoded, UNICODE_EVENT, path)
+            self.assertTrue(all(isinstance(key, unicode) for key in decoded), path)
+
+    def test_native_strings_are_packed_as_str(self):
+        for path in self.paths():
+            data = self.codec.encode({'event_type': 'MOVEMENT'})
+            self.assertTrue(is_str(data, 1), path)
+            self.assertTrue(is_str(data, 2 + len('event_type')), path)
+
+    @unittest.skipIf(wire.msgpack is None, "msgpack isn't installed")
+    def test_paths_decode_each_other(self):
+        packed = {}
+        for path in self.paths():
+            packed[path] = self.codec.encode(EVENT)
+        for path in self.paths():
+            for data in packed.values():
+                self.assertEqual(self.codec.decode(data), UNICODE_EVENT, path)
+
+
+if __name__ == '__main__':
+    unittest.main()